@@ -0,0 +1,203 @@
+import os
+import json
+import xml.etree.ElementTree as ET
+
+import pandas as pd
+import numpy as np
+
+#Exact match lookup of "NUMBER STREET" locations against the OpenAddresses datasets in open_addresses/.
+#The index is built once into .npy files (sorted 64 bit key hashes, coordinates and city codes)
+#and memory mapped on load, so a lookup is one vectorized binary search with no csv parsing.
+
+street_suffixes = {'AVENUE': 'AVE', 'AV': 'AVE', 'STREET': 'ST', 'STR': 'ST', 'ROAD': 'RD', 'DRIVE': 'DR',
+                   'PLACE': 'PL', 'BOULEVARD': 'BLVD', 'COURT': 'CT', 'LANE': 'LN', 'PARKWAY': 'PKWY',
+                   'TERRACE': 'TER', 'TERR': 'TER', 'TERRR': 'TER', 'SQUARE': 'SQ', 'CIRCLE': 'CIR',
+                   'WY': 'WAY', 'HIGHWAY': 'HWY', 'TRAIL': 'TRL', 'HILL': 'HL', 'CROSSING': 'XING',
+                   'PKY': 'PKWY', 'PLAZA': 'PLZ', 'BL': 'BLVD', 'MOUNT': 'MT',
+                   'NORTH': 'N', 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W'}
+
+suffix_pattern = r'\b(' + '|'.join(street_suffixes) + r')\b'
+
+#cities for OpenAddresses sources without a CITY column
+source_cities = {'providence': 'Providence', 'city_of_cranston': 'Cranston'}
+
+def normalize_address(locations):
+    """
+    Takes an array or Series of address strings and returns a Series of lookup keys;
+    upper case, punctuation removed, single spaces and abbreviated street suffixes
+    e.g. '71 Linwood Avenue' and '71 LINWOOD AV' both become '71 LINWOOD AVE'
+
+    Only the distinct strings are normalized, then mapped back onto the input
+    """
+    locations = pd.Series(locations)
+    unique = pd.Series(locations.dropna().unique())
+
+    keys = unique.astype(str).str.upper()
+    keys = keys.str.replace(r'[.,#]', ' ', regex=True)
+    keys = keys.str.replace(suffix_pattern, lambda m: street_suffixes[m.group(1)], regex=True)
+    keys = keys.str.split().str.join(' ')
+
+    return locations.map(pd.Series(keys.values, index=unique.values))
+
+def hash_keys(keys):
+    #pandas hashes with a fixed key, so the same string always gets the same 64 bit hash across runs
+    return pd.util.hash_array(np.asarray(keys, dtype=object))
+
+def read_vrt(vrt_file):
+    """
+    Reads an OGR VRT file and returns (csv path, x column, y column, layer name) of its point layer
+    """
+    layer = ET.parse(vrt_file).getroot().find('OGRVRTLayer')
+    source = layer.find('SrcDataSource')
+    csv_file = source.text
+    if source.get('relativeToVRT') == '1':
+        csv_file = os.path.join(os.path.dirname(vrt_file), csv_file)
+    geometry = layer.find('GeometryField')
+    return csv_file, geometry.get('x'), geometry.get('y'), layer.get('name')
+
+def find_sources(address_dir='open_addresses'):
+    """
+    Returns the (csv path, x column, y column, layer name) of every VRT in address_dir whose csv exists,
+    providence first so its points win when two sources share an address
+    """
+    sources = []
+    for name in sorted(os.listdir(address_dir), key=lambda f: (f != 'providence.vrt', f)):
+        if name.endswith('.vrt'):
+            source = read_vrt(os.path.join(address_dir, name))
+            if os.path.exists(source[0]):
+                sources.append(source)
+    return sources
+
+def read_sources(sources):
+    """
+    Reads OpenAddresses csvs into one DataFrame with columns key, lat, lon, city, number, street
+    """
+    frames = []
+    for csv_file, x, y, layer in sources:
+        addresses = pd.read_csv(csv_file, dtype={'NUMBER': str, 'STREET': str, 'CITY': str})
+        addresses = addresses[addresses['NUMBER'].notnull() & addresses['STREET'].notnull()]
+
+        city = addresses['CITY'].str.title() if 'CITY' in addresses else pd.Series(np.nan, index=addresses.index)
+        city = city.fillna(source_cities.get(layer, np.nan))
+
+        frames.append(pd.DataFrame({'number': addresses['NUMBER'].values, 'street': addresses['STREET'].values,
+                                    'lat': addresses[y].values, 'lon': addresses[x].values,
+                                    'city': city.values}))
+    addresses = pd.concat(frames, ignore_index=True)
+    addresses['key'] = normalize_address(addresses['number'] + ' ' + addresses['street']).values
+    return addresses
+
+def write_index_file(path, write):
+    """
+    Writes an index file through write(file object) to a temp file renamed into place, so a process
+    loading the index while another (re)builds it never reads a half written file
+    """
+    tmp_path = path + '.tmp' + str(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+def write_index_meta(path, meta):
+    write_index_file(path, lambda f: f.write(json.dumps(meta).encode()))
+
+def source_stamp(sources):
+    return {csv_file: os.path.getmtime(csv_file) for csv_file, x, y, layer in sources}
+
+def is_stale(address_dir, meta_file):
+    """
+    True if the index described by meta_file is missing or was built from different source csvs
+    """
+    if not os.path.exists(meta_file):
+        return True
+    with open(meta_file) as f:
+        built_from = json.load(f)['sources']
+    return built_from != source_stamp(find_sources(address_dir))
+
+def build_index(address_dir='open_addresses', index_dir=None):
+    """
+    Builds the lookup index from the OpenAddresses csvs in address_dir and saves it to index_dir
+    (default address_dir/index). Only the first point seen for each key is kept.
+
+    returns the index directory
+    """
+    if index_dir is None:
+        index_dir = os.path.join(address_dir, 'index')
+    os.makedirs(index_dir, exist_ok=True)
+
+    sources = find_sources(address_dir)
+    addresses = read_sources(sources)
+
+    hashes = hash_keys(addresses['key'].values)
+    #stable sort keeps the first source's point first among equal hashes
+    order = np.argsort(hashes, kind='stable')
+    hashes = hashes[order]
+    first = np.concatenate(([True], hashes[1:] != hashes[:-1]))
+    order = order[first]
+
+    city_codes, cities = pd.factorize(addresses['city'])
+    keys = hashes[first]
+    coords = addresses[['lat', 'lon']].values[order].astype('float64')
+    city_codes = city_codes[order].astype('int16')
+    write_index_file(os.path.join(index_dir, 'keys.npy'), lambda f: np.save(f, keys))
+    write_index_file(os.path.join(index_dir, 'coords.npy'), lambda f: np.save(f, coords))
+    write_index_file(os.path.join(index_dir, 'cities.npy'), lambda f: np.save(f, city_codes))
+
+    #meta.json last, the index is stale until every array is in place
+    write_index_meta(os.path.join(index_dir, 'meta.json'),
+                     {'cities': list(cities), 'sources': source_stamp(sources), 'size': int(first.sum())})
+
+    return index_dir
+
+class AddressIndex(object):
+    """
+    Memory mapped exact match index of OpenAddresses points
+
+    address_dir: directory of OpenAddresses VRTs and csvs
+    index_dir: where the built index lives, default address_dir/index;
+        (re)built automatically if missing or older than the source csvs
+    """
+    def __init__(self, address_dir='open_addresses', index_dir=None):
+        if index_dir is None:
+            index_dir = os.path.join(address_dir, 'index')
+        if is_stale(address_dir, os.path.join(index_dir, 'meta.json')):
+            build_index(address_dir, index_dir)
+
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            self.cities = np.array(json.load(f)['cities'] + [np.nan], dtype=object)
+        self.keys = np.load(os.path.join(index_dir, 'keys.npy'), mmap_mode='r')
+        self.coords = np.load(os.path.join(index_dir, 'coords.npy'), mmap_mode='r')
+        self.city_codes = np.load(os.path.join(index_dir, 'cities.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, locations):
+        """
+        Returns an integer array with the index row of each location, -1 where not found
+        """
+        keys = normalize_address(locations)
+        found = keys.notnull().values
+        hashes = hash_keys(keys[found].values)
+
+        rows = np.full(len(keys), -1, dtype='int64')
+        positions = np.searchsorted(self.keys, hashes)
+        positions[positions == len(self.keys)] = 0
+        matched = self.keys[positions] == hashes
+        rows[np.flatnonzero(found)[matched]] = positions[matched]
+        return rows
+
+    def lookup(self, locations):
+        """
+        Looks up an array or Series of locations in one pass
+
+        returns DataFrame aligned with locations; columns lat, lon, city, NaN where not found
+        """
+        rows = self.find(locations)
+        hit = rows >= 0
+
+        coords = np.full((len(rows), 2), np.nan)
+        coords[hit] = self.coords[rows[hit]]
+        city_codes = np.full(len(rows), -1, dtype='int64')
+        city_codes[hit] = self.city_codes[rows[hit]]
+
+        return pd.DataFrame({'lat': coords[:, 0], 'lon': coords[:, 1], 'city': self.cities[city_codes]})
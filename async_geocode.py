@@ -0,0 +1,152 @@
+import time
+import random
+import asyncio
+
+import aiohttp
+
+import do_geocode
+
+#asyncio geocoding client; one pooled aiohttp session, a token bucket holding requests to the
+#provider's QPS and jittered exponential backoff on quota (OVER_QUERY_LIMIT, http 429) and server
+#errors. Any other error answers only its own address with None, never the whole batch.
+#geocode_addresses keeps max_in_flight requests going at once and otherwise behaves like
+#do_geocode.geocode_addresses (same cache, same returned DataFrame).
+
+class TokenBucket(object):
+    """
+    Async token bucket; acquire() waits until a token is free
+
+    rate: tokens added per second (the provider's QPS)
+    burst: most tokens that can build up while idle; 1 spaces requests evenly
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class RetryableError(Exception):
+    pass
+
+class AsyncGeocoder(object):
+    """
+    Geocodes many addresses concurrently
+
+    key: google maps api key
+    qps: requests per second allowed by the provider
+    max_in_flight: requests awaiting a response at once, also the connection pool size
+    retries: attempts after the first one for quota, 5xx and connection errors
+    base_delay, max_delay: seconds; attempt n sleeps a random time up to min(max_delay, base_delay * 2**n)
+    link: geocoding endpoint
+    bounds: viewport bias sent with every request
+
+    OVER_QUERY_LIMIT and http 429 also cut the request rate by a fifth (at most once a second), so a qps set
+    above the real quota settles below it instead of burning retries. An address still failing after
+    the last retry, or answered with another 4xx or an unreadable response, comes back as None and
+    is left out of the results (and the cache).
+
+    requests, retries_made and quota_errors count activity since the geocoder was created
+    """
+    def __init__(self, key, qps=40, max_in_flight=10, retries=6, base_delay=0.5, max_delay=32,
+                 link=do_geocode.google_link, bounds='41.70,-71.65|42.0,-71.25', timeout=10):
+        self.key = key
+        self.qps = qps
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.link = link
+        self.bounds = bounds
+        self.timeout = timeout
+        self.requests = 0
+        self.retries_made = 0
+        self.quota_errors = 0
+        self.failures = 0
+
+    def backoff(self, attempt):
+        #full jitter keeps retrying clients from hitting the provider in lock step
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def request(self, session, address):
+        await self.bucket.acquire()
+        self.requests += 1
+        params = {'address': address, 'bounds': self.bounds, 'key': self.key}
+        async with session.get(self.link, params=params) as response:
+            if response.status >= 500:
+                raise RetryableError('server error '+str(response.status))
+            if response.status == 429:
+                self.over_quota()
+                raise RetryableError('too many requests')
+            response.raise_for_status()
+            result = do_geocode.parse_response(await response.json(content_type=None))
+        if result is None:
+            self.over_quota()
+            raise RetryableError('OVER_QUERY_LIMIT')
+        return result
+
+    def over_quota(self):
+        self.quota_errors += 1
+        #requests already in flight hit the same quota window, so cut at most once a second
+        now = time.monotonic()
+        if now - self.last_cut >= 1:
+            self.bucket.rate = max(1.0, self.bucket.rate * 0.8)
+            self.last_cut = now
+
+    async def geocode(self, session, semaphore, address):
+        async with semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    return await self.request(session, address)
+                except (RetryableError, aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if attempt == self.retries:
+                        self.failures += 1
+                        return None
+                    self.retries_made += 1
+                    await asyncio.sleep(self.backoff(attempt))
+                except (aiohttp.ClientError, ValueError, KeyError, IndexError):
+                    #a 4xx or a malformed answer, asking again gets the same one
+                    self.failures += 1
+                    return None
+
+    async def geocode_many(self, addresses):
+        """
+        Geocodes a list of google formatted addresses, returns a list of
+        (lat, lon, neighborhood, city) in the same order, None where every attempt failed
+        """
+        self.bucket = TokenBucket(self.qps)
+        self.last_cut = 0.0
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            return await asyncio.gather(*[self.geocode(session, semaphore, address) for address in addresses])
+
+    def __call__(self, addresses):
+        return asyncio.run(self.geocode_many(list(addresses)))
+
+    def stats(self):
+        return {'requests': self.requests, 'retries': self.retries_made, 'quota_errors': self.quota_errors,
+                'failures': self.failures}
+
+def geocode_addresses(addresses, key, city_state=', Providence, RI', cache=None, qps=40, max_in_flight=10,
+                      **geocoder_args):
+    """
+    Bulk geocoding with max_in_flight concurrent requests held to qps
+
+    Same arguments and result as do_geocode.geocode_addresses; extra keyword arguments
+    go to AsyncGeocoder
+    """
+    geocoder = AsyncGeocoder(key, qps=qps, max_in_flight=max_in_flight, **geocoder_args)
+    return do_geocode.geocode_addresses(addresses, key, city_state=city_state, cache=cache, geocoder=geocoder)
@@ -0,0 +1,187 @@
+import os
+import json
+import argparse
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from crime_fetch import fetch_chunks, create_session
+from do_geocode import GeocodeCache
+from address_index import is_stale, build_index
+from street_resolver import build_street_index, street_index_stale
+from master_store import open_store, write_json, has_parquet
+from neighborhoods import NeighborhoodAssigner
+from rollups import RollupCube
+from spatial_bins import SpatialBins
+from map_tiles import MapArtifacts
+from query_service import notify_reload, default_service_url
+from run_report import RunReport
+from pvd_crime import classify_crime, parse_dates, clean_location, geocoder_chain, get_lat_lon, config_value
+
+#Parallel historical backfill.
+#A date range is split into windows and each window is fetched, classified, cleaned and geocoded
+#in its own worker process; the workers share the on disk geocode cache. A finished window is
+#written to out_dir/windows/<window>.parquet (csv without pyarrow) followed by a <window>.json
+#status file, so a rerun skips finished windows and only refetches the ones that were cut off.
+#The parent process upserts finished windows into the master store in date order
+#while later windows are still running; state.json records the windows already merged.
+
+#geocoder chain and neighborhood polygons of a worker process, loaded once by init_worker
+worker = {}
+
+def date_windows(start, end, freq='MS'):
+    """
+    Splits [start, end) into windows at pandas frequency freq ('MS' months, 'W' weeks, '7D', ...)
+
+    returns list of (window start, window end) Timestamps, end exclusive
+    """
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    bounds = [start] + [bound for bound in pd.date_range(start, end, freq=freq) if start < bound < end] + [end]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def window_name(window):
+    start, end = window
+    return start.strftime('%Y%m%dT%H%M%S')+'_'+end.strftime('%Y%m%dT%H%M%S')
+
+def build_indexes(address_dir='open_addresses'):
+    #stale OpenAddresses indexes are rebuilt once in the parent before the pool starts, so the
+    #workers only load them instead of all rebuilding the same files at once
+    index_dir = os.path.join(address_dir, 'index')
+    if is_stale(address_dir, os.path.join(index_dir, 'meta.json')):
+        build_index(address_dir, index_dir)
+    if street_index_stale(address_dir, os.path.join(index_dir, 'streets.json')):
+        build_street_index(address_dir, index_dir)
+
+def init_worker(google_key, cache_file):
+    worker['google_key'] = google_key
+    worker['chain'] = geocoder_chain(google_key, cache=GeocodeCache(cache_file))
+    worker['neighborhoods'] = NeighborhoodAssigner()
+
+def backfill_window(window, link, key, out_dir, page_size=5000):
+    """
+    Fetches, cleans and geocodes one window in a worker process (see init_worker) and writes it
+    to out_dir/windows/
+
+    window: (start, end) Timestamps, end exclusive
+
+    returns the window's status dict; name, rows, file and the run report of its stages
+    """
+    name = window_name(window)
+    status_file = os.path.join(out_dir, 'windows', name+'.json')
+    if os.path.exists(status_file):
+        with open(status_file) as f:
+            return json.load(f)
+
+    #fetch_chunks bounds are > since and <= until, written with whole seconds (format_since
+    #truncates to .000) and the api's reported_dates are whole seconds too, so with window
+    #edges on whole seconds > start - 1s is >= start and <= end - 1s is < end
+    since = window[0] - pd.Timedelta(seconds=1)
+    until = window[1] - pd.Timedelta(seconds=1)
+    report = RunReport('backfill '+name)
+    session = create_session(key, pool_size=2)
+    report.http('socrata', session)
+    chunks = fetch_chunks(link, key=key, since=since, until=until, page_size=page_size, max_workers=2,
+                          session=session)
+    frames = list(report.timed_iter('fetch', chunks))
+
+    status = {'window': [str(window[0]), str(window[1])], 'name': name, 'rows': 0, 'file': None}
+    if frames:
+        df = pd.concat(frames, ignore_index=True)
+        df = report.call('classify', classify_crime, df)
+        df = report.call('parse_dates', parse_dates, df)
+        df = report.call('clean_location', clean_location, df)
+        df = report.call('geocode', get_lat_lon, df, worker['google_key'], chain=worker['chain'],
+                         neighborhoods=worker['neighborhoods'])
+
+        #write under a temp name first, a killed worker never leaves half a window file
+        file_name = name+('.parquet' if has_parquet else '.csv')
+        path = os.path.join(out_dir, 'windows', file_name)
+        if has_parquet:
+            report.call('save', df.to_parquet, path+'.tmp', index=False)
+        else:
+            report.call('save', df.to_csv, path+'.tmp', index=False)
+        os.replace(path+'.tmp', path)
+        status.update(rows=len(df), file=file_name)
+
+    status['report'] = report.stats()
+    write_json(status_file, status)
+    return status
+
+def read_window(out_dir, status):
+    path = os.path.join(out_dir, 'windows', status['file'])
+    return pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path)
+
+def backfill(start, end, freq='MS', link=None, key=None, google_key=None,
+             out_dir='backfill', store_dir='crime_store', master_file='pvd_crime_master.csv', workers=None,
+             page_size=5000, cache_file='geocode_cache.sqlite', map_dir='map_tiles',
+             service_url=default_service_url):
+    """
+    Backfills the master store with every crime log row reported between start and end
+
+    start, end: date range, end exclusive
+    freq: window size as a pandas frequency, one window is one task for the process pool
+    link, key, google_key: api link and keys, read from config.py when None
+    out_dir: window files and merge state; rerun with the same out_dir to resume
+    store_dir, master_file: master store the windows are merged into, see master_store.open_store
+    workers: worker processes, all cores if None
+    page_size: rows per api page request
+    cache_file: geocode cache shared by the workers
+    map_dir, service_url: map artifacts regenerated and query service notified after the merge,
+        None to skip
+
+    returns dict with the windows processed and the rows inserted, updated and unchanged
+    """
+    link, key, google_key = config_value('api_link', link), config_value('api_key', key), \
+        config_value('google_key', google_key)
+    os.makedirs(os.path.join(out_dir, 'windows'), exist_ok=True)
+    state_file = os.path.join(out_dir, 'state.json')
+    state = {'merged': []}
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+
+    windows = [window for window in date_windows(start, end, freq) if window_name(window) not in state['merged']]
+    store = open_store(store_dir, master_file)
+    cube = RollupCube(store)
+    bins = SpatialBins(store)
+    RollupCube(store.non_offenses)
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    statuses = []
+
+    build_indexes()
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=init_worker,
+                             initargs=(google_key, cache_file)) as pool:
+        futures = [pool.submit(backfill_window, window, link, key, out_dir, page_size) for window in windows]
+        #merge in date order as windows finish; the store has a single writer, this process
+        for future in futures:
+            status = future.result()
+            if status['rows']:
+                for column, value in store.append(read_window(out_dir, status)).items():
+                    counts[column] += value
+            state['merged'].append(status['name'])
+            write_json(state_file, state)
+            statuses.append(status)
+            print(status['name'], status['rows'], 'rows')
+
+    if any(status['rows'] for status in statuses):
+        if map_dir is not None:
+            MapArtifacts(bins, cube, map_dir).generate()
+        if service_url is not None:
+            notify_reload(service_url)
+        store.snapshot(dt.datetime.now().strftime("%m_%d_%Y")+'_backfill')
+
+    write_json(os.path.join(out_dir, 'report.json'), {'counts': counts, 'windows': statuses})
+    return {'windows': len(statuses), 'rows': sum(status['rows'] for status in statuses), **counts}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Backfill the crime master over a date range with a process pool')
+    parser.add_argument('start', help='first reported_date, e.g. 2015-01-01')
+    parser.add_argument('end', help='end of the range (exclusive), e.g. 2018-01-01')
+    parser.add_argument('--freq', default='MS', help='window size as a pandas frequency, default one month')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, default all cores')
+    parser.add_argument('--out-dir', default='backfill')
+    parser.add_argument('--store-dir', default='crime_store')
+    args = parser.parse_args()
+    print(backfill(args.start, args.end, args.freq, out_dir=args.out_dir, store_dir=args.store_dir,
+                   workers=args.workers))
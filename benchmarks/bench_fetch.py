@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+import signal
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crime_fetch import fetch_chunks, read_cursor
+from fake_socrata import FakeSocrataServer
+
+#Offline benchmarks for crime_fetch against the fake Socrata server;
+#throughput per paging mode/concurrency and resume after a killed fetch.
+#python benchmarks/bench_fetch.py --rows 100000 --latency 0.05
+
+def time_fetch(link, **fetch_args):
+    start = time.perf_counter()
+    n_rows = 0
+    for chunk in fetch_chunks(link, **fetch_args):
+        n_rows += len(chunk)
+    elapsed = time.perf_counter() - start
+    return n_rows, elapsed
+
+def bench_throughput(server, page_size, workers):
+    results = []
+    configs = [('keyset', 1)] + [('offset', n) for n in workers]
+    for mode, max_workers in configs:
+        n_rows, elapsed = time_fetch(server.link, page_size=page_size, mode=mode, max_workers=max_workers)
+        results.append({'mode': mode, 'max_workers': max_workers, 'rows': n_rows,
+                        'seconds': round(elapsed, 3), 'rows_per_second': round(n_rows / elapsed)})
+        print(mode, 'workers='+str(max_workers), n_rows, 'rows', round(elapsed, 2), 's',
+              round(n_rows / elapsed), 'rows/s')
+    return results
+
+child_script = """
+import sys
+sys.path.insert(0, {repo!r})
+from crime_fetch import fetch_chunks
+with open({out!r}, 'a') as out:
+    for chunk in fetch_chunks({link!r}, page_size={page_size}, mode={mode!r}, max_workers={workers},
+                              cursor_file={cursor!r}):
+        out.write('\\n'.join(chunk['casenumber']) + '\\n')
+        out.flush()
+"""
+
+def bench_resume(server, page_size, mode, workers, kill_after_pages=3):
+    """
+    Starts a fetch in a child process, SIGKILLs it once kill_after_pages pages have been
+    checkpointed, resumes in this process from the cursor and checks every row arrived
+    """
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    tmp = tempfile.mkdtemp()
+    out, cursor = os.path.join(tmp, 'rows.txt'), os.path.join(tmp, 'cursor.json')
+
+    script = child_script.format(repo=repo, out=out, link=server.link, page_size=page_size, mode=mode,
+                                 workers=workers, cursor=cursor)
+    child = subprocess.Popen([sys.executable, '-c', script])
+    while child.poll() is None:
+        saved = read_cursor(cursor)
+        if saved and (saved.get('offset', 0) >= kill_after_pages*page_size or mode == 'keyset'):
+            os.kill(child.pid, signal.SIGKILL)
+            break
+        time.sleep(0.005)
+    child.wait()
+    killed_at = read_cursor(cursor)
+
+    start = time.perf_counter()
+    with open(out, 'a') as f:
+        for chunk in fetch_chunks(server.link, page_size=page_size, mode=mode, max_workers=workers,
+                                  cursor_file=cursor):
+            f.write('\n'.join(chunk['casenumber']) + '\n')
+    resume_seconds = time.perf_counter() - start
+
+    with open(out) as f:
+        rows = f.read().split()
+    result = {'mode': mode, 'killed_at': killed_at, 'rows_written': len(rows), 'unique_rows': len(set(rows)),
+              'expected_rows': server.fake.n_rows, 'resume_seconds': round(resume_seconds, 3)}
+    print('resume', mode, result)
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark crime_fetch against a local fake Socrata server')
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds of simulated api latency per request')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    with FakeSocrataServer(n_rows=args.rows, latency=args.latency) as server:
+        bench_throughput(server, args.page_size, args.workers)
+        bench_resume(server, args.page_size, 'offset', max(args.workers))
+        bench_resume(server, args.page_size, 'keyset', 1)
@@ -0,0 +1,49 @@
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import do_geocode
+import async_geocode
+from stub_geocoder import StubGeocoderServer
+
+#Throughput and quota behaviour of the serial and async geocoders against the local stub.
+#python benchmarks/bench_geocode.py --addresses 500 --latency 0.05 --quota 50
+
+def run(name, function, addresses, server):
+    cache = do_geocode.GeocodeCache(':memory:', seed_file=None)
+    start = time.perf_counter()
+    df = function(addresses, cache)
+    seconds = time.perf_counter() - start
+    result = dict({'geocoder': name, 'addresses': len(addresses), 'found': len(df), 'seconds': round(seconds, 2),
+                   'addresses_per_second': round(len(addresses) / seconds, 1)}, **server.stub.stats())
+    print(result)
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark geocoding clients against a local stub geocoder')
+    parser.add_argument('--addresses', type=int, default=300)
+    parser.add_argument('--latency', type=float, default=0.05, help='stub response time in seconds')
+    parser.add_argument('--quota', type=int, default=50, help='stub requests per second before OVER_QUERY_LIMIT')
+    parser.add_argument('--error-rate', type=float, default=0.02, help='fraction of stub requests answered 503')
+    parser.add_argument('--in-flight', type=int, nargs='+', default=[4, 16])
+    args = parser.parse_args()
+
+    addresses = [str(i)+' Stub St' for i in range(args.addresses)] + ['1 Nowhere St']
+    stub_args = {'latency': args.latency, 'quota_qps': args.quota, 'error_rate': 0.0}
+
+    with StubGeocoderServer(**stub_args) as server:
+        run('serial', lambda a, c: do_geocode.geocode_addresses(a, 'stub', cache=c, link=server.link),
+            addresses, server)
+
+    for in_flight in args.in_flight:
+        #held just under the quota, and pushed over it to exercise backoff
+        for qps in [args.quota * 0.9, args.quota * 2]:
+            with StubGeocoderServer(latency=args.latency, quota_qps=args.quota, error_rate=args.error_rate) as server:
+                geocoder = async_geocode.AsyncGeocoder('stub', qps=qps, max_in_flight=in_flight, link=server.link,
+                                                       base_delay=0.1)
+                run('async in_flight='+str(in_flight)+' qps='+str(qps),
+                    lambda a, c: do_geocode.geocode_addresses(a, 'stub', cache=c, geocoder=geocoder), addresses, server)
+                print('  client', geocoder.stats())
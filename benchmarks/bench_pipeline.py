@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+
+from synthetic import generate_crime_columns, load_distributions, api_columns, repo_dir
+from fake_socrata import FakeSocrataServer
+from stub_geocoder import StubGeocoderServer
+
+#End to end benchmark of the create_crime_log stages on synthetic data, offline.
+#The fake Socrata server and the stub geocoder stand in for the city api and google.
+#Every size runs the same chunked pipeline and times each stage separately:
+#fetch, classify, parse dates, clean location, geocode join, master merge (with the rollups).
+#Results go to benchmarks/results/<size>_<commit>.json (local, not committed; run the baseline
+#on the commit to compare against) and are compared with the previous results for the same size.
+#
+#python benchmarks/bench_pipeline.py --rows 10000 1000000
+#python benchmarks/bench_pipeline.py --rows 10000000 --no-fetch   (rows generated in process)
+
+results_dir = os.path.join(repo_dir, 'benchmarks', 'results')
+stages = ['fetch', 'classify', 'parse_dates', 'clean_location', 'geocode', 'merge']
+
+def ensure_config(api_link):
+    #pvd_crime reads its default links from config.py, which holds private keys and is not in
+    #the repo; without one the benchmark points the defaults at the local stubs
+    try:
+        import config
+    except ImportError:
+        config = types.ModuleType('config')
+        config.api_link, config.api_key, config.google_key = api_link, None, 'stub'
+        sys.modules['config'] = config
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def peak_rss_mb():
+    #ru_maxrss is kilobytes on linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def generated_chunks(columns, chunk_size):
+    for start in range(0, len(columns['reported_date']), chunk_size):
+        yield pd.DataFrame({column: values[start:start+chunk_size] for column, values in columns.items()},
+                           columns=api_columns)
+
+class Timer(object):
+    #accumulates wall time and rows per stage
+    def __init__(self):
+        self.seconds = dict.fromkeys(stages, 0.0)
+        self.rows = dict.fromkeys(stages, 0)
+
+    def call(self, name, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.seconds[name] += time.perf_counter() - start
+        return result
+
+    def timed_iter(self, name, chunks):
+        chunks = iter(chunks)
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                self.seconds[name] += time.perf_counter() - start
+                return
+            self.seconds[name] += time.perf_counter() - start
+            self.rows[name] += len(chunk)
+            yield chunk
+
+    def report(self):
+        return {name: {'seconds': round(self.seconds[name], 3), 'rows': self.rows[name],
+                       'rows_per_second': round(self.rows[name] / self.seconds[name]) if self.seconds[name] else None}
+                for name in stages if self.rows[name]}
+
+def run_size(n_rows, chunk_size, fetch, latency, new_locations, google, distributions, workdir):
+    columns = generate_crime_columns(n_rows, seed=n_rows, distributions=distributions, new_locations=new_locations)
+    import pvd_crime
+    from crime_fetch import fetch_chunks
+    from master_store import MasterStore
+    from rollups import RollupCube
+    from spatial_bins import SpatialBins
+    from do_geocode import GeocodeCache
+    from async_geocode import AsyncGeocoder
+
+    timer = Timer()
+    store_dir = os.path.join(workdir, 'store_'+str(n_rows))
+    store = MasterStore(store_dir)
+    RollupCube(store)
+    SpatialBins(store)
+    chain = pvd_crime.geocoder_chain('stub', cache=GeocodeCache(':memory:'), nominatim_link=None,
+                                     geocoder=AsyncGeocoder('stub', qps=2000, max_in_flight=32, link=google.link))
+    neighborhoods = pvd_crime.NeighborhoodAssigner()
+
+    server = None
+    if fetch:
+        server = FakeSocrataServer(columns=columns, latency=latency)
+        server.__enter__()
+        source = fetch_chunks(server.link, page_size=chunk_size, max_workers=4)
+    else:
+        source = generated_chunks(columns, chunk_size)
+
+    start = time.perf_counter()
+    try:
+        for chunk in timer.timed_iter('fetch', source):
+            for name, function in [('classify', pvd_crime.classify_crime), ('parse_dates', pvd_crime.parse_dates),
+                                   ('clean_location', pvd_crime.clean_location)]:
+                chunk = timer.call(name, function, chunk)
+                timer.rows[name] += len(chunk)
+            chunk = timer.call('geocode', pvd_crime.get_lat_lon, chunk, 'stub', chain=chain, neighborhoods=neighborhoods)
+            timer.rows['geocode'] += len(chunk)
+            timer.call('merge', store.append, chunk)
+            timer.rows['merge'] += len(chunk)
+    finally:
+        if server is not None:
+            server.__exit__()
+    total = time.perf_counter() - start
+
+    result = {'rows': n_rows, 'chunk_size': chunk_size, 'fetch': 'fake_socrata' if fetch else 'generated',
+              'new_locations': new_locations, 'total_seconds': round(total, 3), 'peak_rss_mb': peak_rss_mb(),
+              'stages': timer.report(), 'geocoder': chain.stats(), 'store_rows': len(store)}
+    shutil.rmtree(store_dir, ignore_errors=True)
+    return result
+
+def previous_result(n_rows, commit):
+    #newest saved result for this size from another commit
+    if not os.path.isdir(results_dir):
+        return None
+    names = [name for name in os.listdir(results_dir)
+             if name.startswith(str(n_rows)+'_') and not name.endswith('_'+commit+'.json')]
+    if not names:
+        return None
+    newest = max(names, key=lambda name: os.path.getmtime(os.path.join(results_dir, name)))
+    with open(os.path.join(results_dir, newest)) as f:
+        return json.load(f)
+
+def compare(result, previous):
+    for name, stage in result['stages'].items():
+        before = previous['stages'].get(name)
+        if before and before['rows_per_second'] and stage['rows_per_second']:
+            change = stage['rows_per_second'] / before['rows_per_second'] - 1
+            print('  {:<15}{:>12} rows/s  {:+.0%} vs {}'.format(name, stage['rows_per_second'], change,
+                                                               previous['commit']))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark every create_crime_log stage on synthetic data')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000], help='sizes to run, e.g. 10000 1000000 10000000')
+    parser.add_argument('--chunk-size', type=int, default=50000)
+    parser.add_argument('--no-fetch', dest='fetch', action='store_false',
+                        help='generate chunks in process instead of fetching them from the fake Socrata server')
+    parser.add_argument('--latency', type=float, default=0.0, help='fake Socrata seconds per request')
+    parser.add_argument('--new-locations', type=float, default=0.02,
+                        help='fraction of rows with addresses the master never saw')
+    parser.add_argument('--google-latency', type=float, default=0.005, help='stub geocoder seconds per request')
+    args = parser.parse_args()
+
+    commit = git_commit()
+    os.makedirs(results_dir, exist_ok=True)
+    distributions = load_distributions()
+    workdir = tempfile.mkdtemp()
+    os.chdir(repo_dir)
+    with StubGeocoderServer(latency=args.google_latency, quota_qps=None) as google:
+        ensure_config('http://127.0.0.1:1/resource/crime.json')
+        for n_rows in args.rows:
+            result = run_size(n_rows, args.chunk_size, args.fetch, args.latency, args.new_locations, google,
+                              distributions, workdir)
+            result.update({'commit': commit, 'date': pd.Timestamp.now().isoformat(),
+                           'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__})
+            with open(os.path.join(results_dir, str(n_rows)+'_'+commit+'.json'), 'w') as f:
+                json.dump(result, f, indent=1)
+            print(n_rows, 'rows', result['total_seconds'], 's, peak rss', result['peak_rss_mb'], 'MB')
+            for name, stage in result['stages'].items():
+                print('  {:<15}{:>10.3f} s {:>12} rows/s'.format(name, stage['seconds'], stage['rows_per_second']))
+            previous = previous_result(n_rows, commit)
+            if previous is not None:
+                compare(result, previous)
+    shutil.rmtree(workdir, ignore_errors=True)
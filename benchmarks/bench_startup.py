@@ -0,0 +1,89 @@
+import os
+import re
+import sys
+import json
+import argparse
+import platform
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import repo_dir
+from bench_pipeline import git_commit, results_dir
+
+#Cold start benchmark of the command line entry point.
+#Every case runs in a fresh interpreter: cli.py --help, and for each subcommand importing cli.py
+#plus the modules the subcommand loads (cli.load), which is what the subcommand pays before it
+#does any work. The eager import of pvd_crime is timed as well for comparison. Wall times are the
+#median of --runs runs; python -X importtime gives the slowest imports of each case.
+#Results go to benchmarks/results/startup_<commit>.json and are compared with the previous result.
+#
+#python benchmarks/bench_startup.py --runs 10
+
+importtime_line = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+def cases():
+    import cli
+    commands = {'--help': [os.path.join(repo_dir, 'cli.py'), '--help']}
+    for command in cli.command_modules:
+        commands[command] = ['-c', 'import cli; cli.load('+repr(command)+')']
+    commands['import pvd_crime'] = ['-c', 'import pvd_crime']
+    return commands
+
+def wall_time(args, runs):
+    #perf_counter in the child would miss interpreter startup, so time the whole process
+    times = []
+    for i in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', 'import time, subprocess, sys; start = time.perf_counter(); '
+                                       'subprocess.check_call([sys.executable] + sys.argv[1:], '
+                                       'stdout=subprocess.DEVNULL); print(time.perf_counter() - start)'] + args,
+                                      cwd=repo_dir)
+        times.append(float(out))
+    return statistics.median(times)
+
+def slowest_imports(args, top=5):
+    #top level imports by cumulative microseconds
+    err = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=repo_dir, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE).stderr.decode()
+    imports = {}
+    for line in err.splitlines():
+        match = importtime_line.match(line)
+        if match and len(match.group(3)) == 1:
+            imports[match.group(4)] = int(match.group(2))
+    modules = len([line for line in err.splitlines() if importtime_line.match(line)])
+    slowest = sorted(imports.items(), key=lambda item: -item[1])[:top]
+    return modules, {name: round(us / 1000, 1) for name, us in slowest}
+
+def previous_result(commit):
+    names = [name for name in os.listdir(results_dir)
+             if name.startswith('startup_') and not name.endswith('_'+commit+'.json')] \
+        if os.path.isdir(results_dir) else []
+    if not names:
+        return None
+    newest = max(names, key=lambda name: os.path.getmtime(os.path.join(results_dir, name)))
+    with open(os.path.join(results_dir, newest)) as f:
+        return json.load(f)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the cold start of every cli.py subcommand')
+    parser.add_argument('--runs', type=int, default=5, help='runs per case, the median is reported')
+    args = parser.parse_args()
+
+    commit = git_commit()
+    result = {'commit': commit, 'python': platform.python_version(), 'runs': args.runs, 'cases': {}}
+    for name, case in cases().items():
+        modules, slowest = slowest_imports(case)
+        result['cases'][name] = {'seconds': round(wall_time(case, args.runs), 4), 'modules': modules,
+                                 'slowest_imports_ms': slowest}
+
+    os.makedirs(results_dir, exist_ok=True)
+    with open(os.path.join(results_dir, 'startup_'+commit+'.json'), 'w') as f:
+        json.dump(result, f, indent=1)
+    previous = previous_result(commit)
+    for name, case in result['cases'].items():
+        line = '{:<18}{:>8.3f} s {:>5} modules'.format(name, case['seconds'], case['modules'])
+        before = previous['cases'].get(name) if previous is not None else None
+        if before:
+            line += '  {:+.0%} vs {}'.format(case['seconds'] / before['seconds'] - 1, previous['commit'])
+        print(line)
@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+import argparse
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transforms import classify_offenses, parse_reported_dates, add_hour_minute_day, violent_crime, property_crime
+
+#Throughput of the vectorized transforms against the original per row versions
+#on the master and on a large synthetic frame built by tiling the master.
+#python benchmarks/bench_transforms.py --rows 10000000
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def classify_per_row(df):
+    #pvd_crime.classify_crime before vectorizing
+    def helper(crime):
+        if crime in violent_crime:
+            return 'violent_crime'
+        elif crime in property_crime:
+            return 'property_crime'
+        else:
+            return 'other_crime'
+    return df['offense_desc'].apply(helper)
+
+def parse_per_row(df):
+    #pvd_crime.parse_dates before vectorizing
+    return df['reported_date'].apply(dt.datetime.strptime, args=("%Y-%m-%dT%H:%M:%S.%f",))
+
+def hour_minute_day_per_row(df):
+    #crime_gac.create_hour_minute_day
+    dates = df['reported_date']
+    return [i.hour for i in dates], [i.minute for i in dates], [i.day for i in dates]
+
+def api_frame(n_rows=None):
+    """
+    The master's offense_desc, reported_date (in api format), counts, month and year,
+    tiled to n_rows if given
+    """
+    master = pd.read_csv(os.path.join(repo_dir, 'pvd_crime_master.csv'),
+                         usecols=['offense_desc', 'reported_date', 'counts', 'month', 'year'])
+    master['reported_date'] = pd.to_datetime(master['reported_date']).dt.strftime('%Y-%m-%dT%H:%M:%S.000')
+    if n_rows is None:
+        return master
+    return pd.DataFrame({column: np.resize(master[column].values, n_rows) for column in master})
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def bench(df, baseline=True):
+    results = {}
+    stages = [('classify', lambda d: classify_offenses(d['offense_desc']), classify_per_row),
+              ('parse_dates', lambda d: parse_reported_dates(d['reported_date']), parse_per_row)]
+    for name, vectorized, per_row in stages:
+        result, seconds = timed(vectorized, df)
+        results[name] = {'vectorized_rows_per_second': round(len(df) / seconds)}
+        if baseline:
+            expected, baseline_seconds = timed(per_row, df)
+            assert (np.asarray(result) == np.asarray(expected)).all()
+            results[name]['per_row_rows_per_second'] = round(len(df) / baseline_seconds)
+            results[name]['speedup'] = round(baseline_seconds / seconds, 1)
+
+    parsed = df.assign(reported_date=parse_reported_dates(df['reported_date']))
+    result, seconds = timed(add_hour_minute_day, parsed)
+    results['hour_minute_day'] = {'vectorized_rows_per_second': round(len(df) / seconds)}
+    if baseline:
+        expected, baseline_seconds = timed(hour_minute_day_per_row, parsed)
+        assert (result['hour'].values == expected[0]).all()
+        results['hour_minute_day']['per_row_rows_per_second'] = round(len(df) / baseline_seconds)
+        results['hour_minute_day']['speedup'] = round(baseline_seconds / seconds, 1)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the vectorized crime log transforms')
+    parser.add_argument('--rows', type=int, default=10000000, help='rows in the synthetic frame')
+    parser.add_argument('--max-baseline-rows', type=int, default=1000000,
+                        help='skip the slow per row baseline above this many rows')
+    args = parser.parse_args()
+
+    master = api_frame()
+    print('master', len(master), 'rows', bench(master))
+    synthetic = api_frame(args.rows)
+    print('synthetic', len(synthetic), 'rows', bench(synthetic, baseline=len(synthetic) <= args.max_baseline_rows))
@@ -0,0 +1,140 @@
+import re
+import sys
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from synthetic import generate_crime_columns, api_columns
+
+#Local stand in for the Socrata crime log endpoint.
+#Understands the subset of SoQL that crime_fetch sends: $select, $where on reported_date and :id,
+#$order by reported_date, :id, $limit and $offset. Rows are held as sorted numpy arrays so a page
+#lookup is a binary search, and the server is never the bottleneck in a fetch benchmark.
+
+date_gt = re.compile(r"^reported_date > '([^']+)'$")
+date_le = re.compile(r"^reported_date <= '([^']+)'$")
+keyset = re.compile(r"^\(reported_date > '([^']+)' OR \(reported_date = '([^']+)' AND :id > '([^']+)'\)\)$")
+
+class FakeSocrata(object):
+    """
+    Holds the synthetic rows and answers page queries
+
+    n_rows: number of rows served
+    latency: seconds each request sleeps before answering, to mimic the real api's round trip
+    columns: pre-generated columns (see synthetic.generate_crime_columns), generated if None
+    """
+    def __init__(self, n_rows=10000, latency=0.0, columns=None, seed=0):
+        if columns is None:
+            columns = generate_crime_columns(n_rows, seed=seed)
+        self.columns = columns
+        self.n_rows = len(columns['reported_date'])
+        self.ids = np.array(['row-'+str(i).zfill(10) for i in range(self.n_rows)])
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def row_range(self, where):
+        #translate the where clause into a [start, stop) slice of the sorted rows
+        dates = self.columns['reported_date']
+        start, stop = 0, self.n_rows
+        if not where:
+            return start, stop
+        for clause in re.split(r" AND (?=reported_date|\()", where):
+            clause = clause.strip()
+            match = keyset.match(clause)
+            if match:
+                since, since_eq, last_id = match.groups()
+                first = np.searchsorted(dates, since, side='left')
+                after = np.searchsorted(dates, since, side='right')
+                tied = first + np.searchsorted(self.ids[first:after], last_id, side='right')
+                start = max(start, tied)
+                continue
+            match = date_gt.match(clause)
+            if match:
+                start = max(start, np.searchsorted(dates, match.group(1), side='right'))
+                continue
+            match = date_le.match(clause)
+            if match:
+                stop = min(stop, np.searchsorted(dates, match.group(1), side='right'))
+                continue
+            raise ValueError('unsupported $where clause: '+clause)
+        return start, stop
+
+    def page(self, params):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        start, stop = self.row_range(params.get('$where'))
+        offset = int(params.get('$offset', 0))
+        limit = int(params.get('$limit', 1000))
+        start = min(start + offset, stop)
+        stop = min(start + limit, stop)
+
+        select_id = ':id' in params.get('$select', '')
+        rows = []
+        for i in range(start, stop):
+            row = {column: self.columns[column][i] for column in api_columns}
+            if select_id:
+                row[':id'] = self.ids[i]
+            rows.append(row)
+        return rows
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+            try:
+                body = json.dumps(fake.page(params)).encode()
+                status = 200
+            except ValueError as e:
+                body = json.dumps({'error': True, 'message': str(e)}).encode()
+                status = 400
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                #client was killed mid request, which the resume benchmark does on purpose
+                pass
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+class FakeSocrataServer(object):
+    """
+    Runs a FakeSocrata on a local port in a background thread. Use as a context manager;
+    the api link to pass to crime_fetch is in .link
+    """
+    def __init__(self, port=0, **fake_args):
+        self.fake = FakeSocrata(**fake_args)
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(self.fake))
+        self.server.daemon_threads = True
+        self.link = 'http://127.0.0.1:'+str(self.server.server_address[1])+'/resource/crime.json'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == "__main__":
+    #python fake_socrata.py [n_rows] [port]
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+    with FakeSocrataServer(port=port, n_rows=n_rows) as server:
+        print(server.link)
+        server.thread.join()
@@ -0,0 +1,155 @@
+import sys
+import json
+import time
+import random
+import hashlib
+import threading
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+#Local stand in for the google geocoding endpoint.
+#Answers with a deterministic point inside Providence for every address, ZERO_RESULTS for
+#addresses containing "Nowhere", OVER_QUERY_LIMIT when more than quota_qps requests arrive
+#within one second and random 503s at error_rate, after sleeping latency seconds.
+#Requests to a path ending in /search get a Nominatim style answer instead, found for about
+#half of the addresses and never rate limited.
+
+class StubGeocoder(object):
+    def __init__(self, latency=0.05, quota_qps=50, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.quota_qps = quota_qps
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.recent = collections.deque()
+        self.requests = 0
+        self.nominatim_requests = 0
+        self.quota_errors = 0
+        self.server_errors = 0
+        self.max_concurrent = 0
+        self.concurrent = 0
+
+    def over_quota(self):
+        now = time.monotonic()
+        with self.lock:
+            self.requests += 1
+            while self.recent and now - self.recent[0] > 1.0:
+                self.recent.popleft()
+            if self.quota_qps is not None and len(self.recent) >= self.quota_qps:
+                self.quota_errors += 1
+                return True
+            self.recent.append(now)
+            return False
+
+    def answer(self, address):
+        """
+        returns (http status, json body) for one request
+        """
+        with self.lock:
+            self.concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self.concurrent)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            if self.over_quota():
+                return 200, {'status': 'OVER_QUERY_LIMIT', 'results': []}
+            with self.lock:
+                failed = self.random.random() < self.error_rate
+                if failed:
+                    self.server_errors += 1
+            if failed:
+                return 503, {'status': 'UNKNOWN_ERROR'}
+            if 'Nowhere' in address:
+                return 200, {'status': 'ZERO_RESULTS', 'results': []}
+
+            digest = hashlib.md5(address.encode()).digest()
+            lat = 41.77 + digest[0] / 255 * 0.09
+            lon = -71.47 + digest[1] / 255 * 0.10
+            result = {'geometry': {'location': {'lat': lat, 'lng': lon}},
+                      'address_components': [{'long_name': 'Stub Hood', 'types': ['neighborhood', 'political']},
+                                             {'long_name': 'Providence', 'types': ['locality', 'political']}]}
+            return 200, {'status': 'OK', 'results': [result]}
+        finally:
+            with self.lock:
+                self.concurrent -= 1
+
+    def answer_nominatim(self, query):
+        """
+        returns (http status, json list of places) for one Nominatim /search request
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.nominatim_requests += 1
+        digest = hashlib.md5(query.split(',')[0].replace('+', ' ').encode()).digest()
+        if 'Nowhere' in query or digest[2] % 2:
+            return 200, []
+        lat = 41.77 + digest[0] / 255 * 0.09
+        lon = -71.47 + digest[1] / 255 * 0.10
+        return 200, [{'lat': str(lat), 'lon': str(lon),
+                      'address': {'neighbourhood': 'Stub Hood', 'city': 'Providence'}}]
+
+    def stats(self):
+        return {'requests': self.requests, 'nominatim_requests': self.nominatim_requests, 'quota_errors': self.quota_errors, 'server_errors': self.server_errors,
+                'max_concurrent': self.max_concurrent}
+
+def make_handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if url.path.endswith('/search'):
+                status, body = stub.answer_nominatim(params.get('q', ''))
+            else:
+                status, body = stub.answer(params.get('address', ''))
+            body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+class QuietServer(ThreadingHTTPServer):
+    #clients closing pooled keep-alive connections reset them mid read; not worth a traceback
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionResetError):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+class StubGeocoderServer(object):
+    """
+    Runs a StubGeocoder on a local port in a background thread; use as a context manager,
+    the endpoints to geocode against are in .link (google) and .nominatim_link
+    """
+    def __init__(self, port=0, **stub_args):
+        self.stub = StubGeocoder(**stub_args)
+        self.server = QuietServer(('127.0.0.1', port), make_handler(self.stub))
+        self.server.daemon_threads = True
+        self.link = 'http://127.0.0.1:'+str(self.server.server_address[1])+'/maps/api/geocode/json'
+        self.nominatim_link = 'http://127.0.0.1:'+str(self.server.server_address[1])+'/search'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == "__main__":
+    #python stub_geocoder.py [port]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    with StubGeocoderServer(port=port) as server:
+        print(server.link)
+        print(server.nominatim_link)
+        server.thread.join()
@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+#Synthetic Providence crime log data for benchmarks.
+#Values are sampled from the distributions in the master file so the generated rows
+#look like the api's json (string fields, reported_date in the api format).
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+api_columns = ['casenumber', 'counts', 'location', 'month', 'offense_desc', 'reported_date',
+               'reporting_officer', 'statute_code', 'statute_desc', 'year']
+
+def load_distributions(master_file=os.path.join(repo_dir, 'pvd_crime_master.csv')):
+    """
+    Reads the master file and returns the value/frequency tables the generator samples from
+    """
+    master = pd.read_csv(master_file, usecols=['counts', 'location', 'offense_desc', 'reporting_officer',
+                                               'statute_code', 'statute_desc'])
+    offenses = master.groupby(['offense_desc', 'statute_code', 'statute_desc']).size()
+    counts = master['counts'].value_counts()
+    officers = master['reporting_officer'].dropna().value_counts()
+    locations = master['location'].dropna().value_counts()
+
+    return {'offenses': (offenses.index.to_frame(index=False), offenses.values / offenses.values.sum()),
+            'counts': (counts.index.values, counts.values / counts.values.sum()),
+            'officers': (officers.index.values, officers.values / officers.values.sum()),
+            'locations': (locations.index.values, locations.values / locations.values.sum())}
+
+def new_addresses(n, locations, rng):
+    """
+    Makes n "NUMBER STREET" addresses from the streets of known locations with random house
+    numbers, so a large generated log has addresses the master (and the geocode cache) never saw
+    """
+    streets = pd.Series(locations).str.extract(r'^\d+\S*\s+(.+)$', expand=False).dropna().unique()
+    numbers = rng.integers(1, 400, n).astype(str)
+    return np.char.add(np.char.add(numbers, ' '), rng.choice(streets, n).astype(str)).astype(object)
+
+def generate_crime_columns(n_rows, start='2017-01-01', rows_per_day=40, seed=0, distributions=None,
+                           new_locations=0.0):
+    """
+    Generates n_rows of crime log rows sorted by reported_date
+
+    n_rows: number of rows
+    start: reported_date of the first row
+    rows_per_day: average number of rows reported per day, sets how far the dates span
+    seed: random seed, the same seed always returns the same rows
+    new_locations: fraction of rows whose location is a new address rather than one from the master
+
+    returns dict of column name to numpy array of strings, in api format
+    """
+    if distributions is None:
+        distributions = load_distributions()
+    rng = np.random.default_rng(seed)
+
+    #evenly spread reports with random gaps, kept to whole minutes like the api
+    minutes_per_row = 24*60 / rows_per_day
+    gaps = rng.exponential(minutes_per_row, n_rows).round().astype('int64')
+    dates = pd.Timestamp(start) + pd.to_timedelta(np.cumsum(gaps), unit='m')
+
+    offense_table, offense_p = distributions['offenses']
+    offense_rows = rng.choice(len(offense_table), n_rows, p=offense_p)
+    counts, counts_p = distributions['counts']
+    officers, officers_p = distributions['officers']
+    locations, locations_p = distributions['locations']
+
+    location_values = rng.choice(locations, n_rows, p=locations_p)
+    if new_locations:
+        new = rng.random(n_rows) < new_locations
+        location_values[new] = new_addresses(int(new.sum()), locations, rng)
+
+    years = dates.year.values
+    case_numbers = pd.Series(years.astype(str)) + '-' + pd.Series(np.arange(n_rows) % 10**8).astype(str).str.zfill(8)
+
+    return {'casenumber': case_numbers.values,
+            'counts': rng.choice(counts, n_rows, p=counts_p).astype(str),
+            'location': location_values,
+            'month': dates.month.values.astype(str),
+            'offense_desc': offense_table['offense_desc'].values[offense_rows],
+            'reported_date': dates.strftime('%Y-%m-%dT%H:%M:%S.000').values,
+            'reporting_officer': rng.choice(officers, n_rows, p=officers_p),
+            'statute_code': offense_table['statute_code'].values[offense_rows],
+            'statute_desc': offense_table['statute_desc'].values[offense_rows],
+            'year': years.astype(str)}
+
+def generate_crime_df(n_rows, **kwargs):
+    """
+    Same as generate_crime_columns, returned as a DataFrame like pvd_crime.create_df
+    """
+    return pd.DataFrame(generate_crime_columns(n_rows, **kwargs), columns=api_columns)
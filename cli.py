@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+import argparse
+import importlib
+import datetime as dt
+
+#Command line entry point for the crime log pipeline.
+#python cli.py fetch | ingest | backfill | export | stats
+#Only the standard library is imported up front. Each subcommand imports the module it runs
+#from (and with it pandas, numpy, requests and config.py) when it runs, so --help and stats
+#start in milliseconds; benchmarks/bench_startup.py tracks the cold start of every subcommand.
+
+#module each subcommand runs from, imported by load() only when the subcommand runs
+command_modules = {'fetch': 'pvd_crime', 'ingest': 'pvd_crime', 'watch': 'ingest_daemon', 'backfill': 'backfill',
+                   'export': 'master_store', 'stats': None}
+
+def load(command):
+    """
+    Imports the module of a subcommand; returns it, or None for subcommands that only need the
+    standard library
+    """
+    name = command_modules[command]
+    return None if name is None else importlib.import_module(name)
+
+def fetch(args):
+    pvd_crime = load('fetch')
+    today = dt.datetime.now().strftime("%m_%d_%Y")
+    out = args.out or 'crime_log_runs/'+today+'raw_crime_log.csv'
+    df = pvd_crime.create_df(store_dir=args.store_dir, page_size=args.page_size, mode=args.mode)
+    df.to_csv(out, index=False)
+    print(len(df), 'rows written to', out)
+
+def ingest(args):
+    if args.watch:
+        ingest_daemon = load('watch')
+        #the daemon always pages by keyset, see ingest_daemon.IngestDaemon.fetch
+        paging = {} if args.page_size is None else {'page_size': args.page_size}
+        daemon = ingest_daemon.IngestDaemon(store_dir=args.store_dir, min_interval=args.min_interval,
+                                            max_interval=args.max_interval, **paging)
+        print(daemon.run())
+    else:
+        pvd_crime = load('ingest')
+        pvd_crime.create_crime_log(store_dir=args.store_dir, only_create_csv=True, export_csv=args.export_csv,
+                                   chunk_size=args.chunk_size, profile=args.profile, page_size=args.page_size,
+                                   mode=args.mode)
+
+def backfill(args):
+    module = load('backfill')
+    print(module.backfill(args.start, args.end, args.freq, out_dir=args.out_dir, store_dir=args.store_dir,
+                          workers=args.workers))
+
+def export(args):
+    master_store = load('export')
+    master_store.MasterStore(args.store_dir).export_csv(args.out, args.snapshot)
+    print('wrote', args.out)
+
+def store_stats(store_dir='crime_store'):
+    """
+    Summary of a master store read straight from its manifest, without loading any rows
+
+    returns dict with rows, partition files, months, last ingest, newest reported_date, format,
+    location table version and snapshots
+    """
+    with open(os.path.join(store_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    snapshot_dir = os.path.join(store_dir, 'snapshots')
+    snapshots = sorted(name[:-len('_manifest.json')] for name in os.listdir(snapshot_dir)
+                       if name.endswith('_manifest.json')) if os.path.isdir(snapshot_dir) else []
+    months = sorted(set(entry['month'] for entry in manifest['files']))
+    return {'rows': sum(entry['rows'] for entry in manifest['files']), 'files': len(manifest['files']),
+            'months': len(months), 'first_month': months[0] if months else None,
+            'last_month': months[-1] if months else None, 'ingest': manifest.get('ingest', 0),
+            'max_reported_date': manifest['max_reported_date'], 'format': manifest.get('format', 'csv'),
+            'locations': manifest.get('locations'), 'snapshots': len(snapshots),
+            'last_snapshot': snapshots[-1] if snapshots else None}
+
+def stats(args):
+    if not os.path.exists(os.path.join(args.store_dir, 'manifest.json')):
+        sys.exit('no master store in '+args.store_dir+', run ingest first')
+    summary = store_stats(args.store_dir)
+    #the non offense rows (counts == 0) are a store of their own under the offense store
+    non_offense_dir = os.path.join(args.store_dir, 'non_offense')
+    if os.path.exists(os.path.join(non_offense_dir, 'manifest.json')):
+        summary['non_offenses'] = store_stats(non_offense_dir)
+    if os.path.exists(args.state_file):
+        with open(args.state_file) as f:
+            summary['daemon'] = json.load(f)
+    if args.json:
+        print(json.dumps(summary, indent=1))
+    else:
+        for name, value in summary.items():
+            print('{:<20}{}'.format(name, value))
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='cli.py', description='Providence crime log pipeline')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+    #options every subcommand takes
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--store-dir', default='crime_store', help='master store directory')
+
+    command = commands.add_parser('fetch', parents=[common],
+                                  help='fetch the rows newer than the master store to a csv, as the api returns them')
+    command.add_argument('--out', default=None, help='csv to write, default crime_log_runs/<date>raw_crime_log.csv')
+    command.add_argument('--page-size', type=int, default=5000)
+    command.add_argument('--mode', choices=['offset', 'keyset'], default='offset', help='api paging, see crime_fetch')
+    command.set_defaults(run=fetch)
+
+    command = commands.add_parser('ingest', parents=[common],
+                                  help='fetch, clean and geocode new rows and add them to the master store')
+    command.add_argument('--chunk-size', type=int, default=None,
+                         help='process the crime log in chunks of this many rows to bound memory')
+    command.add_argument('--profile', action='store_true',
+                         help='run under cProfile and tracemalloc, results go in the run report')
+    command.add_argument('--export-csv', action='store_true', help='also rewrite pvd_crime_master.csv')
+    command.add_argument('--page-size', type=int, default=None,
+                         help='rows per api page, default 5000 or --chunk-size (1000 with --watch)')
+    command.add_argument('--mode', choices=['offset', 'keyset'], default='offset',
+                         help='api paging, see crime_fetch; --watch always pages by keyset')
+    command.add_argument('--watch', action='store_true', help='keep polling for new rows, see ingest_daemon')
+    command.add_argument('--min-interval', type=float, default=30, help='with --watch, shortest wait between polls')
+    command.add_argument('--max-interval', type=float, default=1800, help='with --watch, longest wait between polls')
+    command.set_defaults(run=ingest)
+
+    command = commands.add_parser('backfill', parents=[common],
+                                  help='backfill a date range with a process pool, see backfill.py')
+    command.add_argument('start', help='first reported_date, e.g. 2015-01-01')
+    command.add_argument('end', help='end of the range (exclusive), e.g. 2018-01-01')
+    command.add_argument('--freq', default='MS', help='window size as a pandas frequency, default one month')
+    command.add_argument('--workers', type=int, default=None, help='worker processes, default all cores')
+    command.add_argument('--out-dir', default='backfill')
+    command.set_defaults(run=backfill)
+
+    command = commands.add_parser('export', parents=[common],
+                                  help='write the master store (or a snapshot of it) as one csv')
+    command.add_argument('--out', default='pvd_crime_master.csv')
+    command.add_argument('--snapshot', default=None, help='snapshot name, e.g. 04_08_2018')
+    command.set_defaults(run=export)
+
+    command = commands.add_parser('stats', parents=[common],
+                                  help='summarize the master store and its non offense store from their manifests')
+    command.add_argument('--state-file', default='crime_log_runs/daemon_state.json',
+                         help='ingest daemon checkpoint, shown when present')
+    command.add_argument('--json', action='store_true')
+    command.set_defaults(run=stats)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
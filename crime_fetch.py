@@ -0,0 +1,188 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import pandas as pd
+
+#Paging fetch engine for the Socrata crime log api.
+#Pages are requested with $limit/$offset (concurrent) or keyset paging on reported_date (serial),
+#a resume cursor is saved after every page and rows come back as a stream of DataFrame chunks.
+
+date_format = '%Y-%m-%dT%H:%M:%S.000'
+
+def create_session(key=None, pool_size=8):
+    """
+    Creates a requests Session with a connection pool large enough for
+    pool_size concurrent page requests
+
+    key: user key for api, sent with every request
+    pool_size: number of pooled connections to keep open
+
+    returns: requests.Session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if key is not None:
+        session.headers.update({'Authentication': key})
+    return session
+
+def read_cursor(cursor_file):
+    """
+    Returns the saved resume cursor as a dict, or None if there is no cursor to resume from
+    """
+    if cursor_file is None or not os.path.exists(cursor_file):
+        return None
+    with open(cursor_file) as f:
+        return json.load(f)
+
+def save_cursor(cursor_file, cursor):
+    """
+    Writes the resume cursor; written to a temp file first so a killed run never leaves half a cursor
+    """
+    if cursor_file is None:
+        return
+    tmp_file = cursor_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(cursor, f)
+    os.replace(tmp_file, cursor_file)
+
+def clear_cursor(cursor_file):
+    if cursor_file is not None and os.path.exists(cursor_file):
+        os.remove(cursor_file)
+
+def format_since(since):
+    """
+    Takes a datetime-like or string watermark and returns it in the api's reported_date format
+    """
+    if since is None:
+        return None
+    return pd.Timestamp(since).strftime(date_format)
+
+def fetch_page(session, link, params, timeout=60):
+    """
+    Requests one page from the api and returns it as a list of dictionaries
+    """
+    response = session.get(link, params=params, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+def offset_params(since, limit, offset, until=None):
+    params = {'$order': 'reported_date, :id', '$limit': limit, '$offset': offset}
+    where = []
+    if since is not None:
+        where.append("reported_date > '"+since+"'")
+    if until is not None:
+        where.append("reported_date <= '"+until+"'")
+    if where:
+        params['$where'] = ' AND '.join(where)
+    return params
+
+def keyset_params(since, last_id, limit, until=None):
+    #rows sharing the last page's reported_date are picked up by the :id tie breaker
+    params = {'$select': '*, :id', '$order': 'reported_date, :id', '$limit': limit}
+    where = []
+    if since is not None:
+        if last_id is None:
+            where.append("reported_date > '"+since+"'")
+        else:
+            where.append("(reported_date > '"+since+"' OR (reported_date = '"+since+"' AND :id > '"+last_id+"'))")
+    if until is not None:
+        where.append("reported_date <= '"+until+"'")
+    if where:
+        params['$where'] = ' AND '.join(where)
+    return params
+
+def fetch_offset_pages(session, link, since, page_size, max_workers, cursor_file, until=None):
+    """
+    Generator of pages using $limit/$offset paging. Keeps at most max_workers page
+    requests in flight and yields pages in order.
+    """
+    cursor = read_cursor(cursor_file)
+    if cursor and cursor.get('mode') == 'offset' and cursor.get('since') == since and cursor.get('until') == until:
+        next_offset = cursor['offset']
+    else:
+        next_offset = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        in_flight = []
+        submit_offset = next_offset
+        done = False
+        while not done:
+            #keep the window full
+            while len(in_flight) < max_workers:
+                params = offset_params(since, page_size, submit_offset, until)
+                in_flight.append(pool.submit(fetch_page, session, link, params))
+                submit_offset += page_size
+
+            rows = in_flight.pop(0).result()
+            if len(rows) < page_size:
+                done = True
+                for future in in_flight:
+                    future.cancel()
+
+            next_offset += page_size
+            if rows:
+                yield rows
+            save_cursor(cursor_file, {'mode': 'offset', 'since': since, 'until': until, 'offset': next_offset})
+
+def fetch_keyset_pages(session, link, since, page_size, cursor_file, until=None):
+    """
+    Generator of pages using keyset paging on (reported_date, :id). Each page depends
+    on the last row of the previous one, so only one request is in flight.
+    """
+    cursor = read_cursor(cursor_file)
+    last_id = None
+    if cursor and cursor.get('mode') == 'keyset' and cursor.get('start') == since and cursor.get('until') == until:
+        since = cursor['since']
+        last_id = cursor['last_id']
+    start = since
+
+    while True:
+        rows = fetch_page(session, link, keyset_params(since, last_id, page_size, until))
+        if rows:
+            since = format_since(rows[-1]['reported_date'])
+            last_id = rows[-1][':id']
+            for row in rows:
+                del row[':id']
+            yield rows
+            save_cursor(cursor_file, {'mode': 'keyset', 'start': start, 'until': until, 'since': since, 'last_id': last_id})
+        if len(rows) < page_size:
+            break
+
+def fetch_chunks(link, key=None, since=None, until=None, page_size=5000, max_workers=4, mode='offset',
+                 cursor_file=None, session=None):
+    """
+    Retrieves json data from the api one page at a time and yields each page as a pandas DataFrame
+
+    link: link for json api data
+    key: user key for api
+    since: only rows with reported_date after this are returned, None for all rows
+    until: only rows with reported_date at or before this are returned, None for no upper bound
+    page_size: rows per page request
+    max_workers: number of page requests in flight at once (offset mode only)
+    mode: 'offset' for concurrent $limit/$offset paging or 'keyset' for serial paging on reported_date
+    cursor_file: path of the resume cursor, saved after every page; a rerun with the same
+        since/until picks up after the last completed page. Removed once every page is fetched.
+    session: requests.Session to reuse, one with a pool of max_workers connections is created if None
+
+    returns: generator of DataFrames
+    """
+    since = format_since(since)
+    until = format_since(until)
+    if session is None:
+        session = create_session(key, pool_size=max_workers)
+
+    if mode == 'offset':
+        pages = fetch_offset_pages(session, link, since, page_size, max_workers, cursor_file, until)
+    elif mode == 'keyset':
+        pages = fetch_keyset_pages(session, link, since, page_size, cursor_file, until)
+    else:
+        raise ValueError("mode must be 'offset' or 'keyset', got "+repr(mode))
+
+    for rows in pages:
+        yield pd.DataFrame(rows)
+
+    clear_cursor(cursor_file)
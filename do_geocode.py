@@ -1,85 +1,517 @@
+import time
+import sqlite3
+
 import pandas as pd
 import numpy as np
 import requests
 
-def geocode(address, key, parse_address=False, city_state=', Providence, RI', bounds='41.70,-71.65|42.0,-71.25'):
-    link ='https://maps.googleapis.com/maps/api/geocode/json'
-    
-    if parse_address:
-        addresses = address+ city_state
-        address = address.replace(' ', '+')
-        
-    params={'address': address, 'bounds': bounds, 'key': key}
-    response = requests.get(link, params=params)
+from transforms import normalize_locations
+
+#version of the location keys the cache is written with; 1 is pvd_crime.clean_location's
+#canonical addresses (transforms.normalize_locations)
+location_key_version = 1
+
+class GeocodeCache(object):
+    """
+    On disk cache of geocoder results keyed on the address string, stored in sqlite
+
+    Found addresses are kept until evicted (or until ttl seconds if ttl is set).
+    ZERO_RESULTS answers are stored as negative entries that expire after negative_ttl seconds,
+    so an address google could not find is retried eventually but not on every run.
+    When the cache holds more than max_entries the least recently used entries are evicted.
+
+    cache_file: path of the sqlite file, ':memory:' for a throw away cache
+    max_entries: size cap for LRU eviction
+    ttl: seconds a found address is kept, None to keep forever
+    negative_ttl: seconds a ZERO_RESULTS address is kept
+    seed_file: csv of known locations (location, lat, lon, neighborhood, city) loaded into a new, empty cache
+    timeout: seconds to wait for another process holding the file's write lock, e.g. backfill workers
+
+    hits, negative_hits, misses and evictions count cache activity since the cache was opened
+    """
+    def __init__(self, cache_file='geocode_cache.sqlite', max_entries=200000, ttl=None,
+                 negative_ttl=30*24*3600, seed_file='pvd_location_info.csv', timeout=30):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.conn = sqlite3.connect(cache_file, check_same_thread=False, timeout=timeout)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS geocode (
+                                 address TEXT PRIMARY KEY, lat REAL, lon REAL, neighborhood TEXT, city TEXT,
+                                 negative INTEGER NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS geocode_last_used ON geocode (last_used)")
+        self.conn.commit()
+
+        if seed_file is not None and len(self) == 0:
+            try:
+                self.load_address_csv(seed_file)
+            except IOError:
+                pass
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] < location_key_version:
+            self.add_canonical_keys()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+
+    def load_address_csv(self, address_file):
+        """
+        Loads a csv of already geocoded locations (same columns as pvd_location_info.csv) into the cache,
+        under both the csv's address and its canonical one
+        """
+        addresses = pd.read_csv(address_file).drop_duplicates('location', keep='last')
+        addresses = addresses[addresses['lat'].notnull()]
+        results = zip(addresses['lat'], addresses['lon'], addresses['neighborhood'], addresses['city'])
+        self.put_many(dict(zip(addresses['location'], results)))
+        self.add_canonical_keys()
+
+    def add_canonical_keys(self):
+        """
+        Copies entries keyed on addresses cleaned by the old rules (or loaded from csv) to their
+        canonical address, so a rerun with the new keys still hits them
+        """
+        addresses = [row[0] for row in self.conn.execute("SELECT address FROM geocode")]
+        canonical = normalize_locations(addresses)
+        renames = [(new, old) for old, new in zip(addresses, canonical) if new is not None and new != old]
+        self.conn.executemany("INSERT OR IGNORE INTO geocode SELECT ?, lat, lon, neighborhood, city, negative, "
+                              "created, last_used FROM geocode WHERE address = ?", renames)
+        self.conn.execute("PRAGMA user_version = "+str(location_key_version))
+        self.conn.commit()
+
+    def expired(self, negative, created, now):
+        ttl = self.negative_ttl if negative else self.ttl
+        return ttl is not None and now - created > ttl
+
+    def get_many(self, addresses):
+        """
+        Looks up a list of addresses
+
+        returns dict of address to (lat, lon, neighborhood, city) for every cached address;
+        negative entries map to a tuple of np.nan. Addresses not in the dict are misses.
+        """
+        now = time.time()
+        found = {}
+        stale = []
+        addresses = list(addresses)
+        #sqlite limits the number of bound parameters, look up in batches
+        for i in range(0, len(addresses), 500):
+            batch = addresses[i:i+500]
+            rows = self.conn.execute("SELECT address, lat, lon, neighborhood, city, negative, created FROM geocode "
+                                     "WHERE address IN ("+','.join('?'*len(batch))+")", batch).fetchall()
+            for address, lat, lon, hood, city, negative, created in rows:
+                if self.expired(negative, created, now):
+                    stale.append(address)
+                elif negative:
+                    found[address] = (np.nan, np.nan, np.nan, np.nan)
+                    self.negative_hits += 1
+                else:
+                    found[address] = (lat, lon, none_to_nan(hood), none_to_nan(city))
+                    self.hits += 1
+        self.misses += len(addresses) - len(found)
+
+        self.conn.executemany("UPDATE geocode SET last_used = ? WHERE address = ?", [(now, a) for a in found])
+        self.conn.executemany("DELETE FROM geocode WHERE address = ?", [(a,) for a in stale])
+        self.conn.commit()
+        return found
+
+    def get(self, address):
+        return self.get_many([address]).get(address)
+
+    def put_many(self, results):
+        """
+        Stores a dict of address to (lat, lon, neighborhood, city); a result with a null lat is
+        stored as a negative entry
+        """
+        now = time.time()
+        rows = []
+        for address, (lat, lon, hood, city) in results.items():
+            negative = int(pd.isnull(lat))
+            if negative:
+                rows.append((address, None, None, None, None, 1, now, now))
+            else:
+                rows.append((address, float(lat), float(lon), nan_to_none(hood), nan_to_none(city), 0, now, now))
+        self.conn.executemany("INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.evict()
+        self.conn.commit()
+
+    def put(self, address, result):
+        self.put_many({address: result})
+
+    def evict(self):
+        #drop least recently used entries above the size cap
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            self.conn.execute("DELETE FROM geocode WHERE address IN "
+                              "(SELECT address FROM geocode ORDER BY last_used LIMIT ?)", (excess,))
+            self.evictions += excess
 
-    response_json=response.json()
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        return {'hits': self.hits, 'negative_hits': self.negative_hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self),
+                'hit_rate': (self.hits + self.negative_hits) / lookups if lookups else 0.0}
+
+    def close(self):
+        self.conn.close()
+
+def none_to_nan(value):
+    return np.nan if value is None else value
+
+def nan_to_none(value):
+    return None if pd.isnull(value) else value
+
+google_link = 'https://maps.googleapis.com/maps/api/geocode/json'
+
+def parse_result(results):
+    """
+    Takes one google geocoding result and returns (lat, lon, neighborhood, city),
+    np.nan for a neighborhood or city google did not give
+    """
+    neighborhood, city = np.nan, np.nan
+    for component in results.get('address_components', []):
+        if component['types'][0] == 'neighborhood':
+            neighborhood = component['long_name']
+        if component['types'][0] == 'locality':
+            city = component['long_name']
+
+    lat = results.get('geometry').get('location').get('lat')
+    lon = results.get('geometry').get('location').get('lng')
+    return lat, lon, neighborhood, city
+
+def parse_response(response_json):
+    """
+    Takes a google geocoding json response and returns (lat, lon, neighborhood, city);
+    np.nans for ZERO_RESULTS, 1s for REQUEST_DENIED, 2s for INVALID_REQUEST
+    and None for OVER_QUERY_LIMIT, which should be retried
+    """
     status = response_json['status']
-    
+
     if status == 'ZERO_RESULTS':
-        print(address)
         return np.nan, np.nan, np.nan, np.nan
     if status == 'OVER_QUERY_LIMIT':
-        time.sleep(30)
+        return None
     if status == 'REQUEST_DENIED':
         return 1, 1, 1, 1
     if status == 'INVALID_REQUEST':
         return 2, 2, 2, 2
 
-    results = response_json['results'][0]
-    address_components = results.get('address_components')
+    return parse_result(response_json['results'][0])
 
-    for component in address_components:
-        if component['types'][0] == 'neighborhood':
-            neighborhood = component['long_name']
-        if component['types'][0] == 'locality':
-            city = component['long_name']
-    
-    lat = results.get('geometry').get('location').get('lat')
-    lon = results.get('geometry').get('location').get('lng')
+def geocode(address, key, parse_address=False, city_state=', Providence, RI', bounds='41.70,-71.65|42.0,-71.25',
+            retries=3, link=google_link):
+    if parse_address:
+        address = address+ city_state
+        address = address.replace(' ', '+')
+        
+    params={'address': address, 'bounds': bounds, 'key': key}
+    response = requests.get(link, params=params)
 
-    try:
-        neighborhood
-    except UnboundLocalError or NameError:
-        neighborhood = np.nan
+    result = parse_response(response.json())
+    if result is None:
+        if retries == 0:
+            raise RuntimeError('Google geocoding quota exceeded')
+        time.sleep(30)
+        return geocode(address, key, bounds=bounds, retries=retries-1, link=link)
+    if pd.isnull(result[0]):
+        print(address)
 
-    try:
-        city
-    except UnboundLocalError or NameError:
-        city = np.nan
+    return result
 
-    return lat, lon, neighborhood, city
 
+#Geocoder backends, chained in cost order by GeocoderChain: local indexes, the on disk cache,
+#a local Nominatim server, then google. Each backend takes a list of addresses and returns a dict
+#of address to (lat, lon, neighborhood, city) for what it resolved; a tuple of np.nans is a
+#definitive "does not exist" (google ZERO_RESULTS) and stops the chain for that address.
 
-def geocode_addresses(addresses, key, city_state=', Providence, RI'):
+#upper bounds, in milliseconds, of the latency histogram buckets
+latency_buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, np.inf]
 
-    lats, lons, neighborhoods, cities = [], [], [], []
-    addresses_google = [address+ city_state for address in addresses]
-    addresses_google = [address.replace(' ', '+') for address in addresses_google]
-    
-    for address in addresses_google:
-        lat, lon, hood, city = geocode(address, key=key)
+def latency_histogram(histogram):
+    """
+    Takes the counts of each of latency_buckets and returns a dict of bucket label to count
+    for the buckets that were hit, e.g. {'<=5ms': 3, '>10000ms': 1}
+    """
+    return {'<='+str(bound)+'ms' if np.isfinite(bound) else '>'+str(latency_buckets[-2])+'ms': int(count)
+            for bound, count in zip(latency_buckets, histogram) if count}
+
+class Backend(object):
+    """
+    Base class of the geocoder backends; subclasses implement resolve(addresses)
+    and call record() once per call they make to their data source
+
+    name: label used in stats
+    cost_per_call: dollars charged per paid call
+    """
+    paid = False
+
+    def __init__(self, name, cost_per_call=0.0):
+        self.name = name
+        self.cost_per_call = cost_per_call
+        self.lookups = 0
+        self.hits = 0
+        self.negatives = 0
+        self.calls = 0
+        self.paid_calls = 0
+        self.seconds = 0.0
+        self.histogram = np.zeros(len(latency_buckets), dtype='int64')
+
+    def record(self, seconds, paid_calls=0):
+        self.calls += 1
+        self.seconds += seconds
+        self.paid_calls += paid_calls
+        self.histogram[np.searchsorted(latency_buckets, seconds * 1000)] += 1
+
+    def lookup(self, addresses):
+        results = self.resolve(addresses)
+        self.lookups += len(addresses)
+        for result in results.values():
+            if pd.isnull(result[0]):
+                self.negatives += 1
+            else:
+                self.hits += 1
+        return results
+
+    def resolve(self, addresses):
+        raise NotImplementedError
+
+    def stats(self):
+        return {'backend': self.name, 'lookups': self.lookups, 'hits': self.hits, 'negatives': self.negatives,
+                'hit_rate': (self.hits + self.negatives) / self.lookups if self.lookups else 0.0,
+                'calls': self.calls, 'seconds': round(self.seconds, 4),
+                'mean_ms': round(self.seconds * 1000 / self.calls, 3) if self.calls else 0.0,
+                'paid_calls': self.paid_calls, 'cost': round(self.paid_calls * self.cost_per_call, 4),
+                'latency_ms': latency_histogram(self.histogram)}
+
+class IndexBackend(Backend):
+    """
+    Wraps a local batch lookup such as address_index.AddressIndex.lookup,
+    street_resolver.StreetResolver.resolve or locations.LocationTable.lookup
+
+    lookup: function taking a list of locations and returning an aligned DataFrame with lat, lon, city
+        and optionally neighborhood
+    """
+    def __init__(self, lookup, name='index'):
+        Backend.__init__(self, name)
+        self.lookup_function = lookup
+
+    def resolve(self, addresses):
+        start = time.perf_counter()
+        found = self.lookup_function(addresses)
+        self.record(time.perf_counter() - start)
+        hit = found['lat'].notnull().values
+        hoods = found['neighborhood'].values[hit] if 'neighborhood' in found else np.full(hit.sum(), np.nan)
+        return {address: (lat, lon, hood, city) for address, lat, lon, hood, city
+                in zip(np.asarray(addresses, dtype=object)[hit], found['lat'].values[hit],
+                       found['lon'].values[hit], hoods, found['city'].values[hit])}
+
+class CacheBackend(Backend):
+    """
+    Wraps a GeocodeCache; results of the backends after it in the chain are stored in it
+    """
+    def __init__(self, cache, name='cache'):
+        Backend.__init__(self, name)
+        self.cache = cache
+
+    def resolve(self, addresses):
+        start = time.perf_counter()
+        found = self.cache.get_many(addresses)
+        self.record(time.perf_counter() - start)
+        return found
+
+    def store(self, results):
+        self.cache.put_many(results)
 
+class NominatimBackend(Backend):
+    """
+    Queries a Nominatim compatible /search endpoint one address at a time, e.g. a local
+    Nominatim server loaded with the Rhode Island extract. Addresses it cannot find are
+    left for the next backend rather than treated as non existent.
+
+    link: search endpoint
+    city_state: appended to every address
+    viewbox: lon1,lat1,lon2,lat2 box results must fall in
+    """
+    def __init__(self, link='http://localhost:8080/search', city_state=', Providence, RI',
+                 viewbox='-71.65,42.0,-71.25,41.70', timeout=10, name='nominatim'):
+        Backend.__init__(self, name)
+        self.link = link
+        self.city_state = city_state
+        self.viewbox = viewbox
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def search(self, address):
+        params = {'q': address + self.city_state, 'format': 'jsonv2', 'addressdetails': 1, 'limit': 1,
+                  'viewbox': self.viewbox, 'bounded': 1}
+        start = time.perf_counter()
+        try:
+            response = self.session.get(self.link, params=params, timeout=self.timeout)
+            response.raise_for_status()
+            places = response.json()
+        except (requests.RequestException, ValueError):
+            places = []
+        self.record(time.perf_counter() - start)
+        if not places:
+            return None
+
+        details = places[0].get('address', {})
+        neighborhood = details.get('neighbourhood', details.get('suburb', np.nan))
+        city = details.get('city', details.get('town', details.get('village', np.nan)))
+        return float(places[0]['lat']), float(places[0]['lon']), neighborhood, city
+
+    def resolve(self, addresses):
+        results = {}
+        for address in addresses:
+            result = self.search(address)
+            if result is not None:
+                results[address] = result
+        return results
+
+class GoogleBackend(Backend):
+    """
+    Google geocoding api, the only paid backend
+
+    key: google maps api key
+    city_state: appended to every address
+    link: geocoding endpoint
+    geocoder: function taking a list of google formatted addresses and returning a list of
+        (lat, lon, neighborhood, city) or None for failures, e.g. async_geocode.AsyncGeocoder;
+        default calls geocode one address at a time. A batch geocoder is timed as one call
+        and its requests attribute, if it has one, is used for the paid call count.
+    cost_per_call: dollars per request
+    """
+    paid = True
+
+    def __init__(self, key, city_state=', Providence, RI', link=google_link, geocoder=None, cost_per_call=0.005,
+                 name='google'):
+        Backend.__init__(self, name, cost_per_call)
+        self.key = key
+        self.city_state = city_state
+        self.link = link
+        self.geocoder = geocoder
+
+    def geocode_one(self, address):
+        start = time.perf_counter()
+        result = geocode(address, key=self.key, link=self.link)
+        self.record(time.perf_counter() - start, paid_calls=1)
+        return result
+
+    def resolve(self, addresses):
+        addresses_google = [(address + self.city_state).replace(' ', '+') for address in addresses]
+        if self.geocoder is None:
+            answers = [self.geocode_one(address) for address in addresses_google]
+        else:
+            requests_before = getattr(self.geocoder, 'requests', 0)
+            start = time.perf_counter()
+            answers = self.geocoder(addresses_google)
+            requests_made = getattr(self.geocoder, 'requests', requests_before + len(addresses)) - requests_before
+            self.record(time.perf_counter() - start, paid_calls=requests_made)
+
+        #request errors come back as 1s and 2s (or None) and are not worth caching
+        return {address: result for address, result in zip(addresses, answers)
+                if result is not None and result[0] not in (1, 2)}
+
+class GeocoderChain(object):
+    """
+    Runs addresses through backends in order, each backend only seeing what the ones before it
+    did not resolve. Results from backends after a CacheBackend are written back to that cache.
+
+    backends: list of Backend, cheapest first
+    """
+    def __init__(self, backends):
+        self.backends = list(backends)
+
+    def resolve(self, addresses):
+        """
+        Resolves a list of addresses, each distinct address once
+
+        returns dict of address to (lat, lon, neighborhood, city) for every address resolved,
+        np.nans for addresses known not to exist
+        """
+        remaining = list(pd.unique(pd.Series(list(addresses), dtype=object).dropna().astype(str)))
+        results = {}
+        caches = []
+        for backend in self.backends:
+            if not remaining:
+                break
+            found = backend.lookup(remaining)
+            for cache in caches:
+                cache.store(found)
+            if hasattr(backend, 'store'):
+                caches.append(backend)
+            results.update(found)
+            remaining = [address for address in remaining if address not in found]
+        return results
+
+    def stats(self):
+        """
+        returns a list with the stats dict of each backend, in chain order
+        """
+        return [backend.stats() for backend in self.backends]
+
+    def summary(self):
+        """
+        returns a DataFrame of backend stats, one row per backend
+        """
+        return pd.DataFrame(self.stats()).drop(columns='latency_ms').set_index('backend')
+
+
+def geocode_addresses(addresses, key, city_state=', Providence, RI', cache=None, link=google_link, geocoder=None,
+                      chain=None):
+    """
+    Geocodes a list of addresses, returns a DataFrame with one row per distinct address found;
+    columns location, lat, lon, neighborhood, city
+
+    Each distinct address is looked up once. Addresses in the cache (found or ZERO_RESULTS)
+    are answered without calling google; new answers are written to the cache.
+
+    addresses: list of addresses in street number street format
+    key: google maps api key
+    cache: GeocodeCache, the default on disk cache is opened if None
+    link: geocoding endpoint
+    geocoder: function taking a list of google formatted addresses and returning a list of
+        (lat, lon, neighborhood, city) or None for failures; default calls geocode one address at a time
+    chain: GeocoderChain to resolve with instead of the cache followed by google;
+        cache, link and geocoder are ignored when it is given
+    """
+    if chain is None:
+        if cache is None:
+            cache = GeocodeCache()
+        chain = GeocoderChain([CacheBackend(cache), GoogleBackend(key, city_state, link, geocoder)])
+
+    #deduplicate within the batch, keeping first seen order
+    unique_addresses = list(pd.unique(pd.Series(addresses).dropna().astype(str)))
+    results = chain.resolve(unique_addresses)
+
+    lats, lons, neighborhoods, cities = [], [], [], []
+    for address in unique_addresses:
+        lat, lon, hood, city = results.get(address, (np.nan, np.nan, np.nan, np.nan))
         lats.append(lat)
         lons.append(lon)
         neighborhoods.append(hood)
         cities.append(city)
     
-    address_dict = {'location': addresses, 'lat': lats, 'lon':lons, 'neighborhood':neighborhoods, 'city':cities}
+    address_dict = {'location': unique_addresses, 'lat': lats, 'lon':lons, 'neighborhood':neighborhoods, 'city':cities}
 
     df = pd.DataFrame.from_dict(address_dict)
     df = df[df.lat.notnull()]
     df.reset_index(drop=True, inplace=True)
 
-    #update_address_csv(df)
-
     return df
 
 def update_address_csv(address_df, address_file='pvd_location_info.csv'):
+    """
+    Appends newly geocoded locations to the address csv, keeping the newest row per location
+    """
     addresses_master = pd.read_csv(address_file)
-    addresses_master = addresses_master.append(address_df, ignore_index=True)
+    addresses_master = pd.concat([addresses_master, address_df], ignore_index=True)
+    addresses_master.drop_duplicates('location', keep='last', inplace=True)
     
-    #save csv, currently overwrites my current file
-    addresses.to_csv(address_file, index=False)
+    addresses_master.to_csv(address_file, index=False)
     
 """    
 def do_geocode(address, geocoder=None, key=None):
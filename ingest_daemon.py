@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import signal
+import argparse
+import threading
+import datetime as dt
+
+import pandas as pd
+
+from crime_fetch import fetch_chunks
+from master_store import open_store, write_json
+from neighborhoods import NeighborhoodAssigner
+from rollups import RollupCube
+from spatial_bins import SpatialBins
+from map_tiles import MapArtifacts
+from query_service import notify_reload, default_service_url
+from run_report import RunReport
+from pvd_crime import (classify_crime, parse_dates, clean_location, geocoder_chain, get_lat_lon, instrument,
+                       instrument_chain, config_value)
+
+#Long running change data capture for the crime log.
+#Instead of a cold create_crime_log run (imports, config, opening the store, loading the geocoding
+#indexes) the daemon keeps the api session, store, location table, geocode cache and neighborhood
+#polygons loaded and polls the api for rows reported after its watermark. Each delta is a few
+#rows, so classify, clean, geocode and upsert take milliseconds. The poll interval follows the
+#observed arrival rate: it shrinks while rows keep arriving and backs off while the log is quiet
+#or a poll is failing. A failed poll (api, geocoder, store or a malformed row) is logged in the
+#report and retried later; only SIGTERM or SIGINT stop the daemon, which then finishes the delta
+#in progress, checkpoints and writes its report. After every delta the watermark is checkpointed
+#to state_file.
+
+class AdaptiveInterval(object):
+    """
+    Poll interval from the arrival rate of new rows
+
+    The rate is an exponentially weighted average of rows per second between polls; the next
+    poll is when target_rows are expected to have arrived. An empty poll stretches the interval
+    by backoff, a failed poll by twice that.
+
+    min_interval, max_interval: bounds of the interval in seconds
+    target_rows: rows a poll should pick up on average
+    alpha: weight of the latest poll in the rate average
+    """
+    def __init__(self, min_interval=30, max_interval=1800, target_rows=20, alpha=0.3, backoff=1.5,
+                 interval=None, rate=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_rows = target_rows
+        self.alpha = alpha
+        self.backoff = backoff
+        self.interval = min_interval if interval is None else self.bound(interval)
+        self.rate = rate
+
+    def bound(self, interval):
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def update(self, rows, seconds):
+        """
+        Takes the rows picked up by a poll and the seconds since the previous poll
+
+        returns the seconds to wait before the next poll
+        """
+        rate = rows / seconds if seconds > 0 else 0.0
+        self.rate = rate if self.rate is None else self.alpha * rate + (1 - self.alpha) * self.rate
+        if rows and self.rate > 0:
+            self.interval = self.bound(self.target_rows / self.rate)
+        else:
+            self.interval = self.bound(self.interval * self.backoff)
+        return self.interval
+
+    def failed(self):
+        self.interval = self.bound(self.interval * self.backoff * 2)
+        return self.interval
+
+class IngestDaemon(object):
+    """
+    Polls the crime log api and ingests new rows into the master store as they are reported
+
+    link, key, google_key: api link and keys, read from config.py when None
+    store_dir, master_file: master store, see master_store.open_store
+    state_file: watermark checkpoint, the daemon resumes from it after a restart
+    page_size: rows per page request of a poll
+    map_dir: map artifacts regenerated at most every map_interval seconds after new rows; None to skip
+    service_url: query service told to load new rows after every delta; None to skip
+    min_interval, max_interval: bounds of the poll interval in seconds, see AdaptiveInterval
+    """
+    def __init__(self, link=None, key=None, google_key=None,
+                 master_file='pvd_crime_master.csv', store_dir='crime_store',
+                 state_file='crime_log_runs/daemon_state.json', page_size=1000, map_dir='map_tiles',
+                 map_interval=300, service_url=default_service_url, min_interval=30, max_interval=1800):
+        self.link = config_value('api_link', link)
+        self.key = config_value('api_key', key)
+        self.google_key = config_value('google_key', google_key)
+        self.state_file = state_file
+        self.page_size = page_size
+        self.map_interval = map_interval
+        self.service_url = service_url
+        self.stopping = threading.Event()
+
+        #everything a cold run loads, loaded once
+        self.report = RunReport('ingest_daemon')
+        self.session = instrument(self.report, self.key, max_workers=1)
+        self.store = open_store(store_dir, master_file)
+        self.cube = RollupCube(self.store)
+        self.bins = SpatialBins(self.store)
+        self.non_offense_cube = RollupCube(self.store.non_offenses)
+        self.maps = MapArtifacts(self.bins, self.cube, map_dir) if map_dir is not None else None
+        self.chain = geocoder_chain(self.google_key, locations=self.store.locations)
+        instrument_chain(self.report, self.chain)
+        self.neighborhoods = NeighborhoodAssigner()
+
+        self.classify = self.report.timed('classify', classify_crime)
+        self.parse_dates = self.report.timed('parse_dates', parse_dates)
+        self.clean_location = self.report.timed('clean_location', clean_location)
+        self.geocode = self.report.timed('geocode', get_lat_lon)
+        self.append = self.report.timed('add_to_master', self.store.append)
+
+        state = {}
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+        #rows backfilled into the store since the last checkpoint move the watermark too
+        watermarks = [pd.Timestamp(date) for date in (state.get('watermark'), self.store.max_reported_date)
+                      if date is not None]
+        self.watermark = max(watermarks) if watermarks else None
+        self.interval = AdaptiveInterval(min_interval, max_interval, interval=state.get('interval'),
+                                         rate=state.get('rate'))
+        self.counts = state.get('counts', {'polls': 0, 'failed': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0})
+        self.snapshot_day = None
+        self.maps_stale = False
+        self.maps_written = 0.0
+
+    def checkpoint(self):
+        os.makedirs(os.path.dirname(self.state_file) or '.', exist_ok=True)
+        write_json(self.state_file, {'watermark': None if self.watermark is None else str(self.watermark),
+                                     'interval': self.interval.interval, 'rate': self.interval.rate,
+                                     'counts': self.counts, 'checkpointed': dt.datetime.now().isoformat()})
+
+    def fetch(self):
+        #keyset paging, a delta is a page or two and has nothing to gain from concurrent requests.
+        #Rows reported in the watermark's second after the last poll are only found with >=, so
+        #the poll starts 1s earlier (the api's dates are whole seconds) and the upsert finds the
+        #rows already stored unchanged
+        since = None if self.watermark is None else self.watermark - pd.Timedelta(seconds=1)
+        chunks = fetch_chunks(self.link, key=self.key, since=since, page_size=self.page_size,
+                              mode='keyset', session=self.session)
+        chunks = [chunk for chunk in self.report.timed_iter('fetch', chunks) if len(chunk)]
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+
+    def ingest(self, df):
+        """
+        Runs one delta through the pipeline and into the store
+
+        returns the store's inserted, updated and unchanged counts
+        """
+        df = self.classify(df)
+        df = self.parse_dates(df)
+        df = self.clean_location(df)
+        df = self.geocode(df, google_key=self.google_key, chain=self.chain, neighborhoods=self.neighborhoods)
+        counts = self.append(df)
+        self.watermark = self.store.max_reported_date
+        if counts['inserted'] or counts['updated']:
+            if self.service_url is not None:
+                notify_reload(self.service_url)
+            self.maps_stale = True
+        return counts
+
+    def poll(self):
+        """
+        Fetches and ingests the rows reported after the watermark, then checkpoints
+
+        returns the number of rows inserted or updated
+        """
+        df = self.fetch()
+        self.counts['polls'] += 1
+        rows = 0
+        if len(df):
+            counts = self.ingest(df)
+            for column, value in counts.items():
+                self.counts[column] += value
+            rows = counts['inserted'] + counts['updated']
+        self.checkpoint()
+        return rows
+
+    def housekeeping(self, force=False):
+        #map artifacts recompute only the tiles and months changed since their last run (see
+        #map_tiles.MapArtifacts.generate); they are still batched over deltas to bound the rewrites
+        now = time.time()
+        if self.maps is not None and self.maps_stale and (force or now - self.maps_written >= self.map_interval):
+            self.report.call('map_artifacts', self.maps.generate)
+            self.maps_stale = False
+            self.maps_written = now
+        #one archive snapshot a day, like the daily runs
+        today = dt.datetime.now().strftime("%m_%d_%Y")
+        if force or today != self.snapshot_day:
+            self.store.snapshot(today)
+            self.snapshot_day = today
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def failed(self, error):
+        #the last errors go in the report, the count in the checkpoint
+        self.counts['failed'] += 1
+        errors = self.report.extra.setdefault('errors', [])
+        errors.append({'time': dt.datetime.now().isoformat(timespec='seconds'), 'type': type(error).__name__,
+                       'error': str(error)})
+        del errors[:-20]
+
+    def report_file(self):
+        return os.path.join(os.path.dirname(self.state_file) or '.', 'daemon_report.json')
+
+    def run(self, max_polls=None):
+        """
+        Polls until stop() is called, SIGTERM or SIGINT is received or max_polls polls are done
+
+        returns dict of the daemon's counts
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+
+        polls = 0
+        last_poll = time.time()
+        try:
+            while not self.stopping.is_set():
+                try:
+                    rows = self.poll()
+                    now = time.time()
+                    wait = self.interval.update(rows, now - last_poll)
+                    last_poll = now
+                    if rows:
+                        print(dt.datetime.now().isoformat(timespec='seconds'), rows, 'rows, watermark',
+                              self.watermark, 'next poll in', round(wait), 's')
+                    self.housekeeping()
+                except Exception as e:
+                    #the api being down, a geocoder quota, a store write or an unexpected column
+                    #is not a reason to exit; log it and try again later
+                    self.failed(e)
+                    wait = self.interval.failed()
+                    print(dt.datetime.now().isoformat(timespec='seconds'), 'poll failed:', repr(e),
+                          'retrying in', round(wait), 's')
+                self.report.write(self.report_file())
+                polls += 1
+                if max_polls is not None and polls >= max_polls:
+                    break
+                self.stopping.wait(wait)
+        finally:
+            try:
+                self.housekeeping(force=True)
+            except Exception as e:
+                self.failed(e)
+            self.checkpoint()
+            self.report.write(self.report_file())
+        return self.counts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Poll the crime log api and ingest new rows as they are reported')
+    parser.add_argument('--min-interval', type=float, default=30, help='shortest wait between polls in seconds')
+    parser.add_argument('--max-interval', type=float, default=1800, help='longest wait between polls in seconds')
+    parser.add_argument('--store-dir', default='crime_store')
+    parser.add_argument('--state-file', default='crime_log_runs/daemon_state.json')
+    args = parser.parse_args()
+    daemon = IngestDaemon(store_dir=args.store_dir, state_file=args.state_file,
+                          min_interval=args.min_interval, max_interval=args.max_interval)
+    print(daemon.run())
@@ -0,0 +1,143 @@
+import os
+
+import pandas as pd
+import numpy as np
+
+#Location dimension of the master store.
+#Every distinct location string gets a compact int32 id; its coordinates, neighborhood and city
+#are kept once here instead of in every crime row, and partitions store only location_id.
+#Reading a partition joins the dimension back with one array take per column. Like the
+#partitions, a version of the table is never rewritten: a change writes a new
+#locations-NNNNNN file and the store's manifest (and its snapshots) name the version they use.
+
+dimension_columns = ['location', 'lat', 'lon', 'neighborhood', 'city']
+attribute_columns = ['lat', 'lon', 'neighborhood', 'city']
+
+class LocationTable(object):
+    """
+    Location id -> (location, lat, lon, neighborhood, city)
+
+    table_dir: directory of the table versions
+    name: file name of the version to load, None for an empty table
+    """
+    def __init__(self, table_dir, name=None):
+        self.table_dir = table_dir
+        self.name = name
+        self.changed = False
+        columns = {'location': np.array([], dtype=object), 'lat': np.array([], dtype='float64'),
+                   'lon': np.array([], dtype='float64'), 'neighborhood': np.array([], dtype=object),
+                   'city': np.array([], dtype=object)}
+        if name is not None:
+            path = os.path.join(table_dir, name)
+            table = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path)
+            #copies, arrays backed by the parquet reader are read only
+            columns = {'location': np.array(table['location'], dtype=object),
+                       'lat': np.array(table['lat'], dtype='float64'), 'lon': np.array(table['lon'], dtype='float64'),
+                       'neighborhood': np.array(table['neighborhood'], dtype=object),
+                       'city': np.array(table['city'], dtype=object)}
+        self.columns = columns
+        self.ids = dict(zip(columns['location'], range(len(columns['location']))))
+
+    def __len__(self):
+        return len(self.columns['location'])
+
+    def find(self, locations):
+        """
+        returns the int32 id of each location, -1 where it is missing or not in the table
+        """
+        unique = pd.Categorical(np.asarray(locations, dtype=object))
+        unique_ids = np.array([self.ids.get(location, -1) for location in unique.categories], dtype='int32')
+        return np.append(unique_ids, -1).astype('int32')[unique.codes]
+
+    def intern(self, locations):
+        """
+        returns the int32 id of each location, adding locations not in the table (with null
+        attributes); -1 for missing locations
+        """
+        unique = pd.Categorical(np.asarray(locations, dtype=object))
+        new = [location for location in unique.categories if location not in self.ids]
+        if new:
+            first = len(self)
+            self.ids.update(zip(new, range(first, first + len(new))))
+            for column, values in self.columns.items():
+                added = np.array(new, dtype=object) if column == 'location' else \
+                    np.full(len(new), np.nan, dtype=values.dtype)
+                self.columns[column] = np.concatenate([values, added])
+            self.changed = True
+        unique_ids = np.array([self.ids[location] for location in unique.categories], dtype='int32')
+        return np.append(unique_ids, -1).astype('int32')[unique.codes]
+
+    def update(self, ids, df):
+        """
+        Sets the attributes of the locations ids from the matching rows of df; null values
+        leave the stored attribute as it is and the last row of an id wins
+        """
+        ids = np.asarray(ids)
+        for column in attribute_columns:
+            if column not in df:
+                continue
+            values = df[column].astype('float64' if column in ('lat', 'lon') else object).values
+            keep = (ids >= 0) & pd.notnull(values)
+            if keep.any():
+                self.columns[column][ids[keep]] = values[keep]
+                self.changed = True
+
+    def add(self, df):
+        """
+        Interns the location column of df; only locations new to the table take their attributes
+        from df. Attributes of locations already in the table are left as they are, every stored
+        row joins them, so they change only through MasterStore.update_locations.
+
+        returns the int32 location id of each row
+        """
+        first = len(self)
+        ids = self.intern(df['location'])
+        new = ids >= first
+        if new.any():
+            self.update(ids[new], df[new])
+        return ids
+
+    def join(self, ids, columns=dimension_columns):
+        """
+        returns a dict of column -> array aligned with ids, nulls where the id is -1
+        """
+        ids = np.asarray(ids, dtype='int64')
+        found = ids >= 0
+        joined = {}
+        for column in columns:
+            values = self.columns[column]
+            out = np.full(len(ids), np.nan, dtype=values.dtype if values.dtype.kind == 'f' else object)
+            out[found] = values[ids[found]]
+            joined[column] = out
+        return joined
+
+    def lookup(self, locations):
+        """
+        Attributes of locations already in the table, for do_geocode.IndexBackend
+
+        returns DataFrame aligned with locations; columns lat, lon, neighborhood, city, NaN where
+        the location is not in the table or has no coordinates
+        """
+        return pd.DataFrame(self.join(self.find(locations), attribute_columns))
+
+    def save(self, file_format='parquet'):
+        """
+        Writes the table as a new version file if it changed
+
+        returns the file name of the current version
+        """
+        if not self.changed:
+            return self.name
+        os.makedirs(self.table_dir, exist_ok=True)
+        existing = [int(name[10:16]) for name in os.listdir(self.table_dir) if name.startswith('locations-')]
+        name = 'locations-'+str(max(existing + [-1]) + 1).zfill(6)+'.'+file_format
+        path = os.path.join(self.table_dir, name)
+        table = pd.DataFrame(self.columns)
+        if file_format == 'parquet':
+            table.to_parquet(path + '.tmp', index=False)
+        else:
+            table.to_csv(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+        self.name = name
+        self.changed = False
+        return name
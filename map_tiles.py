@@ -0,0 +1,294 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from neighborhoods import load_rings, harmonize_names
+from master_store import write_json, month_names
+from spatial_bins import tile_lat_lon
+
+#Static map artifacts built once per ingest from the spatial bins and the rollup cube.
+#out_dir/clusters/{z}/{x}/{y}.geojson holds one point per occupied cluster cell inside web mercator
+#tile z/x/y (cells cluster_offset zoom levels finer than the tile) with counts by offense_cat.
+#out_dir/neighborhoods/{z}.geojson is the neighborhood choropleth with polygons simplified to
+#about half a pixel at zoom z. manifest.json keeps a hash of every artifact so a run only
+#rewrites the files whose data changed and removes the ones left empty. It also keeps the store
+#ingest the artifacts show and the neighborhood totals of every month; when the bins and the cube
+#know the cells changed since that ingest (see rollups.RollupCube.changes), only the tiles holding
+#changed cells and the totals of changed months are computed again.
+
+def simplify_ring(points, tolerance):
+    """
+    Douglas-Peucker simplification of a closed ring (first point repeated or not);
+    returns the kept points, at least 4 with the first point repeated at the end
+    """
+    if len(points) and np.array_equal(points[0], points[-1]):
+        points = points[:-1]
+    if len(points) < 4:
+        return np.vstack([points, points[:1]])
+
+    keep = np.zeros(len(points), dtype=bool)
+    #split the ring at the point farthest from the first so both halves are open lines
+    far = int(np.argmax(np.hypot(*(points - points[0]).T)))
+    keep[[0, far]] = True
+    stack = [(0, far), (far, len(points))]
+    closed = np.vstack([points, points[:1]])
+    while stack:
+        start, stop = stack.pop()
+        if stop - start < 2:
+            continue
+        a, b = closed[start], closed[stop]
+        inner = closed[start+1:stop]
+        direction = b - a
+        length = np.hypot(*direction)
+        if length == 0:
+            distances = np.hypot(*(inner - a).T)
+        else:
+            distances = np.abs(direction[0] * (inner[:, 1] - a[1]) - direction[1] * (inner[:, 0] - a[0])) / length
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance:
+            keep[start + 1 + i] = True
+            stack.append((start, start + 1 + i))
+            stack.append((start + 1 + i, stop))
+
+    kept = points[keep]
+    if len(kept) < 3:
+        kept = points[np.linspace(0, len(points) - 1, 3).astype('int64')]
+    return np.vstack([kept, kept[:1]])
+
+def ring_geometry(rings):
+    """
+    Takes shapefile rings (outer rings clockwise, holes counterclockwise) and returns a GeoJSON
+    Polygon or MultiPolygon geometry with the right hand rule orientation GeoJSON uses
+    """
+    polygons = []
+    for ring in rings:
+        x, y = ring[:, 0], ring[:, 1]
+        clockwise = np.sum((np.roll(x, -1) - x) * (np.roll(y, -1) + y)) > 0
+        if clockwise or not polygons:
+            polygons.append([])
+        polygons[-1].append(ring[::-1].tolist())
+    if len(polygons) == 1:
+        return {'type': 'Polygon', 'coordinates': polygons[0]}
+    return {'type': 'MultiPolygon', 'coordinates': polygons}
+
+def pixel_degrees(zoom):
+    #width of one 256 pixel tile pixel in degrees of longitude
+    return 360.0 / (256 * 2 ** zoom)
+
+def digest(data):
+    return hashlib.md5(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+def write_geojson(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def feature_properties(row, columns):
+    return {column: int(row[column]) for column in columns}
+
+def tile_keys(x, y, zoom):
+    #one int64 per tile of a zoom level
+    return np.asarray(x, dtype='int64') * 2 ** zoom + np.asarray(y, dtype='int64')
+
+def month_totals(cells):
+    """
+    Takes cube cells and returns dict of month to DataFrame indexed by neighborhood with the rows,
+    counts and rows per offense_cat of the month
+    """
+    cells = cells.assign(month=month_names(cells['day']), neighborhood=harmonize_names(cells['neighborhood']).values)
+    if not len(cells):
+        return {}
+    by_cat = cells.pivot_table(index=['month', 'neighborhood'], columns='offense_cat', values='rows',
+                               aggfunc='sum', fill_value=0)
+    totals = cells.groupby(['month', 'neighborhood'])[['rows', 'counts']].sum().join(by_cat)
+    return {month: frame.droplevel('month') for month, frame in totals.groupby(level='month')}
+
+class MapArtifacts(object):
+    """
+    Generates the cluster tiles and choropleth GeoJSON for the maps
+
+    bins: spatial_bins.SpatialBins of the master
+    cube: rollups.RollupCube of the master, for the neighborhood totals
+    out_dir: directory the artifacts are written to
+    zooms: tile zoom levels; zoom + cluster_offset must be one of bins.levels
+    cluster_offset: cluster cells are this many zoom levels finer than their tile
+    shp_file, name_field: neighborhood polygons for the choropleth
+    """
+    def __init__(self, bins, cube, out_dir='map_tiles', zooms=(10, 12, 14, 16), cluster_offset=2,
+                 shp_file='hood_shapefile/pvd.shp', name_field='lname'):
+        for zoom in zooms:
+            if zoom + cluster_offset not in bins.levels:
+                raise ValueError('zoom '+str(zoom)+' needs bins at level '+str(zoom + cluster_offset))
+        self.bins = bins
+        self.cube = cube
+        self.out_dir = out_dir
+        self.zooms = list(zooms)
+        self.cluster_offset = cluster_offset
+        self.shp_file = shp_file
+        self.name_field = name_field
+        self.manifest_file = os.path.join(out_dir, 'manifest.json')
+        self.geometries = None
+
+    def tile_path(self, zoom, tile_x, tile_y):
+        return os.path.join('clusters', str(zoom), str(tile_x), str(tile_y)+'.geojson')
+
+    def changed_tiles(self, changed):
+        """
+        Takes the coordinates of changed bins (see rollups.RollupCube.changes) and returns dict of
+        zoom to the array of tile keys (see tile_keys) of the tiles holding them
+        """
+        tiles = {}
+        for zoom in self.zooms:
+            level = changed[changed['level'] == zoom + self.cluster_offset]
+            tiles[zoom] = np.unique(tile_keys(level['x'].values >> self.cluster_offset,
+                                              level['y'].values >> self.cluster_offset, zoom))
+        return tiles
+
+    def cluster_tiles(self, start=None, end=None, exclude=None, tiles=None, **filters):
+        """
+        tiles: dict of zoom to tile keys (see changed_tiles) to compute, default every tile
+
+        returns dict of artifact path (relative to out_dir) to GeoJSON FeatureCollection for
+        every tile holding at least one row
+        """
+        cells = self.bins.cells(start, end, exclude, **filters)
+        artifacts = {}
+        for zoom in self.zooms:
+            level_cells = cells[cells['level'] == zoom + self.cluster_offset]
+            if tiles is not None:
+                keys = tile_keys(level_cells['x'].values >> self.cluster_offset,
+                                 level_cells['y'].values >> self.cluster_offset, zoom)
+                level_cells = level_cells[np.isin(keys, tiles[zoom])]
+            if not len(level_cells):
+                continue
+            by_cat = level_cells.pivot_table(index=['x', 'y'], columns='offense_cat', values='rows',
+                                             aggfunc='sum', fill_value=0)
+            totals = level_cells.groupby(['x', 'y'])[['rows', 'counts']].sum()
+            clusters = totals.join(by_cat).reset_index()
+            clusters = clusters[clusters['rows'] != 0]
+
+            lat, lon = tile_lat_lon(clusters['x'].values + 0.5, clusters['y'].values + 0.5, zoom + self.cluster_offset)
+            clusters = clusters.assign(lat=np.round(lat, 6), lon=np.round(lon, 6),
+                                       tile_x=clusters['x'].values >> self.cluster_offset,
+                                       tile_y=clusters['y'].values >> self.cluster_offset)
+            columns = ['rows', 'counts'] + list(by_cat.columns)
+            for (tile_x, tile_y), tile in clusters.groupby(['tile_x', 'tile_y']):
+                features = [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [row['lon'], row['lat']]},
+                             'properties': feature_properties(row, columns)} for row in tile.to_dict('records')]
+                artifacts[self.tile_path(zoom, tile_x, tile_y)] = {'type': 'FeatureCollection', 'features': features}
+        return artifacts
+
+    def polygon_geometries(self):
+        #zoom -> [(name, simplified geometry)], the polygons do not change between runs
+        if self.geometries is None:
+            polygons = load_rings(self.shp_file, self.name_field)
+            self.geometries = {}
+            for zoom in self.zooms:
+                tolerance = pixel_degrees(zoom) / 2
+                self.geometries[zoom] = [(name, ring_geometry([np.round(simplify_ring(ring, tolerance), 6)
+                                                               for ring in rings]))
+                                         for name, rings in polygons]
+        return self.geometries
+
+    def choropleths(self, start=None, end=None, exclude=None, totals=None, months=None, **filters):
+        """
+        totals: dict of month to neighborhood totals (see month_totals) of a previous run; when
+            given only the months in months are computed again from the cube, and totals is updated
+
+        returns dict of artifact path to neighborhood choropleth FeatureCollection, one per zoom
+        """
+        cells = self.cube.cells(start, end, exclude, **filters)
+        if totals is None:
+            totals = {}
+            months = None
+        if months is not None:
+            cells = cells[np.isin(month_names(cells['day']), list(months))]
+            for month in months:
+                totals.pop(month, None)
+        totals.update(month_totals(cells))
+
+        summed = pd.concat(list(totals.values())).fillna(0).groupby(level=0).sum() if totals else \
+            pd.DataFrame(columns=['rows', 'counts'])
+        columns = ['rows', 'counts'] + sorted(column for column in summed.columns if column not in ['rows', 'counts'])
+
+        artifacts = {}
+        for zoom, geometries in self.polygon_geometries().items():
+            features = []
+            for name, geometry in geometries:
+                row = summed.loc[name] if name in summed.index else pd.Series(0, index=columns)
+                features.append({'type': 'Feature', 'geometry': geometry,
+                                 'properties': dict({'name': name}, **feature_properties(row, columns))})
+            artifacts[os.path.join('neighborhoods', str(zoom)+'.geojson')] = {'type': 'FeatureCollection',
+                                                                              'features': features}
+        return artifacts
+
+    def generate(self, start=None, end=None, exclude=None, **filters):
+        """
+        Writes every artifact whose content changed since the last run and removes artifacts
+        that no longer have data. When the previous run was for the same query and the bins and
+        cube tracked their changes since, only the tiles and months those changes fall in are
+        computed; the other artifacts are kept as they are.
+
+        returns dict with the number of artifacts written, unchanged and removed
+        """
+        manifest = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                manifest = json.load(f)
+        previous = manifest.get('artifacts', {})
+        query = digest(repr((start, end, exclude, sorted(filters.items()))))
+        same = manifest.get('zooms') == self.zooms and manifest.get('cluster_offset') == self.cluster_offset \
+            and manifest.get('query') == query
+        since = manifest.get('ingest') if same else None
+        ingest = self.bins.store.ingest
+        changed_bins = self.bins.changes(since)
+        changed_cells = self.cube.changes(since)
+
+        kept = {}
+        if changed_bins is None:
+            artifacts = self.cluster_tiles(start, end, exclude, **filters)
+        else:
+            tiles = self.changed_tiles(changed_bins)
+            artifacts = self.cluster_tiles(start, end, exclude, tiles=tiles, **filters)
+            touched = set(self.tile_path(zoom, key >> zoom, key & (2 ** zoom - 1))
+                          for zoom, keys in tiles.items() for key in keys.tolist())
+            kept.update((path, value) for path, value in previous.items()
+                        if path.startswith('clusters') and path not in touched)
+
+        totals = None
+        if changed_cells is not None and 'neighborhood_totals' in manifest:
+            totals = {month: pd.DataFrame.from_dict(frame, orient='index')
+                      for month, frame in manifest['neighborhood_totals'].items()}
+        if totals is not None and not len(changed_cells):
+            kept.update((path, value) for path, value in previous.items() if path.startswith('neighborhoods'))
+        else:
+            months = None if totals is None else set(month_names(changed_cells['day']))
+            totals = {} if totals is None else totals
+            artifacts.update(self.choropleths(start, end, exclude, totals=totals, months=months, **filters))
+
+        hashes = dict(kept)
+        written = 0
+        for path, data in artifacts.items():
+            hashes[path] = digest(data)
+            if previous.get(path) != hashes[path] or not os.path.exists(os.path.join(self.out_dir, path)):
+                write_geojson(os.path.join(self.out_dir, path), data)
+                written += 1
+
+        removed = [path for path in previous if path not in hashes]
+        for path in removed:
+            if os.path.exists(os.path.join(self.out_dir, path)):
+                os.remove(os.path.join(self.out_dir, path))
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        write_json(self.manifest_file, {'artifacts': hashes, 'zooms': self.zooms,
+                                        'cluster_offset': self.cluster_offset, 'query': query, 'ingest': ingest,
+                                        'neighborhood_totals': {month: {name: {column: int(value)
+                                                                               for column, value in row.items()}
+                                                                        for name, row in frame.iterrows()}
+                                                                for month, frame in totals.items()}})
+        return {'written': written, 'unchanged': len(hashes) - written, 'removed': len(removed)}
@@ -0,0 +1,698 @@
+import os
+import json
+import datetime as dt
+
+import pandas as pd
+import numpy as np
+
+try:
+    import pyarrow
+    has_parquet = True
+except ImportError:
+    has_parquet = False
+
+from locations import LocationTable, dimension_columns
+
+#Append-only, month partitioned store for the crime master.
+#Each ingest writes its rows as new delta files under store_dir/YYYY-MM/ and records them in
+#manifest.json; existing files are never rewritten. An archive is a copy of the manifest,
+#and export_csv rebuilds pvd_crime_master.csv on demand.
+#A persistent hash index over (casenumber, offense_desc, statute_code, statute_desc, reported_date)
+#makes ingest an upsert; rows already stored are skipped and late corrections replace the
+#stored row.
+#Partitions are parquet with an explicit schema when pyarrow is installed, csv otherwise.
+#Location attributes live in a location dimension (locations.LocationTable); partitions store a
+#location_id and reading one joins location, lat, lon, neighborhood and city back. Partitions
+#written before the dimension existed still hold those columns and are read as they are.
+#Non offense rows (counts == 0) are routed to a second store under store_dir/non_offense/ with
+#its own partitions, index and rollups, so offenses load without filtering them out.
+
+#low cardinality text is stored as dictionary encoded categoricals, coordinates as float32
+schema = {'casenumber': 'object', 'counts': 'int16', 'location': 'object', 'month': 'int8',
+          'offense_desc': 'category', 'reported_date': 'datetime64[ns]', 'reporting_officer': 'category',
+          'statute_code': 'category', 'statute_desc': 'category', 'year': 'int16', 'offense_cat': 'category',
+          'city': 'category', 'lat': 'float32', 'lon': 'float32', 'neighborhood': 'category', 'location_id': 'int32'}
+
+#row hashes of the key index before 2 covered the location attributes, before 3 they hashed
+#numbers as dtype dependent text, row keys before 4 left out the statute
+index_version = 4
+
+#one case can list several statutes under one offense_desc and reported_date, each is a row
+key_columns = ['casenumber', 'offense_desc', 'statute_code', 'statute_desc']
+
+#directory of the non offense store, under the offense store's directory
+non_offense_dir = 'non_offense'
+
+def write_json(path, data):
+    #write to a temp file and rename so a crash never leaves half a manifest
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp_path, path)
+
+def apply_schema(df):
+    """
+    Casts the columns of df that are in the schema to their schema dtype; integer columns
+    holding nulls are kept as float32
+    """
+    columns = {}
+    for column, dtype in schema.items():
+        if column not in df:
+            continue
+        values = df[column]
+        if dtype == 'datetime64[ns]':
+            values = pd.to_datetime(values)
+        elif dtype.startswith('int') or dtype.startswith('float'):
+            values = pd.to_numeric(values, errors='coerce')
+            if dtype.startswith('int') and values.isnull().any():
+                dtype = 'float32'
+        elif dtype == 'object':
+            values = values.where(values.isnull(), values.astype(str))
+        columns[column] = values.astype(dtype)
+    return df.assign(**columns)
+
+def read_file(path, columns=None, start=None, end=None):
+    """
+    Reads one partition file; parquet files only read the requested columns and the
+    row groups that can hold reported_dates between start and end
+    """
+    if path.endswith('.parquet'):
+        filters = []
+        if start is not None:
+            filters.append(('reported_date', '>=', pd.Timestamp(start)))
+        if end is not None:
+            filters.append(('reported_date', '<=', pd.Timestamp(end)))
+        return pd.read_parquet(path, columns=columns, filters=filters or None)
+    return pd.read_csv(path, usecols=columns)
+
+def month_names(dates):
+    """
+    Returns the 'YYYY-MM' partition name of each date; only the distinct months are formatted
+    """
+    months = pd.to_datetime(dates).values.astype('datetime64[M]')
+    unique, inverse = np.unique(months, return_inverse=True)
+    return np.datetime_as_string(unique, unit='M')[inverse]
+
+def is_non_offense(df):
+    """
+    Returns a boolean mask of the non offense rows of df, those with counts == 0
+    """
+    return (pd.to_numeric(df['counts'], errors='coerce') == 0).values
+
+def row_keys(df):
+    """
+    Returns a uint64 hash of (casenumber, offense_desc, statute_code, statute_desc, reported_date)
+    for every row of df; null text hashes as ''
+    """
+    keys = {column: df[column].astype(object).where(df[column].notnull(), '').astype(str).values
+            for column in key_columns}
+    keys['reported_date'] = pd.to_datetime(df['reported_date']).values.astype('datetime64[ns]').astype('int64')
+    return pd.util.hash_pandas_object(pd.DataFrame(keys), index=False).values
+
+def row_contents(df):
+    """
+    Returns a uint64 hash of every column of each row, on canonical values so a row read
+    back from a partition hashes the same as the row that was written: numbers as float64
+    (an int16 column and its float32 fallback for nulls agree), everything else as text,
+    nulls as null
+
+    The location attributes and location_id are left out; they belong to the location,
+    and a location geocoded again is an update of the location dimension, not of its rows.
+    """
+    columns = [column for column in sorted(df.columns) if column not in dimension_columns[1:] + ['location_id']]
+    canonical = {}
+    for column in columns:
+        values = df[column]
+        if values.dtype.kind in 'iufb':
+            canonical[column] = values.values.astype('float64')
+        else:
+            canonical[column] = values.astype(str).where(values.notnull(), None).values
+    return pd.util.hash_pandas_object(pd.DataFrame(canonical, columns=columns), index=False).values
+
+class KeyIndex(object):
+    """
+    Persistent hash index of row key -> (partition file number, content hash)
+
+    Stored as sorted .npz segments; every add writes one small segment (cost O(new rows)) and
+    newer segments shadow older ones. A removed key is recorded with file number -1 so it
+    shadows the older entries until the segments are merged. Segments are merged into one once
+    there are more than max_segments. Which segments are live is recorded in the store's manifest, so the
+    index and the partitions it points to always change together.
+
+    index_dir: directory of the segment files
+    names: live segment file names, oldest first
+    """
+    def __init__(self, index_dir, names=(), max_segments=8):
+        self.index_dir = index_dir
+        self.max_segments = max_segments
+        self.names = list(names)
+        self.segments = []
+        for name in self.names:
+            with np.load(os.path.join(index_dir, name)) as segment:
+                self.segments.append((segment['keys'], segment['files'], segment['contents']))
+
+    def __len__(self):
+        return sum(len(keys) for keys, files, contents in self.segments)
+
+    def lookup(self, keys):
+        """
+        returns (file numbers, content hashes) for each key; file number -1 where the key is new
+        """
+        files = np.full(len(keys), -1, dtype='int64')
+        contents = np.zeros(len(keys), dtype='uint64')
+        for segment_keys, segment_files, segment_contents in self.segments:
+            if not len(segment_keys):
+                continue
+            positions = np.searchsorted(segment_keys, keys)
+            positions[positions == len(segment_keys)] = 0
+            found = segment_keys[positions] == keys
+            files[found] = segment_files[positions[found]]
+            contents[found] = segment_contents[positions[found]]
+        return files, contents
+
+    def write_segment(self, keys, files, contents):
+        os.makedirs(self.index_dir, exist_ok=True)
+        existing = [int(name[8:14]) for name in os.listdir(self.index_dir) if name.startswith('segment-')]
+        name = 'segment-'+str(max(existing + [-1]) + 1).zfill(6)+'.npz'
+        order = np.argsort(keys, kind='stable')
+        with open(os.path.join(self.index_dir, name), 'wb') as f:
+            np.savez(f, keys=keys[order], files=files[order], contents=contents[order])
+        return name, (keys[order], files[order], contents[order])
+
+    def add(self, keys, files, contents):
+        """
+        Records keys as stored in the given partition files; keys must be unique
+        """
+        if not len(keys):
+            return
+        name, segment = self.write_segment(np.asarray(keys, dtype='uint64'), np.asarray(files, dtype='int64'),
+                                           np.asarray(contents, dtype='uint64'))
+        self.names.append(name)
+        self.segments.append(segment)
+        if len(self.segments) > self.max_segments:
+            self.merge()
+
+    def merge(self):
+        #one segment holding the newest entry of every key
+        keys = np.concatenate([segment[0] for segment in self.segments])
+        files = np.concatenate([segment[1] for segment in self.segments])
+        contents = np.concatenate([segment[2] for segment in self.segments])
+        #removed keys are dropped once nothing older is left to shadow
+        newest = ~pd.Series(keys).duplicated(keep='last').values & (files != -1)
+        name, segment = self.write_segment(keys[newest], files[newest], contents[newest])
+        self.names = [name]
+        self.segments = [segment]
+
+class MasterStore(object):
+    """
+    Month partitioned, append-only store of crime log rows
+
+    store_dir: directory holding the partitions, manifest.json and snapshots/
+    file_format: 'parquet' or 'csv' for newly written partitions; a new store defaults to parquet
+        when pyarrow is installed, an existing store keeps its format unless one is given.
+        Stores may mix formats, compact() rewrites a month in the current format.
+    non_offenses: a new store routes its non offense rows to a store of their own
+        (self.non_offenses); stores written before the split hold both until
+        split_non_offenses() is run, see open_store
+    """
+    def __init__(self, store_dir='crime_store', file_format=None, non_offenses=True):
+        self.store_dir = store_dir
+        self.manifest_file = os.path.join(store_dir, 'manifest.json')
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'files': [], 'next_file': 0, 'max_reported_date': None, 'index_segments': [],
+                             'format': 'parquet' if has_parquet else 'csv', 'index_version': index_version,
+                             'non_offenses': non_offense_dir if non_offenses else None}
+        if file_format is not None:
+            if file_format == 'parquet' and not has_parquet:
+                raise ImportError('pyarrow is required for parquet partitions')
+            self.manifest['format'] = file_format
+
+        self.locations = LocationTable(os.path.join(store_dir, 'locations'), self.manifest.get('locations'))
+        self.index = KeyIndex(os.path.join(store_dir, 'key_index'), self.manifest.get('index_segments', []))
+        if 'index_segments' not in self.manifest or self.manifest.get('index_version', 1) < index_version:
+            self.rebuild_index()
+        self.rollups = []
+        self.non_offenses = None
+        if self.manifest.get('non_offenses'):
+            self.non_offenses = MasterStore(os.path.join(store_dir, self.manifest['non_offenses']), file_format,
+                                            non_offenses=False)
+
+    def exists(self):
+        return os.path.exists(self.manifest_file)
+
+    def save_manifest(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.manifest['index_segments'] = list(self.index.names)
+        if self.locations.changed:
+            self.manifest['locations'] = self.locations.save(self.manifest.get('format', 'csv'))
+        write_json(self.manifest_file, self.manifest)
+
+        #segments replaced by a merge are no longer listed anywhere
+        if os.path.isdir(self.index.index_dir):
+            for name in os.listdir(self.index.index_dir):
+                if name.startswith('segment-') and name not in self.index.names:
+                    os.remove(os.path.join(self.index.index_dir, name))
+
+    def read_partition(self, entry):
+        return apply_schema(self.join_locations(read_file(os.path.join(self.store_dir, entry['path']))))
+
+    def join_locations(self, rows, locations=None, columns=dimension_columns):
+        #partitions holding location_id get the dimension columns back in place of it
+        if 'location_id' not in rows:
+            return rows
+        locations = self.locations if locations is None else locations
+        #stores mixing both kinds of partitions have null ids on the rows that kept their columns
+        ids = pd.to_numeric(rows['location_id']).fillna(-1).values.astype('int64')
+        joined = locations.join(ids, columns)
+        if (ids < 0).any():
+            joined = {column: np.where(ids >= 0, values, rows[column].values) if column in rows else values
+                      for column, values in joined.items()}
+        return rows.assign(**joined)
+
+    def rebuild_index(self):
+        """
+        Builds the key index from every partition; for stores written before the index existed
+        """
+        self.index = KeyIndex(self.index.index_dir)
+        self.manifest['index_version'] = index_version
+        for entry in self.manifest['files']:
+            entry.setdefault('file', int(os.path.basename(entry['path'])[5:11]))
+            rows = self.read_partition(entry)
+            keys = row_keys(rows)
+            self.index.add(keys, np.full(len(keys), entry['file']), row_contents(rows))
+        if len(self.index.segments) > 1:
+            self.index.merge()
+        self.save_manifest()
+
+    @property
+    def ingest(self):
+        return self.manifest.get('ingest', 0)
+
+    @property
+    def max_reported_date(self):
+        #the ingest watermark; with a non offense store it covers the rows of both, and only
+        #moves once both stores hold a batch
+        date = self.manifest['max_reported_date']
+        return None if date is None else pd.Timestamp(date)
+
+    def __len__(self):
+        return sum(entry['rows'] for entry in self.manifest['files'])
+
+    def write_partition(self, month, rows):
+        #one new immutable file per month touched by an ingest
+        file_number = self.manifest['next_file']
+        self.manifest['next_file'] += 1
+        file_format = self.manifest.get('format', 'csv')
+        relative_path = os.path.join(month, 'part-'+str(file_number).zfill(6)+'.'+file_format)
+        path = os.path.join(self.store_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        #date ordered rows let parquet skip row groups outside a date range
+        rows = rows.sort_values('reported_date', kind='mergesort')
+        #the location columns go to the dimension, the partition keeps the id
+        columns = list(rows.columns)
+        if 'location' in rows:
+            location_ids = self.locations.add(rows)
+            rows = rows.drop(columns=[column for column in dimension_columns if column in rows])
+            rows = rows.assign(location_id=location_ids)
+            columns = list(dict.fromkeys(columns + dimension_columns + ['location_id']))
+        if file_format == 'parquet':
+            rows.to_parquet(path, index=False, row_group_size=10000)
+        else:
+            rows.to_csv(path, index=False)
+
+        #columns are the ones read_partition returns
+        return {'path': relative_path, 'file': file_number, 'month': month, 'rows': len(rows), 'columns': columns,
+                'min_date': str(rows['reported_date'].min()), 'max_date': str(rows['reported_date'].max())}
+
+    def write_rows(self, df):
+        #write df as one delta file per month, returns the new entries and each row's file number
+        months = month_names(df['reported_date'])
+        entries = []
+        files = np.empty(len(df), dtype='int64')
+        for month in np.unique(months):
+            in_month = months == month
+            entry = self.write_partition(month, df[in_month])
+            entries.append(entry)
+            files[in_month] = entry['file']
+        self.manifest['files'].extend(entries)
+        return entries, files
+
+    def remove_rows(self, keys, files):
+        """
+        Copy-on-write removal of superseded rows; every partition holding one of keys is
+        rewritten to a new file without them. The old files stay for the snapshots listing them.
+
+        returns DataFrame of the removed rows
+        """
+        keys = set(keys)
+        removed = []
+        for file_number in np.unique(files):
+            entry = [e for e in self.manifest['files'] if e['file'] == file_number][0]
+            rows = self.read_partition(entry)
+            rows_keys = row_keys(rows)
+            keep = ~np.isin(rows_keys, list(keys))
+            removed.append(rows[~keep])
+
+            self.manifest['files'].remove(entry)
+            if keep.any():
+                kept = self.write_partition(entry['month'], rows[keep])
+                self.manifest['files'].append(kept)
+                self.index.add(rows_keys[keep], np.full(keep.sum(), kept['file']), row_contents(rows[keep]))
+        return pd.concat(removed, ignore_index=True)
+
+    def append(self, df):
+        """
+        Upserts the rows of df, keyed on (casenumber, offense_desc, statute_code, statute_desc,
+        reported_date), see row_keys
+
+        New rows are written as delta files, one per month of reported_date. Rows already stored
+        unchanged are skipped. Rows whose key is stored with different values (late corrections
+        from the api) replace the stored row. Duplicates within df keep the last row.
+        Cost is O(new rows) plus the partitions holding corrected rows.
+        Rollups attached to the store (self.rollups) are then updated with the written and
+        replaced rows, see rollups.RollupCube.
+        A store with a non offense store appends the non offense rows there; a row whose counts
+        changed from or to 0 is removed from the store it was in.
+
+        returns dict with the number of rows inserted, updated and unchanged, over both stores
+        """
+        if not len(df):
+            return {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        df = apply_schema(df)
+        if self.non_offenses is None:
+            return self.upsert(df)
+
+        #a key must end up in one store, so duplicates are dropped before the rows are split
+        df = df[~pd.Series(row_keys(df)).duplicated(keep='last').values]
+        non_offense = is_non_offense(df)
+        self.non_offenses.remove(df[~non_offense])
+        self.remove(df[non_offense])
+        counts = self.non_offenses.upsert(df[non_offense])
+        for column, value in self.upsert(df[~non_offense], watermark=False).items():
+            counts[column] += value
+        #the watermark moves only once both stores hold the batch; a run cut off before this
+        #fetches the batch again and the upserts find its rows unchanged
+        self.advance_watermark(df['reported_date'].max())
+        self.save_manifest()
+        return counts
+
+    def advance_watermark(self, newest):
+        stored = self.manifest['max_reported_date']
+        if stored is None or newest > pd.Timestamp(stored):
+            self.manifest['max_reported_date'] = str(newest)
+
+    def upsert(self, df, watermark=True):
+        """
+        Upserts rows of the schema into this store only, see append
+
+        watermark: advance max_reported_date to the newest row written; append leaves it to
+            after both stores are written when the rows were split
+        """
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        if not len(df):
+            return counts
+
+        keys = row_keys(df)
+        last = ~pd.Series(keys).duplicated(keep='last').values
+        df, keys = df[last], keys[last]
+        contents = row_contents(df)
+
+        stored_files, stored_contents = self.index.lookup(keys)
+        new = stored_files == -1
+        changed = ~new & (stored_contents != contents)
+        counts = {'inserted': int(new.sum()), 'updated': int(changed.sum()),
+                  'unchanged': int(len(df) - new.sum() - changed.sum())}
+
+        removed = df.iloc[:0]
+        if changed.any():
+            removed = self.remove_rows(keys[changed], stored_files[changed])
+
+        write = new | changed
+        if write.any():
+            entries, files = self.write_rows(df[write])
+            self.index.add(keys[write], files, contents[write])
+
+            if watermark:
+                self.advance_watermark(df.loc[write, 'reported_date'].max())
+            #counts ingests that changed the rows, rollups record the last one they include
+            self.manifest['ingest'] = self.ingest + 1
+        self.save_manifest()
+
+        if write.any():
+            #rollups see the rows as they are read back, with the stored location attributes
+            added = df[write]
+            if 'location' in added:
+                added = self.join_locations(added.assign(location_id=self.locations.find(added['location'])))
+                added = added.drop(columns='location_id')
+            for rollup in self.rollups:
+                rollup.update(added, removed)
+        return counts
+
+    def remove(self, df):
+        """
+        Removes the stored rows with the keys of the rows of df; keys not in the store are ignored.
+        The partitions holding them are rewritten copy-on-write and attached rollups subtract them.
+
+        returns the number of rows removed
+        """
+        if not len(df):
+            return 0
+        keys = np.unique(row_keys(apply_schema(df)))
+        files, contents = self.index.lookup(keys)
+        stored = files >= 0
+        if not stored.any():
+            return 0
+        removed = self.remove_rows(keys[stored], files[stored])
+        self.index.add(keys[stored], np.full(stored.sum(), -1), np.zeros(stored.sum(), dtype='uint64'))
+        self.manifest['ingest'] = self.ingest + 1
+        self.save_manifest()
+        for rollup in self.rollups:
+            rollup.update(removed.iloc[:0], removed)
+        return len(removed)
+
+    def split_non_offenses(self):
+        """
+        Moves the non offense rows of a store written before the split into a non offense store
+        of their own; a no-op for stores that already have one
+
+        returns the number of rows moved
+        """
+        if self.non_offenses is not None:
+            return 0
+        non_offenses = MasterStore(os.path.join(self.store_dir, non_offense_dir), non_offenses=False)
+        moved = []
+        if len(self):
+            master = self.load()
+            moved = master[is_non_offense(master)]
+            #a run cut off here moves the rows again, appending them a second time leaves them unchanged
+            non_offenses.append(moved)
+            self.remove(moved)
+        self.manifest['non_offenses'] = non_offense_dir
+        self.non_offenses = non_offenses
+        self.save_manifest()
+        return len(moved)
+
+    def update_locations(self, df):
+        """
+        Sets the lat, lon, neighborhood and city of locations already in the store, e.g. after
+        geocoding them again; only the location dimension is written, no partition is
+
+        df: DataFrame with a location column and any of lat, lon, neighborhood, city
+
+        returns the number of rows of df whose location is in the store
+        """
+        ids = self.locations.find(df['location'])
+        known = ids >= 0
+        self.locations.update(ids[known], df[known])
+        if self.locations.changed:
+            #rollups and readers caching the location columns pick the change up as a new ingest
+            self.manifest['ingest'] = self.ingest + 1
+            self.save_manifest()
+            for rollup in self.rollups:
+                rollup.rebuild()
+        if self.non_offenses is not None:
+            self.non_offenses.update_locations(df)
+        return int(known.sum())
+
+    def files(self, start=None, end=None, manifest=None):
+        """
+        Returns the manifest entries whose rows may fall between start and end (inclusive)
+        """
+        if manifest is None:
+            manifest = self.manifest
+        start = None if start is None else pd.Timestamp(start)
+        end = None if end is None else pd.Timestamp(end)
+        entries = []
+        for entry in manifest['files']:
+            if start is not None and pd.Timestamp(entry['max_date']) < start:
+                continue
+            if end is not None and pd.Timestamp(entry['min_date']) > end:
+                continue
+            entries.append(entry)
+        return entries
+
+    def load(self, start=None, end=None, columns=None, snapshot=None):
+        """
+        Reads the store (or a snapshot of it) into one DataFrame sorted newest first,
+        like pvd_crime_master.csv
+
+        start, end: only read partitions, and return rows, with reported_date in this range
+        columns: only read these columns
+        snapshot: name of a snapshot to read instead of the current manifest
+        """
+        manifest = self.read_snapshot(snapshot) if snapshot is not None else self.manifest
+        locations = self.locations
+        if manifest.get('locations') != self.locations.name:
+            locations = LocationTable(self.locations.table_dir, manifest.get('locations'))
+        usecols = None
+        if columns is not None:
+            usecols = list(dict.fromkeys(list(columns) + ['reported_date']))
+
+        frames = []
+        for entry in self.files(start, end, manifest):
+            file_columns = usecols
+            if usecols is not None and 'columns' in entry:
+                file_columns = [column for column in usecols if column in entry['columns']]
+            #location columns of partitions holding location_id come from the dimension
+            wanted = dimension_columns
+            if 'location_id' in entry.get('columns', []):
+                if file_columns is not None:
+                    wanted = [column for column in file_columns if column in dimension_columns]
+                    file_columns = [column for column in file_columns if column not in dimension_columns]
+                    file_columns = list(dict.fromkeys(file_columns + (['location_id'] if wanted else [])))
+            rows = read_file(os.path.join(self.store_dir, entry['path']), file_columns, start, end)
+            frames.append(self.join_locations(rows, locations, wanted))
+        if not frames:
+            return pd.DataFrame(columns=usecols)
+        #categories differ between files, concat falls back to object so the schema is applied after
+        master = apply_schema(pd.concat(frames, ignore_index=True))
+
+        if start is not None:
+            master = master[master['reported_date'] >= pd.Timestamp(start)]
+        if end is not None:
+            master = master[master['reported_date'] <= pd.Timestamp(end)]
+
+        master = master.sort_values('reported_date', ascending=False, kind='mergesort')
+        master.reset_index(inplace=True, drop=True)
+        if columns is not None:
+            master = master[list(columns)]
+        elif 'location_id' in master:
+            #ids are internal to the store, the master keeps the pvd_crime_master.csv columns
+            master = master.drop(columns='location_id')
+        return master
+
+    def snapshot(self, name=None):
+        """
+        Archives the current state of the store by saving a copy of the manifest;
+        partition files are immutable so the listed files are the archived data
+
+        returns the snapshot name
+        """
+        if name is None:
+            name = dt.datetime.now().strftime('%m_%d_%Y')
+        snapshot_dir = os.path.join(self.store_dir, 'snapshots')
+        os.makedirs(snapshot_dir, exist_ok=True)
+        write_json(os.path.join(snapshot_dir, name+'_manifest.json'), self.manifest)
+        if self.non_offenses is not None:
+            self.non_offenses.snapshot(name)
+        return name
+
+    def has_snapshot(self, name):
+        return os.path.exists(os.path.join(self.store_dir, 'snapshots', name+'_manifest.json'))
+
+    def read_snapshot(self, name):
+        with open(os.path.join(self.store_dir, 'snapshots', name+'_manifest.json')) as f:
+            return json.load(f)
+
+    def compact(self, month):
+        """
+        Merges the delta files of one month into a single file in the store's current format
+        (a single file in another format is rewritten too). The old files are left on
+        disk because snapshots may still list them.
+        """
+        entries = [entry for entry in self.manifest['files'] if entry['month'] == month]
+        file_format = '.' + self.manifest.get('format', 'csv')
+        if len(entries) < 2 and all(entry['path'].endswith(file_format) for entry in entries):
+            return
+        rows = apply_schema(pd.concat([self.read_partition(entry) for entry in entries], ignore_index=True))
+
+        merged = self.write_partition(month, rows)
+        self.manifest['files'] = [entry for entry in self.manifest['files'] if entry['month'] != month] + [merged]
+        self.index.add(row_keys(rows), np.full(len(rows), merged['file']), row_contents(rows))
+        self.save_manifest()
+
+    def compact_all(self):
+        """
+        Compacts every month, which also converts the store to its current file format
+        """
+        for month in sorted(set(entry['month'] for entry in self.manifest['files'])):
+            self.compact(month)
+        if self.non_offenses is not None:
+            self.non_offenses.compact_all()
+
+    def export_csv(self, master_file='pvd_crime_master.csv', snapshot=None):
+        """
+        Writes the whole store (or a snapshot of it) as one csv in the pvd_crime_master.csv
+        format; the non offense rows are written with the offenses, as the csv always held both
+        """
+        frames = [self.load(snapshot=snapshot)]
+        if self.non_offenses is not None and (snapshot is None or self.non_offenses.has_snapshot(snapshot)):
+            frames.append(self.non_offenses.load(snapshot=snapshot))
+        master = frames[0]
+        if len(frames) > 1 and len(frames[1]):
+            master = pd.concat(frames, ignore_index=True).sort_values('reported_date', ascending=False, kind='mergesort')
+        master.to_csv(master_file, index=False)
+        return master_file
+
+def open_store(store_dir='crime_store', master_file='pvd_crime_master.csv'):
+    """
+    Opens the master store, creating it from master_file the first time
+    """
+    store = MasterStore(store_dir)
+    if not store.exists():
+        master = pd.read_csv(master_file)
+        if 'neighborhood' in master:
+            #older runs stored google's neighborhood names; imported here, the shapefile reader
+            #is not needed to read the store
+            from neighborhoods import harmonize_names
+            master = master.assign(neighborhood=harmonize_names(master['neighborhood']).values)
+        store.append(master)
+    elif store.non_offenses is None:
+        store.split_non_offenses()
+    return store
+
+def newest_reported_date(store_dir='crime_store', master_file='pvd_crime_master.csv'):
+    """
+    The ingest watermark of the master store, or the newest reported_date of master_file when the
+    store has not been created yet; unlike open_store it never writes the store
+
+    returns Timestamp, None when there are no rows
+    """
+    manifest_file = os.path.join(store_dir, 'manifest.json')
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            date = json.load(f)['max_reported_date']
+    else:
+        date = pd.to_datetime(pd.read_csv(master_file, usecols=['reported_date'])['reported_date']).max()
+    return None if pd.isnull(date) else pd.Timestamp(date)
+
+def load_master(columns=None, start=None, end=None, store_dir='crime_store', non_offenses=False):
+    """
+    Reads the crime master from the store with native dtypes; the replacement for
+    pd.read_csv('pvd_crime_master.csv') followed by pd.to_datetime
+
+    columns: only read these columns, e.g. ['offense_cat', 'reported_date']
+    start, end: only read rows with reported_date in this range
+    non_offenses: read the non offense rows (counts == 0) instead of the offenses
+
+    returns DataFrame sorted newest first
+    """
+    store = MasterStore(store_dir)
+    if non_offenses:
+        if store.non_offenses is None:
+            raise ValueError(store_dir+' has no non offense store yet, open it with open_store to split it')
+        store = store.non_offenses
+    return store.load(start=start, end=end, columns=columns)
@@ -0,0 +1,172 @@
+import numpy as np
+import pandas as pd
+import shapefile
+
+#Vectorized point in polygon neighborhood labels from hood_shapefile/.
+#The polygons' bounding box is cut into a grid; cells that no polygon edge passes through
+#are labeled once from their center, so most points are labeled with a single array lookup
+#and only points in cells on a neighborhood border are ray cast against the polygons.
+
+#google's neighborhood names and the shapefile's names for the same place
+google_to_shapefile = {'West End Providence': 'West End', 'Ward 13': 'Federal Hill',
+                       'Downtown Providence': 'Downtown', 'Jewelry District': 'Downtown'}
+
+def harmonize_names(neighborhoods):
+    """
+    Takes a Series of neighborhood names and returns it with google's names replaced
+    by the names used in hood_shapefile/pvd.shp
+    """
+    return pd.Series(neighborhoods).replace(google_to_shapefile)
+
+def load_rings(shp_file, name_field):
+    """
+    Reads a polygon shapefile and returns a list of (name, rings) where rings is a list of
+    (n, 2) arrays of x, y points, one per ring (outer boundaries and holes)
+    """
+    sf = shapefile.Reader(shp_file)
+    name_index = [field[0] for field in sf.fields[1:]].index(name_field)
+    polygons = []
+    for record, shape in zip(sf.records(), sf.shapes()):
+        points = np.array(shape.points, dtype='float64')
+        rings = [points[start:stop] for start, stop in zip(shape.parts, list(shape.parts[1:]) + [len(points)])]
+        polygons.append((record[name_index], rings))
+    return polygons
+
+def load_polygons(shp_file, name_field):
+    """
+    Reads a polygon shapefile and returns a list of (name, edges) where edges is an (n, 4)
+    array of x1, y1, x2, y2 segments covering every ring of the shape
+    """
+    return [(name, np.vstack([np.hstack([ring, np.roll(ring, -1, axis=0)]) for ring in rings]))
+            for name, rings in load_rings(shp_file, name_field)]
+
+def points_in_polygon(x, y, edges, chunk_size=20000):
+    """
+    Even-odd ray casting of many points against one polygon's edges (holes included)
+
+    returns boolean array, True where (x, y) is inside
+    """
+    inside = np.zeros(len(x), dtype=bool)
+    x1, y1, x2, y2 = edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+    for start in range(0, len(x), chunk_size):
+        px = x[start:start+chunk_size, None]
+        py = y[start:start+chunk_size, None]
+        straddles = (y1 > py) != (y2 > py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cross_x = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        crossings = (straddles & (px < cross_x)).sum(axis=1)
+        inside[start:start+chunk_size] = crossings % 2 == 1
+    return inside
+
+class NeighborhoodAssigner(object):
+    """
+    Labels lat/lon arrays with the neighborhood polygon they fall in
+
+    shp_file: polygon shapefile of neighborhoods
+    name_field: attribute holding the neighborhood name
+    fallback_file: optional second shapefile (e.g. the Zillow RI neighborhoods) used for points
+        outside every polygon of shp_file
+    fallback_name_field: name attribute of fallback_file
+    grid_size: number of grid cells along each side of the bounding box
+    """
+    def __init__(self, shp_file='hood_shapefile/pvd.shp', name_field='lname', fallback_file=None,
+                 fallback_name_field='Name', grid_size=256):
+        polygons = load_polygons(shp_file, name_field)
+        self.names = np.array([name for name, edges in polygons] + [np.nan], dtype=object)
+        self.edges = [edges for name, edges in polygons]
+        self.bboxes = np.array([[e[:, 0].min(), e[:, 1].min(), e[:, 0].max(), e[:, 1].max()] for e in self.edges])
+
+        self.fallback = None
+        if fallback_file is not None:
+            self.fallback = NeighborhoodAssigner(fallback_file, fallback_name_field, grid_size=grid_size)
+
+        self.grid_size = grid_size
+        self.build_grid()
+
+    def build_grid(self):
+        #grid over the union of the polygons' bounding boxes
+        self.x0, self.y0 = self.bboxes[:, 0].min(), self.bboxes[:, 1].min()
+        self.dx = (self.bboxes[:, 2].max() - self.x0) / self.grid_size
+        self.dy = (self.bboxes[:, 3].max() - self.y0) / self.grid_size
+
+        #cells an edge passes through; edges are sampled at under half a cell so no cell is skipped,
+        #then the marks are grown by one cell to cover segments that clip a cell corner
+        boundary = np.zeros((self.grid_size, self.grid_size), dtype=bool)
+        for edges in self.edges:
+            lengths = np.maximum(np.abs(edges[:, 2] - edges[:, 0]) / self.dx, np.abs(edges[:, 3] - edges[:, 1]) / self.dy)
+            steps = np.ceil(lengths * 2).astype('int64') + 1
+            edge_ids = np.repeat(np.arange(len(edges)), steps)
+            t = np.concatenate([np.linspace(0, 1, n) for n in steps])
+            xs = edges[edge_ids, 0] + t * (edges[edge_ids, 2] - edges[edge_ids, 0])
+            ys = edges[edge_ids, 1] + t * (edges[edge_ids, 3] - edges[edge_ids, 1])
+            i, j, valid = self.cells(xs, ys)
+            boundary[i[valid], j[valid]] = True
+        grown = boundary.copy()
+        grown[1:, :] |= boundary[:-1, :]
+        grown[:-1, :] |= boundary[1:, :]
+        grown[:, 1:] |= boundary[:, :-1]
+        grown[:, :-1] |= boundary[:, 1:]
+        self.boundary = grown
+
+        #every other cell lies wholly inside one polygon (or none), its center gives the label
+        i, j = np.nonzero(~self.boundary)
+        cell_labels = np.full((self.grid_size, self.grid_size), -1, dtype='int64')
+        cell_labels[i, j] = self.ray_cast(self.x0 + (j + 0.5) * self.dx, self.y0 + (i + 0.5) * self.dy)
+        self.cell_labels = cell_labels
+
+    def cells(self, x, y):
+        #grid row/column of each point and whether it falls inside the grid at all (NaNs fall outside)
+        x = np.where(np.isnan(x), self.x0 - self.dx, x)
+        y = np.where(np.isnan(y), self.y0 - self.dy, y)
+        i = np.floor((y - self.y0) / self.dy).astype('int64')
+        j = np.floor((x - self.x0) / self.dx).astype('int64')
+        valid = (i >= 0) & (i < self.grid_size) & (j >= 0) & (j < self.grid_size)
+        return np.clip(i, 0, self.grid_size - 1), np.clip(j, 0, self.grid_size - 1), valid
+
+    def ray_cast(self, x, y):
+        #polygon id of each point, -1 for none; only points inside a polygon's bbox are tested against it
+        labels = np.full(len(x), -1, dtype='int64')
+        for polygon_id, (edges, bbox) in enumerate(zip(self.edges, self.bboxes)):
+            candidates = np.flatnonzero((labels == -1) & (x >= bbox[0]) & (x <= bbox[2]) & (y >= bbox[1]) & (y <= bbox[3]))
+            if len(candidates):
+                inside = points_in_polygon(x[candidates], y[candidates], edges)
+                labels[candidates[inside]] = polygon_id
+        return labels
+
+    def polygon_ids(self, lat, lon):
+        x = np.asarray(lon, dtype='float64')
+        y = np.asarray(lat, dtype='float64')
+        i, j, valid = self.cells(x, y)
+
+        labels = np.full(len(x), -1, dtype='int64')
+        labels[valid] = self.cell_labels[i[valid], j[valid]]
+        on_border = np.flatnonzero(valid & self.boundary[i, j])
+        labels[on_border] = self.ray_cast(x[on_border], y[on_border])
+        return labels
+
+    def assign(self, lat, lon):
+        """
+        Labels arrays of latitudes and longitudes in one vectorized pass
+
+        returns numpy object array of neighborhood names, NaN outside every polygon
+        """
+        names = self.names[self.polygon_ids(lat, lon)]
+        if self.fallback is not None:
+            outside = pd.isnull(names)
+            if outside.any():
+                names[outside] = self.fallback.assign(np.asarray(lat)[outside], np.asarray(lon)[outside])
+        return names
+
+    def label_df(self, df, overwrite=False):
+        """
+        Fills the neighborhood column of a DataFrame with lat and lon columns;
+        with overwrite every row whose point falls in a polygon is relabeled
+
+        returns the DataFrame with the new neighborhood column
+        """
+        names = pd.Series(self.assign(df['lat'].values, df['lon'].values), index=df.index)
+        if 'neighborhood' not in df:
+            return df.assign(neighborhood=names)
+        if overwrite:
+            return df.assign(neighborhood=names.fillna(df['neighborhood']))
+        return df.assign(neighborhood=df['neighborhood'].fillna(names))
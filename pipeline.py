@@ -0,0 +1,76 @@
+import os
+
+import pandas as pd
+
+#Generator based, fixed chunk size pipeline plumbing for create_crime_log.
+#Each stage takes an iterator of DataFrames and yields DataFrames, so only a few chunks
+#are alive at once however many rows the api returns.
+
+def rechunk(chunks, chunk_size):
+    """
+    Takes an iterator of DataFrames of any size and yields DataFrames of exactly chunk_size rows
+    (the last one may be smaller)
+    """
+    pending = []
+    pending_rows = 0
+    for chunk in chunks:
+        while len(chunk):
+            take = chunk.iloc[:chunk_size - pending_rows]
+            chunk = chunk.iloc[len(take):]
+            pending.append(take)
+            pending_rows += len(take)
+            if pending_rows == chunk_size:
+                yield pd.concat(pending, ignore_index=True)
+                pending, pending_rows = [], 0
+    if pending_rows:
+        yield pd.concat(pending, ignore_index=True)
+
+def stage(function, chunks, **kwargs):
+    """
+    Applies function(chunk, **kwargs) to every chunk, skipping empty chunks
+    """
+    for chunk in chunks:
+        if len(chunk):
+            yield function(chunk, **kwargs)
+
+def run(chunks, *sinks):
+    """
+    Drains the pipeline, handing every chunk to each sink in turn
+
+    returns the number of rows that went through
+    """
+    rows = 0
+    for chunk in chunks:
+        for sink in sinks:
+            sink(chunk)
+        rows += len(chunk)
+    return rows
+
+class CsvSink(object):
+    """
+    Appends chunks to one csv file, writing the header with the first chunk
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.columns = None
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def __call__(self, chunk):
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+            chunk.to_csv(self.filename, index=False)
+        else:
+            chunk.reindex(columns=self.columns).to_csv(self.filename, mode='a', header=False, index=False)
+
+class StoreSink(object):
+    """
+    Upserts chunks into a master_store.MasterStore and keeps running insert/update counts
+    """
+    def __init__(self, store):
+        self.store = store
+        self.counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+    def __call__(self, chunk):
+        for key, value in self.store.append(chunk).items():
+            self.counts[key] += value
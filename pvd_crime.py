@@ -1,53 +1,95 @@
-import config
-import requests
 import pandas as pd
 import numpy as np
 import datetime as dt
-
-from do_geocode import geocode_addresses, update_address_csv
+import argparse
+import json
+
+from do_geocode import (geocode_addresses, update_address_csv, GeocodeCache, GeocoderChain, IndexBackend,
+                        CacheBackend, NominatimBackend, GoogleBackend)
+from crime_fetch import fetch_chunks, create_session
+from address_index import AddressIndex
+from street_resolver import StreetResolver
+from neighborhoods import NeighborhoodAssigner, harmonize_names
+from master_store import open_store, newest_reported_date, is_non_offense
+from rollups import RollupCube
+from spatial_bins import SpatialBins
+from map_tiles import MapArtifacts
+from query_service import notify_reload, default_service_url
+import pipeline
+from run_report import RunReport
+from transforms import violent_crime, property_crime, classify_offenses, parse_reported_dates, intern_locations
 
 #Set of functions used to get and clean josn data from the city of Providence crime log API. 
 #Could be modified to work with other data;
 
-violent_crime = ['Assault, Aggravated', 'Murder\\Manslaughter', 'Statutory Rape', 'Assault, Threats']
+def config_value(name, value=None):
+    """
+    Returns value, or the setting name of config.py when value is None; config.py holds the
+    private api keys and is imported the first time a setting is needed, not when this module is
+    """
+    if value is not None:
+        return value
+    import config
+    return getattr(config, name, None)
+
+
+def create_df_chunks(link=None, key=None, master_file = 'pvd_crime_master.csv',
+                     store_dir='crime_store', page_size=5000, max_workers=4, mode='offset', cursor_file='crime_log_runs/fetch_cursor.json',
+                     session=None):
+    """
+    Retrives json data from an api one page at a time and yields each page as a pandas DataFrame
+
+    link: link for json api data, config.api_link if None
+    key: user key for api, config.api_key if None
+    master_file: csv the master store is created from, its newest row is the start before that
+    store_dir: directory of the master store, see master_store.MasterStore; not created here
+    page_size: number of rows in each page request
+    max_workers: number of page requests in flight at once
+    mode: 'offset' or 'keyset' paging, see crime_fetch.fetch_chunks
+    cursor_file: resume cursor saved after each page, a killed run restarts from the last page
+    session: requests.Session to fetch with, see crime_fetch.create_session
+
+    returns: generator of DataFrames
+    """
+    #only want reports we don't already have, so what is the most recent date in the master
+    most_recent = newest_reported_date(store_dir, master_file)
+    #a run stopped between two chunks may have stored only some of the rows sharing that date,
+    #so they are fetched again and the upsert finds the stored ones unchanged; the api's dates are
+    #whole seconds, so > most_recent - 1s is >= most_recent
+    since = None if most_recent is None else pd.Timestamp(most_recent) - pd.Timedelta(seconds=1)
 
-property_crime = ['Larceny from Motor Vehicle', 'Vandalism', 'Larceny from Building', 'Burglary',
-                  'Robbery', 'Larceny, Other', 'Larceny, Purse-snatching', 'Motor Vehicle Theft',
-                  'Larceny, Shoplifting', 'Tresspassing', 'Arson']
+    return fetch_chunks(config_value('api_link', link), key=config_value('api_key', key), since=since,
+                        page_size=page_size, max_workers=max_workers, mode=mode, cursor_file=cursor_file,
+                        session=session)
 
-def create_df(link=config.api_link, key=config.api_key, master_file = 'pvd_crime_master.csv'):
+def create_df(link=None, key=None, master_file = 'pvd_crime_master.csv', **fetch_args):
     """
     Retrives json data from an api and return it as a pandas DataFrame
     
-    link: link for json api data
-    key: user key for api
-    limit: number of rows to return
+    link: link for json api data, config.api_link if None
+    key: user key for api, config.api_key if None
+    fetch_args: paging options passed on to create_df_chunks
     
     returns: DataFrame
     """
-    #only want reports we don't already have, so what is the most recent date in the master
-    master = pd.read_csv(master_file, nrows=1)
-    most_recent = pd.to_datetime(master['reported_date'])[0]
-    most_recent_format = most_recent.strftime('%Y-%m-%dT%H:%M:%S.000')
-
-    headers = {'Authentication': key} #api_key
-    
-    query = "SELECT * WHERE reported_date > '"+most_recent_format+"' ORDER BY reported_date LIMIT 13000"
-
-    params = {'$query': query}
+    #the pages are only held in memory, so a failed fetch starts over; a resume cursor would
+    #skip pages that were never saved (stream_crime_log stores every page before the next)
+    chunks = list(create_df_chunks(link=link, key=key, master_file=master_file, cursor_file=None, **fetch_args))
+    if not chunks:
+        return pd.DataFrame()
 
-    response = requests.get(link, headers=headers, params=params) #json data
-    response_json = response.json() #json data as list of dictionaries
-    
     #create and return pandas DataFrame of json response
-
-    return pd.DataFrame(response_json)
+    return pd.concat(chunks, ignore_index=True)
 
 def split_no_offense(df):
-    df['counts'] = pd.to_numeric(df['counts'])
-    no_offense = df[df['counts']==0]
-    df = df[df['counts']>0]
-    return no_offense
+    """
+    Splits crime log rows into offenses and non offenses (counts == 0); the master store keeps
+    the two in separate stores, see master_store.MasterStore
+
+    returns (offenses DataFrame, non offenses DataFrame)
+    """
+    no_offense = is_non_offense(df)
+    return df[~no_offense], df[no_offense]
 
 def classify_crime_helper(crime, violent_crime=violent_crime, property_crime=property_crime):
     if crime in violent_crime:
@@ -58,8 +100,8 @@ def classify_crime_helper(crime, violent_crime=violent_crime, property_crime=pro
         return 'other_crime'
 
 def classify_crime(df):
-    classified = df.offense_desc.apply(classify_crime_helper)
-    return df.assign(offense_cat=pd.Series(classified).values)
+    classified = classify_offenses(df['offense_desc'])
+    return df.assign(offense_cat=np.asarray(classified))
 
 def parse_dates(df, args=("%Y-%m-%dT%H:%M:%S.%f",)):
     """
@@ -75,12 +117,9 @@ def parse_dates(df, args=("%Y-%m-%dT%H:%M:%S.%f",)):
 
     Default column and args correspond to the Providence crime log api formating.
     """
-    try:
-        datetime_col = df['reported_date'].apply(dt.datetime.strptime, args=args)
-    except  ValueError:
-        datetime_col = pd.to_datetime(df.reported_date)
+    datetime_col = parse_reported_dates(df['reported_date'], date_format=args[0])
 
-    return df.assign(reported_date=pd.Series(datetime_col).values)
+    return df.assign(reported_date=datetime_col.values)
 
 def clean_location(df):
     """
@@ -88,96 +127,319 @@ def clean_location(df):
     in a format that matches the OpenAddresses dataset and is more usable by the geolocators
     
     df: pandas DataFrame
-    column: name of column in df containing address strings
 
-    returns series object of column with formatted addresses
-    use: df['column'] = clean_location(df, 'column') 
+    returns the DataFrame with location as a Categorical of canonical addresses;
+    the category codes are the interned location ids the geocoding join runs on
+    use: df = clean_location(df)
 
     Default column corresponds to the Providence crime log api formating.
+    Rules are in transforms.normalize_locations: title case (as in the OpenAddresses dataset),
+    X St At Y St for X & Y or X/Y (geocoders read it better), abbreviated street suffixes,
+    no unit suffixes or extra whitespace. Each distinct string is normalized once.
     """
-    
-    local = df['location'].astype(str)
-    
-    #geocoders read X St at Y St better than X & Y or X/Y
-    local = local.str.replace("&", "at")
-    local = local.str.replace("/", "at")
-    
-   #OpenAddress dataset has addresses in title case
-    local = local.str.title()
+    ids, table = intern_locations(df['location'])
+
+    return df.assign(location=pd.Categorical.from_codes(ids, categories=table))
 
-    return df.assign(location=local.values)
+def geocoder_chain(google_key, address_index=None, street_resolver=None, cache=None,
+                   nominatim_link='config', geocoder='async', locations=None):
+    """
+    Builds the geocoder chain used by get_lat_lon, cheapest backend first; the master store's
+    location dimension (if locations is given), the OpenAddresses index, the street resolver,
+    the geocode cache, a local Nominatim server (skipped if nominatim_link is None) and google
+
+    google_key: your api key to the google maps api
+    address_index: address_index.AddressIndex, loaded from open_addresses/ if None
+    street_resolver: street_resolver.StreetResolver, loaded from open_addresses/ if None
+    cache: do_geocode.GeocodeCache, the default on disk cache is opened if None
+    nominatim_link: search endpoint of a Nominatim server, config.nominatim_link if 'config'
+    geocoder: batch google geocoder; 'async' for an async_geocode.AsyncGeocoder (serial requests when
+        aiohttp is not installed), None for serial requests
+    locations: locations.LocationTable of the master store, e.g. open_store().locations
+
+    returns do_geocode.GeocoderChain
+    """
+    if address_index is None:
+        address_index = AddressIndex()
+    if street_resolver is None:
+        street_resolver = StreetResolver()
+    if cache is None:
+        cache = GeocodeCache()
+    if nominatim_link == 'config':
+        nominatim_link = config_value('nominatim_link')
+    if geocoder == 'async':
+        try:
+            from async_geocode import AsyncGeocoder
+            geocoder = AsyncGeocoder(google_key)
+        except ImportError:
+            geocoder = None
+
+    #locations already in the store resolve to their stored attributes first, so new rows at a
+    #known address agree with the rows the store already joins to it
+    backends = []
+    if locations is not None:
+        backends.append(IndexBackend(locations.lookup, 'locations'))
+    backends += [IndexBackend(address_index.lookup, 'address_index'),
+                 IndexBackend(street_resolver.resolve, 'street_resolver'),
+                 CacheBackend(cache)]
+    if nominatim_link is not None:
+        backends.append(NominatimBackend(nominatim_link))
+    backends.append(GoogleBackend(google_key, geocoder=geocoder))
+    return GeocoderChain(backends)
+
+def save_geocode_stats(chain, filename):
+    """
+    Writes the per backend geocoding stats of a run (hits, latency histogram, paid calls) to a json file
+    """
+    with open(filename, 'w') as f:
+        json.dump(chain.stats(), f, indent=1)
 
-def get_lat_lon(df, google_key, addresses_provided=False):
+def get_lat_lon(df, google_key, address_index=None, street_resolver=None, cache=None, neighborhoods=None, chain=None):
+    """
+    Adds lat, lon, neighborhood and city columns for the addresses in the location column
 
-    parsable = df[df.location.notnull()]
-    addresses = df.location.values
-    address_df = geocode_addresses(addresses, key=config.google_key)
-    
-    df = df.merge(address_df, how='left', on='location', left_index=True)
+    Each distinct location (one interned id, see clean_location) goes through the geocoder
+    chain; the OpenAddresses index and the street resolver (intersections, house numbers
+    missing from OpenAddresses) answer most of them locally and only what is left reaches
+    the cache, Nominatim and google. Results are joined back to the rows by id.
+
+    df: pandas DataFrame
+    google_key: your api key to the google maps api
+    address_index, street_resolver, cache: used to build the chain when chain is None,
+        see geocoder_chain
+    neighborhoods: neighborhoods.NeighborhoodAssigner labeling rows google gave no neighborhood,
+        loaded from hood_shapefile/ if None
+    chain: do_geocode.GeocoderChain, pass one to reuse its backends and stats across calls
+
+    returns the DataFrame with the new columns
+    """
+    if chain is None:
+        chain = geocoder_chain(google_key, address_index, street_resolver, cache)
+
+    #geocode each interned location once and join back on the ids
+    locations = df['location']
+    if not isinstance(locations.dtype, pd.CategoricalDtype):
+        locations = locations.astype(str).where(locations.notnull()).astype('category')
+    table = locations.cat.categories
+    ids = locations.cat.codes.values
+    address_df = geocode_addresses(table, key=google_key, chain=chain).drop_duplicates('location')
+    address_df = address_df.set_index('location').reindex(table.astype(str))
+    #id -1 (no location) picks the appended nan
+    df = df.assign(**{column: np.append(address_df[column].values, np.nan)[ids]
+                      for column in ['lat', 'lon', 'neighborhood', 'city']})
+
+    #rows resolved locally (or without a google neighborhood) get the polygon they fall in
+    if neighborhoods is None:
+        neighborhoods = NeighborhoodAssigner()
+    df = neighborhoods.label_df(df)
+    #google's names for the shapefile's neighborhoods, so one neighborhood is one value
+    df = df.assign(neighborhood=harmonize_names(df['neighborhood']).values)
 
     return df
 
-def add_to_master(df, today, master_file = 'pvd_crime_master.csv'):
+def add_to_master(df, today, master_file = 'pvd_crime_master.csv', store_dir='crime_store', export_csv=False,
+                  map_dir='map_tiles', service_url=default_service_url):
+    """
+    Appends the new rows to the master store; only the new rows are written
 
-    #read in masters
-    master = pd.read_csv(master_file)
+    df: pandas DataFrame of new crime log rows
+    today: name of the archive snapshot taken after the append
+    master_file: csv the store is created from on the first run, and the export target
+    store_dir: directory of the master store
+    export_csv: also rewrite master_file from the store, for consumers still reading the csv
+    map_dir: directory of the map tiles and choropleths, only changed ones are rewritten; None to skip
+    service_url: query service told to load the new rows, if one is running; None to skip
 
+    returns the master_store.MasterStore
+    """
+    store = open_store(store_dir, master_file)
+    #the dashboard cube and heatmap bins get only the new and corrected rows
+    cube = RollupCube(store)
+    bins = SpatialBins(store)
+    RollupCube(store.non_offenses)
+    store.append(df)
 
-    archive_master = 'master_archive/'+today+'_'+master_file
+    if map_dir is not None:
+        MapArtifacts(bins, cube, map_dir).generate()
+    if service_url is not None:
+        notify_reload(service_url)
 
-    master.to_csv(archive_master, index=False)
+    #archives are manifest snapshots, the partition files they list are never rewritten
+    store.snapshot(today)
 
-    #merge new data and old
-    master = pd.concat([df,master])
-    master = parse_dates(master)
+    if export_csv:
+        store.export_csv(master_file)
+    return store
 
-    master.sort_values('reported_date', ascending=False, inplace=True)
-    master.reset_index(inplace=True, drop=True)
 
-    master.to_csv(master_file, index=False)
-    return master
+def instrument(report, key, max_workers=4):
+    """
+    Returns a requests Session for the api whose calls are counted in the run report
+    """
+    session = create_session(key, pool_size=max_workers)
+    report.http('socrata', session)
+    return session
+
+def instrument_chain(report, chain):
+    #the Nominatim backend keeps a session; google calls are timed by the backends themselves
+    for backend in chain.backends:
+        if hasattr(backend, 'session'):
+            report.http(backend.name, backend.session)
+    report.add_geocoder(chain)
+
+def create_crime_log(link=None, key=None, google_key=None, master_file = 'pvd_crime_master.csv',
+                     store_dir='crime_store', return_recent_only=False, only_create_csv=False, export_csv=False,
+                     chunk_size=None, profile=False, map_dir='map_tiles', service_url=default_service_url,
+                     page_size=None, mode='offset'):
+    """
+    Fetches the crime log rows newer than the master, classifies, cleans and geocodes them and
+    adds them to the master store
+
+    link, key, google_key: api link and keys, read from config.py when None
+    chunk_size: process the rows in chunks of this many, see stream_crime_log
+    page_size: rows per api page request, default 5000 (chunk_size when streaming)
+    mode: 'offset' or 'keyset' api paging, see crime_fetch.fetch_chunks
+    map_dir: directory of the map tiles and choropleths, see add_to_master; None to skip
+    service_url: query service told to load the new rows, see add_to_master; None to skip
+    profile: also run cProfile and tracemalloc; the run report then lists the slowest functions
+        and largest allocations and the profile is saved to crime_log_runs/<date>run_report.prof
+
+    Every run writes crime_log_runs/<date>run_report.json with the wall time, rows in and out and
+    memory growth of each stage and the http calls made, see run_report.RunReport
+    """
+    if chunk_size is not None:
+        return stream_crime_log(link=link, key=key, google_key=google_key, master_file=master_file,
+                                store_dir=store_dir, return_recent_only=return_recent_only,
+                                only_create_csv=only_create_csv, export_csv=export_csv, chunk_size=chunk_size,
+                                profile=profile, map_dir=map_dir, service_url=service_url, page_size=page_size,
+                                mode=mode)
 
+    link, key, google_key = config_value('api_link', link), config_value('api_key', key), \
+        config_value('google_key', google_key)
 
+    #get todays date for crime log csv save
+    today = dt.datetime.now().strftime("%m_%d_%Y")
+    report = RunReport('create_crime_log', profile=profile)
 
-def create_crime_log(link=config.api_link, key=config.api_key, google_key=config.google_key, master_file = 'pvd_crime_master.csv',return_recent_only=False, only_create_csv=False):
-    #request json from api and return as pandas dataframe
-    pvd_crime_log = create_df(link=link, key=key, master_file=master_file)
+    #the report is written even when a stage raises, with the failed stage's error
+    try:
+        #request json from api and return as pandas dataframe
+        pvd_crime_log = report.call('fetch', create_df, link=link, key=key, master_file=master_file,
+                                    store_dir=store_dir, page_size=5000 if page_size is None else page_size,
+                                    mode=mode, session=instrument(report, key))
     
-    #add column classifying the type of offense
-    pvd_crime_log = classify_crime(pvd_crime_log)
+        #add column classifying the type of offense
+        pvd_crime_log = report.call('classify', classify_crime, pvd_crime_log)
 
-    #convert report_date column from strings to pandas datetime objects
-    pvd_crime_log = parse_dates(pvd_crime_log)
+        #convert report_date column from strings to pandas datetime objects
+        pvd_crime_log = report.call('parse_dates', parse_dates, pvd_crime_log)
     
-    #parse addresses in location column to google api format
-    pvd_crime_log = clean_location(pvd_crime_log)
+        #parse addresses in location column to google api format
+        pvd_crime_log = report.call('clean_location', clean_location, pvd_crime_log)
     
-    #use address csv and google api to query lat/lon of reported locations
-    pvd_crime_log = get_lat_lon(pvd_crime_log, google_key=google_key)
+        #use the local indexes, geocode cache and google api to query lat/lon of reported locations
+        chain = geocoder_chain(google_key, locations=open_store(store_dir, master_file).locations)
+        instrument_chain(report, chain)
+        pvd_crime_log = report.call('geocode', get_lat_lon, pvd_crime_log, google_key=google_key, chain=chain)
 
-    #get todays date for crime log csv save
-    today = dt.datetime.now().strftime("%m_%d_%Y")
+        save_geocode_stats(chain, 'crime_log_runs/'+today+'geocode_stats.json')
     
-    #save current run
-    filename = 'crime_log_runs/'+today+'pvd_crime_log.csv'
-    pvd_crime_log.to_csv(filename, index=False)
+        #save current run
+        filename = 'crime_log_runs/'+today+'pvd_crime_log.csv'
+        report.call('save_csv', pvd_crime_log.to_csv, filename, index=False)
     
-    #add current crime_log pull to master file of all runs
-    master = add_to_master(pvd_crime_log, today)
+        #add current crime_log pull to master file of all runs
+        store = report.call('add_to_master', add_to_master, pvd_crime_log, today, master_file=master_file,
+                            store_dir=store_dir, export_csv=export_csv, map_dir=map_dir, service_url=service_url)
+    finally:
+        report.write('crime_log_runs/'+today+'run_report.json')
 
     #if called as script do not return dataframes 
     if only_create_csv:
+        print(chain.summary())
+        print(report.summary())
         print('Complete')
         return None
     #return either all crime log data available or just new data since last run
     if return_recent_only:
         return pvd_crime_log #new data
     else:
-        return master #all data
-    
+        return store.load() #all data
 
+def stream_crime_log(link=None, key=None, google_key=None, master_file = 'pvd_crime_master.csv',
+                     store_dir='crime_store', return_recent_only=False, only_create_csv=False, export_csv=False,
+                     chunk_size=5000, profile=False, map_dir='map_tiles', service_url=default_service_url,
+                     page_size=None, mode='offset'):
+    """
+    Same steps as create_crime_log, run over fixed size chunks so memory stays bounded by
+    chunk_size instead of growing with the number of new rows
+
+    Each chunk is fetched, classified, date parsed, cleaned and geocoded, then appended to the
+    run csv and upserted into the master store before the next chunk is processed.
+    The geocoding indexes and cache are loaded once and shared by every chunk.
+    Stage stats add up over the chunks in the run report.
+
+    page_size: rows per api page request, default chunk_size
+    mode: 'offset' or 'keyset' api paging, see crime_fetch.fetch_chunks
+    map_dir: directory of the map tiles and choropleths, see add_to_master; None to skip
+    service_url: query service told to load the new rows, see add_to_master; None to skip
+    """
+    link, key, google_key = config_value('api_link', link), config_value('api_key', key), \
+        config_value('google_key', google_key)
+    report = RunReport('stream_crime_log', profile=profile)
+    today = dt.datetime.now().strftime("%m_%d_%Y")
+    filename = 'crime_log_runs/'+today+'pvd_crime_log.csv'
+    #the report is written even when a chunk fails, with the failed stage's error
+    try:
+        store = open_store(store_dir, master_file)
+        cube = RollupCube(store)
+        bins = SpatialBins(store)
+        RollupCube(store.non_offenses)
+
+        chunks = create_df_chunks(link=link, key=key, master_file=master_file, store_dir=store_dir,
+                                  page_size=chunk_size if page_size is None else page_size, mode=mode,
+                                  session=instrument(report, key))
+        chunks = report.timed_iter('fetch', pipeline.rechunk(chunks, chunk_size))
+        chunks = pipeline.stage(report.timed('classify', classify_crime), chunks)
+        chunks = pipeline.stage(report.timed('parse_dates', parse_dates), chunks)
+        chunks = pipeline.stage(report.timed('clean_location', clean_location), chunks)
+        chain = geocoder_chain(google_key, locations=store.locations)
+        instrument_chain(report, chain)
+        chunks = pipeline.stage(report.timed('geocode', get_lat_lon), chunks, google_key=google_key, chain=chain,
+                                neighborhoods=NeighborhoodAssigner())
+
+        store_sink = pipeline.StoreSink(store)
+        report.extra['store_counts'] = store_sink.counts
+        rows = pipeline.run(chunks, report.timed('save_csv', pipeline.CsvSink(filename)),
+                            report.timed('add_to_master', store_sink))
+
+        store.snapshot(today)
+        save_geocode_stats(chain, 'crime_log_runs/'+today+'geocode_stats.json')
+        if map_dir is not None:
+            report.call('map_artifacts', MapArtifacts(bins, cube, map_dir).generate)
+        if service_url is not None:
+            report.call('notify_reload', notify_reload, service_url)
+        if export_csv:
+            report.call('export_csv', store.export_csv, master_file)
+    finally:
+        report.write('crime_log_runs/'+today+'run_report.json')
+
+    if only_create_csv:
+        print(chain.summary())
+        print(report.summary())
+        print('Complete', rows, 'rows', store_sink.counts)
+        return None
+    if return_recent_only:
+        return pd.read_csv(filename) if rows else pd.DataFrame() #new data
+    else:
+        return store.load() #all data
 
-if __name__ == "__main__":
-    create_crime_log(only_create_csv=True)
-    
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fetch new Providence crime log rows and add them to the master')
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='process the crime log in chunks of this many rows to bound memory')
+    parser.add_argument('--profile', action='store_true',
+                        help='run under cProfile and tracemalloc, results go in the run report')
+    args = parser.parse_args()
+    create_crime_log(only_create_csv=True, chunk_size=args.chunk_size, profile=args.profile)
@@ -0,0 +1,365 @@
+import json
+import threading
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pandas as pd
+import numpy as np
+import requests
+
+from master_store import MasterStore
+
+#Long running local query service over the crime master.
+#The store is read once into numpy columns sorted by reported_date, with a sorted row list per
+#offense_desc, offense_cat and neighborhood value. A query is a binary search for the date range,
+#a merge of the category row lists and a mask over lat/lon, so nothing is read from disk per request.
+#POST /reload (sent by pvd_crime.add_to_master after an ingest) reads only the partition files
+#added to the manifest since the last load, merges their rows into the sorted ones and drops the
+#rows of files that left it. Every reload builds a new IndexVersion; queries never see a partial one.
+#
+#  GET  /crimes?start=2018-01-01&end=2018-02-01&offense_cat=violent_crime&neighborhood=Elmwood
+#              &bbox=south,west,north,east&columns=casenumber,reported_date&offset=0&limit=100
+#  GET  /nearby?lat=41.82&lon=-71.41&radius=300&days=30&offense_cat=violent_crime
+#  GET  /nearby?address=153 Benefit St&k=10    (k nearest instead of a radius)
+#  GET  /stats
+#  POST /reload
+#
+#Repeat a parameter to match several values, e.g. offense_desc=Burglary&offense_desc=Robbery.
+
+indexed_columns = ['offense_desc', 'offense_cat', 'neighborhood']
+default_service_url = 'http://127.0.0.1:8765'
+
+class IndexVersion(object):
+    """
+    One immutable version of a CrimeIndex: columns as numpy arrays sorted by reported_date, the
+    dates as int64 and, for each indexed column, value -> sorted row positions. A reload builds a
+    new version and swaps it in with one assignment, so a query reads a single consistent version.
+    """
+    def __init__(self, columns, categories):
+        self.columns = columns
+        self.dates = columns['reported_date'].astype('int64') if 'reported_date' in columns \
+            else np.array([], dtype='int64')
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.dates)
+
+def column_values(data, column):
+    #plain numpy arrays, categoricals of different files do not share categories
+    if column == 'reported_date':
+        return pd.to_datetime(data[column]).values.astype('datetime64[ns]')
+    return np.asarray(data[column])
+
+def category_rows(values, positions=None):
+    """
+    Takes a column and returns value -> sorted row positions; positions maps the column's rows
+    to their rows in the index, the identity if None
+    """
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+    rows = order if positions is None else positions[order]
+    return {value: rows[bounds[i]:bounds[i+1]] for i, value in enumerate(uniques)}
+
+def build_version(data):
+    """
+    Takes rows sorted by reported_date and returns their IndexVersion
+    """
+    columns = {column: column_values(data, column) for column in data.columns}
+    categories = {column: category_rows(columns[column]) for column in indexed_columns if column in columns}
+    return IndexVersion(columns, categories)
+
+def merge_version(version, data):
+    """
+    Returns a new IndexVersion holding the rows of version and the rows of data (sorted by
+    reported_date); the existing rows are moved into place, not sorted or factorized again
+    """
+    new_columns = {column: column_values(data, column) for column in data.columns}
+    new_dates = new_columns['reported_date'].astype('int64')
+    #rows of the same date keep the existing ones first
+    new_positions = np.searchsorted(version.dates, new_dates, side='right') + np.arange(len(new_dates))
+    old_positions = np.arange(len(version.dates)) + np.searchsorted(new_dates, version.dates, side='left')
+    size = len(version.dates) + len(new_dates)
+
+    columns = {}
+    for column in dict.fromkeys(list(version.columns) + list(new_columns)):
+        old = version.columns.get(column, np.full(len(version.dates), np.nan))
+        new = new_columns.get(column, np.full(len(new_dates), np.nan))
+        merged = np.empty(size, dtype=np.result_type(old.dtype, new.dtype))
+        merged[old_positions] = old
+        merged[new_positions] = new
+        columns[column] = merged
+
+    categories = {}
+    for column in indexed_columns:
+        if column not in columns:
+            continue
+        old_rows = {value: old_positions[rows] for value, rows in version.categories.get(column, {}).items()}
+        new_rows = category_rows(new_columns[column], new_positions) if column in new_columns else {}
+        categories[column] = {value: np.sort(np.concatenate([old_rows.get(value, new_positions[:0]),
+                                                             new_rows.get(value, new_positions[:0])]),
+                                             kind='mergesort')
+                              for value in dict.fromkeys(list(old_rows) + list(new_rows))}
+    return IndexVersion(columns, categories)
+
+class CrimeIndex(object):
+    """
+    In memory columnar copy of a master_store.MasterStore with date and category indexes
+
+    store_dir: directory of the master store
+    """
+    def __init__(self, store_dir='crime_store'):
+        self.store_dir = store_dir
+        self.lock = threading.Lock()
+        self.version = IndexVersion({}, {})
+        self.files = set()
+        self.ingest = None
+        self.locations = None
+        self.reload()
+
+    def __len__(self):
+        return len(self.version)
+
+    def read_entries(self, store, entries):
+        frames = []
+        for entry in entries:
+            rows = store.read_partition(entry)
+            frames.append(rows.assign(_file=entry['file']))
+        return frames
+
+    def reload(self):
+        """
+        Brings the index up to date with the store's manifest, reading only new partition files.
+        When files were only added their rows are merged into the loaded ones; removed files or
+        a new version of the location table rebuild the index from the loaded rows.
+
+        returns dict with the number of rows added and removed
+        """
+        with self.lock:
+            store = MasterStore(self.store_dir)
+            entries = {entry['file']: entry for entry in store.manifest['files']}
+            added = [entries[number] for number in sorted(set(entries) - self.files)]
+            gone = self.files - set(entries)
+            version = self.version
+
+            frames = self.read_entries(store, added)
+            added_rows = sum(len(frame) for frame in frames)
+            new = None
+            if frames:
+                new = pd.concat(frames, ignore_index=True)
+                new = new.assign(reported_date=pd.to_datetime(new['reported_date']))
+                new = new.sort_values('reported_date', kind='mergesort').reset_index(drop=True)
+
+            removed = 0
+            relocated = len(version) and store.manifest.get('locations') != self.locations
+            if len(version) and (gone or relocated):
+                current = pd.DataFrame(version.columns)
+                keep = ~current['_file'].isin(list(gone)).values
+                removed = int((~keep).sum())
+                current = current[keep]
+                if relocated:
+                    #a location was geocoded again, loaded rows take its new attributes
+                    current = store.join_locations(current)
+                if new is not None:
+                    current = pd.concat([current, new], ignore_index=True)
+                    current = current.sort_values('reported_date', kind='mergesort').reset_index(drop=True)
+                version = build_version(current)
+            elif new is not None:
+                version = merge_version(version, new) if len(version) else build_version(new)
+
+            #one assignment, queries running during the reload see the old version or the new one
+            self.version = version
+            self.files = set(entries)
+            self.ingest = store.ingest
+            self.locations = store.manifest.get('locations')
+            return {'added': added_rows, 'removed': removed, 'rows': len(self), 'ingest': self.ingest}
+
+    def query(self, start=None, end=None, bbox=None, columns=None, offset=0, limit=100, **filters):
+        """
+        Rows newest first matching every filter
+
+        start, end: reported_date range, inclusive
+        bbox: (south, west, north, east) the row's lat/lon must fall in
+        columns: columns to return, default all
+        offset, limit: page of the matching rows to return
+        filters: offense_desc, offense_cat or neighborhood = value or list of values
+
+        returns (number of matching rows, DataFrame of the page)
+        """
+        version = self.version
+        columns_data, dates, categories = version.columns, version.dates, version.categories
+        low = 0 if start is None else np.searchsorted(dates, pd.Timestamp(start).value, side='left')
+        high = len(dates) if end is None else np.searchsorted(dates, pd.Timestamp(end).value, side='right')
+
+        keep = np.ones(max(high - low, 0), dtype=bool)
+        for column, wanted in filters.items():
+            if column not in categories:
+                raise ValueError('cannot filter on '+column+', indexed columns are '+', '.join(categories))
+            wanted = wanted if isinstance(wanted, (list, tuple, set)) else [wanted]
+            in_column = np.zeros(len(keep), dtype=bool)
+            for value in wanted:
+                rows = categories[column].get(value)
+                if rows is None:
+                    continue
+                #row lists are sorted, so the rows inside the date range are one slice
+                rows = rows[np.searchsorted(rows, low):np.searchsorted(rows, high)]
+                in_column[rows - low] = True
+            keep &= in_column
+        if bbox is not None:
+            south, west, north, east = bbox
+            lat = columns_data['lat'][low:high].astype('float64')
+            lon = columns_data['lon'][low:high].astype('float64')
+            with np.errstate(invalid='ignore'):
+                keep &= (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+
+        matches = low + np.flatnonzero(keep)[::-1]
+        page = matches[offset:offset+limit]
+        columns = [column for column in columns_data if not column.startswith('_')] if columns is None else columns
+        return len(matches), pd.DataFrame({column: columns_data[column][page] for column in columns})
+
+def parse_query(query):
+    """
+    Takes a parsed query string (dict of lists) and returns the keyword arguments of CrimeIndex.query
+    """
+    unknown = set(query) - set(['start', 'end', 'offset', 'limit', 'bbox', 'columns'] + indexed_columns)
+    if unknown:
+        raise ValueError('unknown parameters '+', '.join(sorted(unknown)))
+    args = {}
+    for name in ['start', 'end']:
+        if name in query:
+            args[name] = query[name][0]
+    for name in ['offset', 'limit']:
+        if name in query:
+            args[name] = int(query[name][0])
+    args['limit'] = min(args.get('limit', 100), 10000)
+    if 'bbox' in query:
+        args['bbox'] = [float(value) for value in query['bbox'][0].split(',')]
+    if 'columns' in query:
+        args['columns'] = query['columns'][0].split(',')
+    for name in indexed_columns:
+        if name in query:
+            args[name] = query[name]
+    return args
+
+def nearby(spatial, query):
+    """
+    Answers a /nearby query string (dict of lists) from a spatial_search.SpatialIndex
+
+    returns DataFrame of the crimes found
+    """
+    unknown = set(query) - set(['lat', 'lon', 'address', 'radius', 'k', 'start', 'end', 'days'] + indexed_columns)
+    if unknown:
+        raise ValueError('unknown parameters '+', '.join(sorted(unknown)))
+    args = {name: query[name] for name in indexed_columns if name in query}
+    for name in ['start', 'end']:
+        if name in query:
+            args[name] = query[name][0]
+    if 'days' in query:
+        args['days'] = float(query['days'][0])
+    meters = float(query.get('radius', [300])[0])
+    k = int(query['k'][0]) if 'k' in query else None
+
+    if 'address' in query:
+        from spatial_search import near_addresses
+        return near_addresses(spatial, query['address'], meters, k, **args)
+    lat, lon = [float(value) for value in query['lat']], [float(value) for value in query['lon']]
+    if k is None:
+        return spatial.radius(lat, lon, meters, **args)
+    return spatial.nearest(lat, lon, k, max_meters=float(query['radius'][0]) if 'radius' in query else np.inf, **args)
+
+def make_handler(index, spatial=None):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_json(self, status, body):
+            body = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/stats':
+                return self.send_json(200, {'rows': len(index), 'files': len(index.files), 'ingest': index.ingest})
+            if url.path == '/nearby' and spatial is not None:
+                try:
+                    found = nearby(spatial, parse_qs(url.query))
+                except (ValueError, KeyError) as error:
+                    return self.send_json(400, {'error': str(error)})
+                return self.send_json(200, '{"total":'+str(len(found))+',"rows":'+
+                                      found.to_json(orient='records', date_format='iso')+'}')
+            if url.path != '/crimes':
+                return self.send_json(404, {'error': 'unknown path '+url.path})
+            try:
+                args = parse_query(parse_qs(url.query))
+                total, page = index.query(**args)
+            except (ValueError, KeyError) as error:
+                return self.send_json(400, {'error': str(error)})
+            rows = page.to_json(orient='records', date_format='iso')
+            self.send_json(200, '{"total":'+str(total)+',"offset":'+str(args.get('offset', 0))+
+                           ',"limit":'+str(args['limit'])+',"rows":'+rows+'}')
+
+        def do_POST(self):
+            if urlparse(self.path).path != '/reload':
+                return self.send_json(404, {'error': 'unknown path '+self.path})
+            reloaded = index.reload()
+            if spatial is not None:
+                reloaded['spatial'] = spatial.refresh()
+            self.send_json(200, reloaded)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+class QueryService(object):
+    """
+    Serves a CrimeIndex and a spatial_search.SpatialIndex over http in a background thread;
+    use as a context manager or call serve_forever()
+
+    store_dir: directory of the master store
+    host, port: address to listen on, port 0 picks a free one
+    """
+    def __init__(self, store_dir='crime_store', host='127.0.0.1', port=8765):
+        #spatial_search loads scipy, imported here so ingest runs that only call notify_reload skip it
+        from spatial_search import SpatialIndex
+        self.index = CrimeIndex(store_dir)
+        self.spatial = SpatialIndex(store_dir)
+        self.server = ThreadingHTTPServer((host, port), make_handler(self.index, self.spatial))
+        self.server.daemon_threads = True
+        self.url = 'http://'+host+':'+str(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+def notify_reload(service_url=default_service_url, timeout=30):
+    """
+    Asks a running query service to pick up the latest ingest; returns its reply, or None
+    when no service is listening or it did not answer
+    """
+    try:
+        return requests.post(service_url+'/reload', timeout=timeout).json()
+    except (requests.RequestException, ValueError):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve filtered, paginated queries over the crime master')
+    parser.add_argument('--store-dir', default='crime_store')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    service = QueryService(args.store_dir, args.host, args.port)
+    print('serving', len(service.index), 'rows at', service.url)
+    service.serve_forever()
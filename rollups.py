@@ -0,0 +1,256 @@
+import os
+import json
+
+import pandas as pd
+import numpy as np
+
+from master_store import write_json, has_parquet, month_names
+
+#Rollup cube of the crime master for the notebook's dashboards.
+#Cells are (day, hour, offense_desc, offense_cat, neighborhood) holding the number of rows,
+#the sum of counts and the number of non offense (counts == 0) rows. The cube is saved as one
+#file per month under store_dir/rollups/<name>/; an ingest only rewrites the months its rows
+#fall in. Queries read the cells, never the master.
+
+dimensions = ['day', 'hour', 'offense_desc', 'offense_cat', 'neighborhood']
+measures = ['rows', 'counts', 'non_offense_rows']
+
+def aggregate(df, sign=1):
+    """
+    Takes crime log rows and returns their cube cells; sign=-1 gives the cells to subtract
+    """
+    dates = pd.to_datetime(df['reported_date'])
+    counts = pd.to_numeric(df['counts'], errors='coerce').fillna(0).astype('int64')
+    rows = pd.DataFrame({'day': dates.dt.normalize().values, 'hour': dates.dt.hour.values.astype('int8'),
+                         'offense_desc': df['offense_desc'].astype(object).values,
+                         'offense_cat': df['offense_cat'].astype(object).values,
+                         'neighborhood': df['neighborhood'].astype(object).values,
+                         'rows': sign, 'counts': sign * counts.values,
+                         'non_offense_rows': sign * (counts.values == 0).astype('int64')})
+    return rows.groupby(dimensions, dropna=False, sort=False)[measures].sum().reset_index()
+
+def combine(cells, dimensions=dimensions):
+    """
+    Takes a list of cell DataFrames, adds cells of the same coordinates together and
+    drops cells left empty
+    """
+    cells = pd.concat(cells, ignore_index=True)
+    cells = cells.groupby(dimensions, dropna=False, sort=True)[measures].sum().reset_index()
+    return cells[cells['rows'] != 0].reset_index(drop=True)
+
+def select(values, wanted):
+    #boolean mask of values equal to wanted, or in it when wanted is a list
+    if isinstance(wanted, (list, tuple, set, np.ndarray, pd.Index)):
+        return values.isin(list(wanted)).values
+    return (values == wanted).values
+
+class RollupCube(object):
+    """
+    Incrementally maintained rollup cube of a master_store.MasterStore
+
+    Attaches itself to the store, so every store.append adds the new rows to (and subtracts
+    corrected rows from) the cells of the months they fall in. The cube records the last store
+    ingest it includes and is rebuilt from the store when the two disagree, e.g. the first time
+    or after a run that crashed between writing the store and the cube.
+
+    Subclasses change the cells by overriding dimensions, columns (the store columns
+    aggregate needs) and aggregate, see spatial_bins.SpatialBins.
+
+    store: master_store.MasterStore
+    name: directory under store_dir/rollups/ holding the cube
+    """
+    dimensions = dimensions
+    columns = ['reported_date', 'offense_desc', 'offense_cat', 'neighborhood', 'counts']
+
+    def __init__(self, store, name='cube'):
+        self.store = store
+        self.cube_dir = os.path.join(store.store_dir, 'rollups', name)
+        self.meta_file = os.path.join(self.cube_dir, 'meta.json')
+        self.file_format = store.manifest.get('format', 'csv')
+        if self.file_format == 'parquet' and not has_parquet:
+            self.file_format = 'csv'
+        self.months = None
+        self.frame = None
+        #coordinates of the cells update changed since store ingest changes_from, see changes
+        self.changes_from = None
+        self.changed = []
+
+        meta = {}
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file) as f:
+                meta = json.load(f)
+        if meta.get('ingest') != store.ingest:
+            self.rebuild()
+        self.changes_from = store.ingest
+        store.rollups.append(self)
+
+    def aggregate(self, df, sign=1):
+        return aggregate(df, sign)
+
+    def month_file(self, month):
+        return os.path.join(self.cube_dir, month+'.'+self.file_format)
+
+    def read_month(self, month):
+        path = self.month_file(month)
+        if self.file_format == 'parquet':
+            cells = pd.read_parquet(path)
+        else:
+            cells = pd.read_csv(path, parse_dates=['day'])
+        return cells
+
+    def write_month(self, month, cells):
+        path = self.month_file(month)
+        tmp_path = path + '.tmp'
+        if self.file_format == 'parquet':
+            cells.to_parquet(tmp_path, index=False)
+        else:
+            cells.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+    def load(self):
+        #month -> cells, read once and kept in memory
+        if self.months is None:
+            months = [name.split('.')[0] for name in os.listdir(self.cube_dir)
+                      if name.endswith('.'+self.file_format)] if os.path.isdir(self.cube_dir) else []
+            self.months = {month: self.read_month(month) for month in sorted(months)}
+        return self.months
+
+    def save_meta(self):
+        write_json(self.meta_file, {'ingest': self.store.ingest, 'months': sorted(self.months),
+                                    'dimensions': self.dimensions, 'measures': measures})
+
+    def rebuild(self):
+        """
+        Recomputes every cell from the store
+        """
+        os.makedirs(self.cube_dir, exist_ok=True)
+        for name in os.listdir(self.cube_dir):
+            os.remove(os.path.join(self.cube_dir, name))
+
+        master = self.store.load(columns=self.columns)
+        self.months = {}
+        if len(master):
+            cells = combine([self.aggregate(master)], self.dimensions)
+            for month, month_cells in cells.groupby(month_names(cells['day'])):
+                self.months[month] = month_cells.reset_index(drop=True)
+                self.write_month(month, self.months[month])
+        self.frame = None
+        #every cell may have changed
+        self.changes_from = None
+        self.changed = []
+        self.save_meta()
+
+    def update(self, added, removed=None):
+        """
+        Adds the cells of the added rows and subtracts those of the removed rows; only the
+        months the rows fall in are read and rewritten
+        """
+        delta = [self.aggregate(added)]
+        if removed is not None and len(removed):
+            delta.append(self.aggregate(removed, sign=-1))
+        delta = pd.concat(delta, ignore_index=True)
+
+        months = self.load()
+        for month, month_delta in delta.groupby(month_names(delta['day'])):
+            cells = combine([months[month], month_delta] if month in months else [month_delta], self.dimensions)
+            if len(cells):
+                months[month] = cells
+                self.write_month(month, cells)
+            elif month in months:
+                del months[month]
+                os.remove(self.month_file(month))
+        self.changed.append(delta[self.dimensions].drop_duplicates())
+        self.frame = None
+        self.save_meta()
+
+    def changes(self, since):
+        """
+        Takes the store ingest a reader of the cells (e.g. map_tiles.MapArtifacts) last saw and
+        returns the coordinates (dimension columns) of the cells changed by update since then;
+        None when they are not known, because the cube was opened after that ingest or rebuilt
+        since. The changes are then tracked again from the store's current ingest.
+        """
+        changed = None
+        if since is not None and since == self.changes_from:
+            changed = pd.concat(self.changed, ignore_index=True).drop_duplicates() if self.changed else \
+                pd.DataFrame(columns=self.dimensions).astype({'day': 'datetime64[ns]'})
+        self.changes_from = self.store.ingest
+        self.changed = []
+        return changed
+
+    def cells(self, start=None, end=None, exclude=None, **filters):
+        """
+        Returns the cube cells with day between start and end (inclusive)
+
+        exclude: dict of column to value(s) to leave out, e.g. {'offense_desc': 'Traffic Violation'}
+        filters: column=value or column=[values] to keep, e.g. offense_cat='violent_crime'
+        """
+        if self.frame is None:
+            months = self.load()
+            frames = [months[month] for month in sorted(months)]
+            self.frame = pd.concat(frames, ignore_index=True) if frames else \
+                pd.DataFrame(columns=self.dimensions + measures).astype({'day': 'datetime64[ns]'})
+        cells = self.frame
+        keep = np.ones(len(cells), dtype=bool)
+        if start is not None:
+            keep &= (cells['day'] >= pd.Timestamp(start).normalize()).values
+        if end is not None:
+            keep &= (cells['day'] <= pd.Timestamp(end)).values
+        for column, wanted in filters.items():
+            keep &= select(cells[column], wanted)
+        for column, unwanted in (exclude or {}).items():
+            keep &= ~select(cells[column], unwanted)
+        return cells[keep]
+
+    def query(self, by, measure='counts', start=None, end=None, exclude=None, **filters):
+        """
+        Sums a measure ('rows', 'counts' or 'non_offense_rows') grouped by one or more cube columns
+
+        returns Series indexed by the by columns
+        """
+        cells = self.cells(start, end, exclude, **filters)
+        return cells.groupby(by, dropna=False)[measure].sum()
+
+    def top(self, column='offense_desc', n=15, measure='counts', start=None, end=None, exclude=None, **filters):
+        """
+        returns Series of the n values of column with the largest measure, largest first
+        """
+        totals = self.query(column, measure, start, end, exclude, **filters)
+        return totals.sort_values(ascending=False, kind='mergesort')[:n]
+
+    def series(self, freq='D', measure='counts', start=None, end=None, exclude=None, **filters):
+        """
+        Measure per period, e.g. freq='D' for the daily and 'W' for the weekly crime counts;
+        periods without rows are 0
+
+        returns Series indexed by period start
+        """
+        daily = self.query('day', measure, start, end, exclude, **filters)
+        return daily.resample(freq).sum()
+
+    def hourly_rate(self, by='offense_desc', measure='rows', start=None, end=None, exclude=None, **filters):
+        """
+        Average measure per day for each hour of the day and value of by, like the notebook's
+        hourly crime rate plots; days are counted from the first to the last day in the range,
+        both included
+
+        returns DataFrame indexed by hour with one column per value of by
+        """
+        cells = self.cells(start, end, exclude, **filters)
+        if not len(cells):
+            return pd.DataFrame(index=pd.RangeIndex(24, name='hour'))
+        days = (cells['day'].max() - cells['day'].min()).days + 1
+        rates = cells.groupby([by, 'hour'], dropna=False)[measure].sum().div(days).unstack(0)
+        return rates.reindex(range(24)).fillna(0)
+
+    def on_dates(self, dates, by='offense_desc', measure='counts', exclude=None, **filters):
+        """
+        Measure on each of a list of days, or a dict of day to label (e.g. holidays)
+
+        returns Series indexed by (day or label, by)
+        """
+        labels = dates if isinstance(dates, dict) else {day: day for day in dates}
+        days = pd.Series(list(labels.values()), index=pd.to_datetime(list(labels.keys())).normalize())
+        cells = self.cells(exclude=exclude, **filters)
+        cells = cells[cells['day'].isin(days.index)]
+        return cells.groupby([cells['day'].map(days).rename('day'), by], dropna=False)[measure].sum()
@@ -0,0 +1,245 @@
+import io
+import os
+import json
+import time
+import pstats
+import cProfile
+import resource
+import tracemalloc
+import functools
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+from do_geocode import latency_buckets, latency_histogram
+
+#Instrumentation of a create_crime_log run.
+#Every stage function is wrapped so its wall time, rows in and out and peak memory growth add up
+#across calls (a streamed run calls each stage once per chunk), a call that raises is counted
+#with its error, and requests sessions get a
+#response hook counting http calls and their latency. The report is written as json next to the
+#run csv in crime_log_runs/. With profile=True the whole run is also under cProfile and
+#tracemalloc: stage memory is the traced python heap instead of the process rss, and the
+#report lists the slowest functions and the largest allocation sites.
+
+def peak_rss_mb():
+    #ru_maxrss is kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def current_rss_mb():
+    """
+    Resident set size of the process now, from /proc/self/statm; the process peak where there
+    is no /proc (e.g. macOS)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return peak_rss_mb()
+    return resident_pages * resource.getpagesize() / 2**20
+
+def row_count(value):
+    return len(value) if isinstance(value, pd.DataFrame) else None
+
+class StageStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.memory_mb = 0.0
+        self.errors = 0
+        self.error = None
+
+    def stats(self):
+        return {'calls': self.calls, 'seconds': round(self.seconds, 4), 'rows_in': self.rows_in,
+                'rows_out': self.rows_out, 'memory_growth_mb': round(self.memory_mb, 2),
+                'rows_per_second': round((self.rows_in or self.rows_out) / self.seconds)
+                if self.seconds and (self.rows_in or self.rows_out) else None,
+                'errors': self.errors, 'error': self.error}
+
+class HttpCounter(object):
+    """
+    Response hook for a requests.Session counting calls, status codes and latency;
+    add with session.hooks['response'].append(counter)
+    """
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.statuses = {}
+        self.histogram = np.zeros(len(latency_buckets), dtype='int64')
+
+    def __call__(self, response, *args, **kwargs):
+        seconds = response.elapsed.total_seconds()
+        self.calls += 1
+        self.seconds += seconds
+        self.statuses[str(response.status_code)] = self.statuses.get(str(response.status_code), 0) + 1
+        self.histogram[np.searchsorted(latency_buckets, seconds * 1000)] += 1
+
+    def stats(self):
+        return {'calls': self.calls, 'seconds': round(self.seconds, 4),
+                'mean_ms': round(self.seconds * 1000 / self.calls, 3) if self.calls else 0.0,
+                'status': self.statuses, 'latency_ms': latency_histogram(self.histogram)}
+
+class RunReport(object):
+    """
+    Collects per stage timing, row counts, memory growth and http calls of one pipeline run
+
+    name: run label written in the report
+    profile: run cProfile and tracemalloc over the whole run
+    """
+    def __init__(self, name='create_crime_log', profile=False):
+        self.name = name
+        self.profile = profile
+        self.stages = {}
+        self.http_counters = {}
+        self.geocoder = None
+        self.extra = {}
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.profiler = None
+        if profile:
+            tracemalloc.start()
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageStats()
+        return self.stages[name]
+
+    def memory_mark(self):
+        if self.profile:
+            tracemalloc.reset_peak()
+            return tracemalloc.get_traced_memory()[0] / 2**20
+        return current_rss_mb(), peak_rss_mb()
+
+    def memory_growth(self, mark):
+        """
+        Memory a stage call grew by over its mark: the traced heap peak with profile=True,
+        otherwise the highest rss seen during the call minus the rss at its start. The process
+        peak is the highest rss seen when the call raised it; when it did not, the rss at the end
+        of the call is the highest one known.
+        """
+        if self.profile:
+            return tracemalloc.get_traced_memory()[1] / 2**20 - mark
+        current, peak = mark
+        peak_now = peak_rss_mb()
+        return (peak_now if peak_now > peak else current_rss_mb()) - current
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        """
+        Adds the wall time and memory growth of the with block to stage, also when the block
+        raises; the exception is counted in the stage's errors (the last one kept as its error)
+        and raised again
+        """
+        mark = self.memory_mark()
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as error:
+            stage.errors += 1
+            stage.error = type(error).__name__+': '+str(error)
+            raise
+        finally:
+            stage.seconds += time.perf_counter() - start
+            stage.memory_mb += max(self.memory_growth(mark), 0.0)
+
+    def timed(self, name, function):
+        """
+        Wraps function(df, ...) so every call is counted under stage name; rows in are the rows of
+        the first argument and rows out the rows of the result when they are DataFrames
+        """
+        stage = self.stage(name)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            stage.calls += 1
+            stage.rows_in += (row_count(args[0]) or 0) if args else 0
+            with self.measure(stage):
+                result = function(*args, **kwargs)
+            stage.rows_out += row_count(result) or 0
+            return result
+        return wrapper
+
+    def call(self, name, function, *args, **kwargs):
+        return self.timed(name, function)(*args, **kwargs)
+
+    def timed_iter(self, name, chunks):
+        """
+        Yields the chunks of an iterator, counting the time spent producing them (e.g. fetching
+        pages) under stage name
+        """
+        return self.iterate(self.stage(name), iter(chunks))
+
+    def iterate(self, stage, chunks):
+        finished = object()
+        while True:
+            with self.measure(stage):
+                chunk = next(chunks, finished)
+            if chunk is finished:
+                return
+            stage.calls += 1
+            stage.rows_out += row_count(chunk) or 0
+            yield chunk
+
+    def http(self, name, session=None):
+        """
+        returns the HttpCounter for name, added as a response hook to session if one is given
+        """
+        if name not in self.http_counters:
+            self.http_counters[name] = HttpCounter()
+        counter = self.http_counters[name]
+        if session is not None:
+            session.hooks['response'].append(counter)
+        return counter
+
+    def add_geocoder(self, chain):
+        """
+        Adds the calls and latency of the geocoder chain's backends (do_geocode.GeocoderChain)
+        """
+        self.geocoder = chain
+
+    def stats(self):
+        report = {'run': self.name, 'started': pd.Timestamp(self.started, unit='s').isoformat(),
+                  'seconds': round(time.perf_counter() - self.start, 4), 'peak_rss_mb': round(peak_rss_mb(), 1),
+                  'stages': {name: stage.stats() for name, stage in self.stages.items()},
+                  'http': {name: counter.stats() for name, counter in self.http_counters.items()}}
+        if self.geocoder is not None:
+            report['geocoder'] = self.geocoder.stats()
+        report.update(self.extra)
+        return report
+
+    def profile_stats(self, profile_file, top=30):
+        self.profiler.disable()
+        self.profiler.dump_stats(profile_file)
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(top)
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        allocations = [{'site': str(stat.traceback), 'mb': round(stat.size / 2**20, 3), 'blocks': stat.count}
+                       for stat in snapshot.statistics('lineno')[:top]]
+        return {'profile_file': profile_file, 'cumulative': out.getvalue().splitlines(),
+                'allocations': allocations}
+
+    def write(self, filename):
+        """
+        Writes the report as json; with profile=True the cProfile stats also go to filename
+        with a .prof extension, for snakeviz or pstats
+
+        returns the report dict
+        """
+        report = self.stats()
+        if self.profiler is not None:
+            report['profile'] = self.profile_stats(filename.rsplit('.', 1)[0]+'.prof')
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=1, default=str)
+        return report
+
+    def summary(self):
+        """
+        returns a DataFrame of the stage stats, one row per stage
+        """
+        return pd.DataFrame({name: stage.stats() for name, stage in self.stages.items()}).T
@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+
+from rollups import RollupCube, measures
+
+#Hierarchical spatial bins of the crime master for heatmaps.
+#Points are binned into web mercator tiles (the slippy map x/y/zoom used by folium and leaflet)
+#at several zoom levels; a tile's parent at zoom - 1 is (x // 2, y // 2). Bins are kept per day
+#and offense_cat and maintained at ingest like the rollup cube, so a map draws a few hundred
+#cells instead of one marker per crime.
+
+default_levels = (10, 12, 14, 16, 18)
+
+def tile_xy(lat, lon, level):
+    """
+    Takes arrays of latitudes and longitudes and returns the int64 (x, y) web mercator tile
+    of each point at a zoom level; -1 where lat or lon is null
+    """
+    lat = np.asarray(lat, dtype='float64')
+    lon = np.asarray(lon, dtype='float64')
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    n = 2 ** level
+    with np.errstate(invalid='ignore'):
+        x = np.floor((lon + 180.0) / 360.0 * n)
+        y = np.floor((1.0 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2.0 * n)
+    x = np.where(valid, np.clip(x, 0, n - 1), -1).astype('int64')
+    y = np.where(valid, np.clip(y, 0, n - 1), -1).astype('int64')
+    return x, y
+
+def tile_lat_lon(x, y, level):
+    """
+    Takes tile coordinates (scalars or arrays, fractional for points inside a tile) and returns
+    the (lat, lon) of their north west corner; x + 0.5, y + 0.5 gives the tile center
+    """
+    n = 2.0 ** level
+    lon = np.asarray(x, dtype='float64') / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y, dtype='float64') / n))))
+    return lat, lon
+
+def tile_bounds(x, y, level):
+    """
+    returns ((south, west), (north, east)) of a tile, the bounds format folium takes
+    """
+    north, west = tile_lat_lon(x, y, level)
+    south, east = tile_lat_lon(x + 1, y + 1, level)
+    return (float(south), float(west)), (float(north), float(east))
+
+class SpatialBins(RollupCube):
+    """
+    Counts per (day, level, x, y, offense_cat) tile, updated incrementally at ingest
+
+    Rows without lat/lon are not binned.
+
+    store: master_store.MasterStore
+    levels: zoom levels to bin at
+    name: directory under store_dir/rollups/ holding the bins
+    """
+    dimensions = ['day', 'level', 'x', 'y', 'offense_cat']
+    columns = ['reported_date', 'offense_cat', 'lat', 'lon', 'counts']
+
+    def __init__(self, store, levels=default_levels, name='spatial'):
+        self.levels = sorted(levels)
+        RollupCube.__init__(self, store, name)
+
+    def aggregate(self, df, sign=1):
+        located = df[df['lat'].notnull() & df['lon'].notnull()]
+        dates = pd.to_datetime(located['reported_date'])
+        counts = pd.to_numeric(located['counts'], errors='coerce').fillna(0).astype('int64').values
+        #binned once at the finest level, coarser levels are the same tiles shifted down
+        finest = self.levels[-1]
+        x, y = tile_xy(located['lat'].values, located['lon'].values, finest)
+        frames = []
+        for level in self.levels:
+            shift = finest - level
+            frames.append(pd.DataFrame({'day': dates.dt.normalize().values, 'level': np.int8(level),
+                                        'x': x >> shift, 'y': y >> shift,
+                                        'offense_cat': located['offense_cat'].astype(object).values,
+                                        'rows': sign, 'counts': sign * counts,
+                                        'non_offense_rows': sign * (counts == 0).astype('int64')}))
+        rows = pd.concat(frames, ignore_index=True)
+        return rows.groupby(self.dimensions, dropna=False, sort=False)[measures].sum().reset_index()
+
+    def level_for(self, max_cells, start=None, end=None, exclude=None, **filters):
+        """
+        returns the finest binned level with at most max_cells non empty tiles for the query,
+        the coarsest level if none is that small
+        """
+        cells = self.cells(start, end, exclude, **filters)
+        for level in reversed(self.levels):
+            tiles = cells.loc[cells['level'] == level, ['x', 'y']]
+            if len(tiles.drop_duplicates()) <= max_cells:
+                return level
+        return self.levels[0]
+
+    def counts(self, level, measure='counts', start=None, end=None, bounds=None, exclude=None, **filters):
+        """
+        Per tile totals of a measure at one zoom level
+
+        level: zoom level, one of self.levels
+        measure: 'rows', 'counts' or 'non_offense_rows'
+        start, end: reported_date range, days inclusive
+        bounds: optional ((south, west), (north, east)) the tiles must overlap
+        exclude, filters: see rollups.RollupCube.cells, e.g. offense_cat='violent_crime'
+
+        returns DataFrame with columns x, y, lat, lon (tile center) and the measure, largest first
+        """
+        if level not in self.levels:
+            raise ValueError('level '+str(level)+' is not binned, levels are '+str(self.levels))
+        cells = self.cells(start, end, exclude, level=level, **filters)
+        if bounds is not None:
+            (south, west), (north, east) = bounds
+            x0, y0 = tile_xy([north], [west], level)
+            x1, y1 = tile_xy([south], [east], level)
+            cells = cells[cells['x'].between(x0[0], x1[0]) & cells['y'].between(y0[0], y1[0])]
+
+        tiles = cells.groupby(['x', 'y'])[measure].sum().reset_index()
+        tiles = tiles[tiles[measure] != 0]
+        lat, lon = tile_lat_lon(tiles['x'].values + 0.5, tiles['y'].values + 0.5, level)
+        tiles = tiles.assign(lat=lat, lon=lon)[['x', 'y', 'lat', 'lon', measure]]
+        return tiles.sort_values(measure, ascending=False, kind='mergesort').reset_index(drop=True)
+
+    def heatmap(self, level, measure='counts', start=None, end=None, exclude=None, **filters):
+        """
+        returns list of [lat, lon, weight] per tile, the data folium.plugins.HeatMap takes
+        """
+        tiles = self.counts(level, measure, start, end, exclude=exclude, **filters)
+        return tiles[['lat', 'lon', measure]].values.tolist()
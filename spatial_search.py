@@ -0,0 +1,243 @@
+import copy
+import datetime as dt
+import threading
+
+import pandas as pd
+import numpy as np
+from scipy.spatial import cKDTree
+
+from master_store import MasterStore
+from do_geocode import GeocodeCache, GeocoderChain, CacheBackend
+from street_resolver import meters_per_lat, meters_per_lon
+
+#Radius and nearest neighbor search over the master's crime locations.
+#Points are projected to meters around Providence and kept in KD-trees, one per segment of
+#partition files: a refresh after an ingest builds a small tree over the new files only and
+#marks rows of files that left the manifest as dead; segments are merged into one tree once
+#there are more than max_segments. Every query takes arrays of points and answers all of them
+#in one call per segment.
+
+result_columns = ['casenumber', 'reported_date', 'offense_desc', 'offense_cat', 'location', 'lat', 'lon']
+
+def to_meters(lat, lon):
+    return np.column_stack([np.asarray(lat, dtype='float64') * meters_per_lat,
+                            np.asarray(lon, dtype='float64') * meters_per_lon])
+
+class Segment(object):
+    #rows of some partition files with a tree over their located points
+    def __init__(self, rows):
+        rows = rows[rows['lat'].notnull() & rows['lon'].notnull()].reset_index(drop=True)
+        self.rows = rows
+        self.files = rows['_file'].values
+        self.dates = pd.to_datetime(rows['reported_date']).values.astype('datetime64[ns]')
+        self.alive = np.ones(len(rows), dtype=bool)
+        self.tree = cKDTree(to_meters(rows['lat'].values, rows['lon'].values))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def with_alive(self, alive):
+        #a new segment sharing the rows and tree, with another alive mask
+        segment = copy.copy(self)
+        segment.alive = alive
+        return segment
+
+    def mask(self, start, end, filters):
+        keep = self.alive.copy()
+        if start is not None:
+            keep &= self.dates >= np.datetime64(pd.Timestamp(start))
+        if end is not None:
+            keep &= self.dates <= np.datetime64(pd.Timestamp(end))
+        for column, wanted in filters.items():
+            wanted = wanted if isinstance(wanted, (list, tuple, set)) else [wanted]
+            keep &= self.rows[column].isin(wanted).values
+        return keep
+
+class SpatialIndex(object):
+    """
+    KD-tree index of the master store's lat/lon for radius and k nearest queries
+
+    store_dir: directory of the master store
+    columns: store columns kept for results and filters
+    max_segments: trees kept before they are merged into one
+    """
+    def __init__(self, store_dir='crime_store', columns=result_columns + ['neighborhood'], max_segments=4):
+        self.store_dir = store_dir
+        self.columns = list(dict.fromkeys(columns + ['reported_date', 'lat', 'lon']))
+        self.max_segments = max_segments
+        self.segments = []
+        self.files = set()
+        self.locations = None
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def __len__(self):
+        return sum(int(segment.alive.sum()) for segment in self.segments)
+
+    def refresh(self):
+        """
+        Indexes partition files added to the store since the last refresh and drops the rows
+        of files no longer in the manifest
+
+        returns dict with the number of rows added and removed
+        """
+        with self.lock:
+            return self.refresh_segments()
+
+    def refresh_segments(self):
+        #segments are replaced by new ones with the new alive masks, never changed in place, and
+        #the list is swapped in one assignment, so queries running in other threads keep a
+        #consistent view
+        store = MasterStore(self.store_dir)
+        current, known = self.segments, self.files
+        if store.manifest.get('locations') != self.locations:
+            #a location was geocoded again, every tree is rebuilt with the new coordinates
+            current, known = [], set()
+        entries = {entry['file']: entry for entry in store.manifest['files']}
+        gone = known - set(entries)
+        removed = 0
+        segments = []
+        for segment in current:
+            dead = segment.alive & np.isin(segment.files, list(gone))
+            removed += int(dead.sum())
+            if dead.any():
+                segment = segment.with_alive(segment.alive & ~dead)
+            if segment.alive.any():
+                segments.append(segment)
+
+        frames = []
+        for number in sorted(set(entries) - known):
+            entry = entries[number]
+            columns = [column for column in self.columns if column in entry.get('columns', self.columns)]
+            rows = store.read_partition(entry)[columns]
+            frames.append(rows.assign(_file=number))
+        added = 0
+        if frames:
+            segment = Segment(pd.concat(frames, ignore_index=True))
+            added = len(segment)
+            segments.append(segment)
+        if len(segments) > self.max_segments:
+            segments = self.merge(segments)
+        self.segments = segments
+        self.files = set(entries)
+        self.locations = store.manifest.get('locations')
+        return {'added': added, 'removed': removed, 'rows': len(self)}
+
+    def merge(self, segments):
+        rows = pd.concat([segment.rows[segment.alive] for segment in segments], ignore_index=True)
+        return [Segment(rows)] if len(rows) else []
+
+    def date_range(self, start, end, days):
+        if days is not None:
+            start = dt.datetime.now() - dt.timedelta(days=days)
+        return start, end
+
+    def radius(self, lat, lon, meters, start=None, end=None, days=None, **filters):
+        """
+        Crimes within meters of each point
+
+        lat, lon: scalars or arrays of query points
+        meters: search radius
+        start, end: reported_date range; days: only the last days days, overrides start
+        filters: column = value or list of values, e.g. offense_cat='violent_crime'
+
+        returns DataFrame with one row per (query point, crime); columns query (position of the
+        query point), distance in meters and the indexed columns, nearest first per query point
+        """
+        start, end = self.date_range(start, end, days)
+        points = to_meters(np.atleast_1d(lat), np.atleast_1d(lon))
+        frames = []
+        for segment in self.segments:
+            keep = segment.mask(start, end, filters)
+            if not keep.any():
+                continue
+            found = segment.tree.query_ball_point(points, r=meters)
+            lengths = np.array([len(rows) for rows in found], dtype='int64')
+            if not lengths.sum():
+                continue
+            queries = np.repeat(np.arange(len(points)), lengths)
+            rows = np.concatenate([np.asarray(rows, dtype='int64') for rows in found])
+            wanted = keep[rows]
+            queries, rows = queries[wanted], rows[wanted]
+            distances = np.hypot(*(segment.tree.data[rows] - points[queries]).T)
+            frames.append(segment.rows.iloc[rows].drop(columns='_file').assign(query=queries, distance=distances))
+        return self.collect(frames)
+
+    def nearest(self, lat, lon, k=10, start=None, end=None, days=None, max_meters=np.inf, **filters):
+        """
+        The k crimes closest to each point that pass the filters (see radius)
+
+        max_meters: ignore crimes farther than this
+
+        returns DataFrame like radius with at most k rows per query point
+        """
+        start, end = self.date_range(start, end, days)
+        points = to_meters(np.atleast_1d(lat), np.atleast_1d(lon))
+        frames = []
+        for segment in self.segments:
+            keep = segment.mask(start, end, filters)
+            total = int(keep.sum())
+            if not total:
+                continue
+            #ask for more neighbors than k until every point has k that pass the filters
+            pending = np.arange(len(points))
+            asked = min(len(segment), max(k * 4, k + 8))
+            while len(pending):
+                distances, rows = segment.tree.query(points[pending], k=asked, distance_upper_bound=max_meters)
+                distances, rows = distances.reshape(len(pending), -1), rows.reshape(len(pending), -1)
+                found = rows < len(segment)
+                passes = found & keep[np.where(found, rows, 0)]
+                enough = (passes.sum(axis=1) >= min(k, total)) | (asked >= len(segment)) | ~found.all(axis=1)
+                done = pending[enough]
+                first_k = passes[enough] & (np.cumsum(passes[enough], axis=1) <= k)
+                queries = np.repeat(done, first_k.sum(axis=1))
+                frames.append(segment.rows.iloc[rows[enough][first_k]].drop(columns='_file')
+                              .assign(query=queries, distance=distances[enough][first_k]))
+                pending = pending[~enough]
+                asked = min(len(segment), asked * 4)
+        results = self.collect(frames)
+        return results.groupby('query', sort=False).head(k).reset_index(drop=True)
+
+    def collect(self, frames):
+        if not frames:
+            return pd.DataFrame(columns=['query', 'distance'] + [c for c in self.columns if c != '_file'])
+        results = pd.concat(frames, ignore_index=True)
+        results = results.sort_values(['query', 'distance'], kind='mergesort').reset_index(drop=True)
+        return results[['query', 'distance'] + [column for column in results.columns
+                                                if column not in ('query', 'distance')]]
+
+def locate(addresses, chain=None):
+    """
+    Resolves address strings to (lat, lon) for spatial queries through do_geocode; by default
+    only the geocode cache (seeded from pvd_location_info.csv) is used, so nothing is paid for
+
+    addresses: list of addresses in street number street format
+    chain: do_geocode.GeocoderChain, e.g. pvd_crime.geocoder_chain(google_key)
+
+    returns DataFrame aligned with addresses; columns location, lat, lon, NaN where not found
+    """
+    if chain is None:
+        chain = GeocoderChain([CacheBackend(GeocodeCache())])
+    results = chain.resolve(addresses)
+    found = [results.get(str(address), (np.nan, np.nan, np.nan, np.nan)) for address in addresses]
+    return pd.DataFrame({'location': list(addresses), 'lat': [result[0] for result in found],
+                         'lon': [result[1] for result in found]})
+
+def near_addresses(index, addresses, meters=300, k=None, chain=None, **query_args):
+    """
+    Radius (or, with k, nearest) search around addresses; each address is located with locate()
+
+    index: SpatialIndex
+    query_args: start, end, days and filters, see SpatialIndex.radius
+
+    returns DataFrame like SpatialIndex.radius with the query point's address in an address column;
+    addresses that could not be located have no rows
+    """
+    points = locate(addresses, chain)
+    located = points[points['lat'].notnull()].reset_index(drop=True)
+    if k is None:
+        results = index.radius(located['lat'].values, located['lon'].values, meters, **query_args)
+    else:
+        results = index.nearest(located['lat'].values, located['lon'].values, k, max_meters=meters, **query_args)
+    results.insert(0, 'address', located['location'].values[results['query'].values.astype('int64')])
+    return results
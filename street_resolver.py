@@ -0,0 +1,270 @@
+import os
+import re
+import json
+
+import pandas as pd
+import numpy as np
+
+from address_index import (find_sources, read_sources, normalize_address, source_stamp, is_stale, write_index_file,
+                           write_index_meta)
+
+#Local resolver for the locations the exact OpenAddresses index misses;
+#"X At Y" intersections, house numbers that are not in OpenAddresses and misspelled street names.
+#OpenAddresses points are grouped by street and city (one sorted block of numbers/coordinates per
+#street in each city, a street name shared by Providence and Cranston is two streets) and street
+#names get a trigram index for fuzzy matching.
+
+intersection_pattern = re.compile(r'\s+(?:AT|&|/|AND)\s+|\s*[&/]\s*')
+
+#rough meters per degree around Providence, fine for comparing short distances
+meters_per_lat = 111132.0
+meters_per_lon = 111320.0 * np.cos(np.radians(41.82))
+
+#bumped when the layout of streets.npz/streets.json changes, an index of another version is rebuilt;
+#indexes before 2 grouped points by street name only
+street_index_version = 2
+
+def trigrams(name):
+    padded = '  ' + name + ' '
+    return set(padded[i:i+3] for i in range(len(padded) - 2))
+
+def split_location(location):
+    """
+    Splits a normalized location into (number, street, cross street);
+    number and cross street are None when absent
+    """
+    parts = intersection_pattern.split(location, maxsplit=1)
+    if len(parts) == 2:
+        return None, parts[0].strip(), parts[1].strip()
+    match = re.match(r'^(\d+)\S*\s+(.+)$', location)
+    if match:
+        return int(match.group(1)), match.group(2), None
+    return None, location, None
+
+def street_index_stale(address_dir, meta_file):
+    """
+    True if the street index described by meta_file is missing, was built from different source csvs
+    or by another street_index_version
+    """
+    if is_stale(address_dir, meta_file):
+        return True
+    with open(meta_file) as f:
+        return json.load(f).get('version') != street_index_version
+
+def build_street_index(address_dir='open_addresses', index_dir=None):
+    """
+    Groups the OpenAddresses points by normalized street name and city and saves them to
+    index_dir/streets.npz and streets.json (default index_dir is address_dir/index)
+
+    returns the index directory
+    """
+    if index_dir is None:
+        index_dir = os.path.join(address_dir, 'index')
+    os.makedirs(index_dir, exist_ok=True)
+
+    sources = find_sources(address_dir)
+    addresses = read_sources(sources)
+    addresses['street_key'] = normalize_address(addresses['street']).values
+    addresses['house'] = pd.to_numeric(addresses['number'].str.extract(r'^(\d+)', expand=False), errors='coerce')
+    addresses = addresses[addresses['street_key'].notnull()]
+
+    street_codes, streets = pd.factorize(addresses['street_key'], sort=True)
+    city_codes, cities = pd.factorize(addresses['city'])
+    #one group per (street, city); points without a city (code -1) are a group of their own
+    pairs = street_codes.astype('int64') * (len(cities) + 1) + (city_codes + 1)
+    group_codes, groups = pd.factorize(pairs, sort=True)
+    #sort by group then house number so each group is one contiguous, ordered block
+    order = np.lexsort((addresses['house'].fillna(-1).values, group_codes))
+    group_codes = group_codes[order]
+    starts = np.searchsorted(group_codes, np.arange(len(groups) + 1))
+
+    arrays = {'starts': starts, 'houses': addresses['house'].fillna(-1).values[order].astype('int64'),
+              'coords': addresses[['lat', 'lon']].values[order].astype('float64'),
+              'cities': city_codes[order].astype('int16'),
+              'group_streets': (groups // (len(cities) + 1)).astype('int64'),
+              'group_cities': (groups % (len(cities) + 1) - 1).astype('int16')}
+    write_index_file(os.path.join(index_dir, 'streets.npz'), lambda f: np.savez(f, **arrays))
+    write_index_meta(os.path.join(index_dir, 'streets.json'),
+                     {'streets': list(streets), 'cities': list(cities), 'sources': source_stamp(sources),
+                      'version': street_index_version})
+
+    return index_dir
+
+class StreetResolver(object):
+    """
+    Resolves intersections, missing house numbers and misspelled streets from OpenAddresses points
+
+    address_dir: directory of OpenAddresses VRTs and csvs
+    index_dir: where the street index lives, default address_dir/index; rebuilt if stale
+    city: a street name found in several cities is looked up in this city first
+    min_similarity: trigram similarity (0-1) a fuzzy street match needs to be accepted
+    max_gap: meters; an intersection whose two streets never come closer than this is rejected
+    max_extrapolate: house numbers this far beyond either end of a street snap to the end point
+    """
+    def __init__(self, address_dir='open_addresses', index_dir=None, city='Providence', min_similarity=0.6,
+                 max_gap=120, max_extrapolate=40):
+        if index_dir is None:
+            index_dir = os.path.join(address_dir, 'index')
+        meta_file = os.path.join(index_dir, 'streets.json')
+        if street_index_stale(address_dir, meta_file):
+            build_street_index(address_dir, index_dir)
+
+        with open(meta_file) as f:
+            meta = json.load(f)
+        arrays = np.load(os.path.join(index_dir, 'streets.npz'))
+        self.starts = arrays['starts']
+        self.houses = arrays['houses']
+        self.coords = arrays['coords']
+        self.city_codes = arrays['cities']
+        self.group_cities = arrays['group_cities']
+        self.streets = meta['streets']
+        self.cities = np.array(meta['cities'] + [np.nan], dtype=object)
+        self.street_ids = {street: i for i, street in enumerate(self.streets)}
+        #group ids of each street, the preferred city's group first
+        city_code = meta['cities'].index(city) if city in meta['cities'] else -2
+        group_order = np.lexsort((self.group_cities != city_code, arrays['group_streets']))
+        group_starts = np.searchsorted(arrays['group_streets'][group_order], np.arange(len(self.streets) + 1))
+        self.street_groups = [group_order[start:stop] for start, stop in zip(group_starts[:-1], group_starts[1:])]
+
+        self.min_similarity = min_similarity
+        self.max_gap = max_gap
+        self.max_extrapolate = max_extrapolate
+        self.build_trigram_index()
+        self.street_cache = {}
+        self.intersection_cache = {}
+
+    def build_trigram_index(self):
+        #inverted index of trigram -> street ids, with each street's trigram count for the similarity score
+        postings = {}
+        self.trigram_counts = np.zeros(len(self.streets), dtype='int64')
+        for i, street in enumerate(self.streets):
+            grams = trigrams(street)
+            self.trigram_counts[i] = len(grams)
+            for gram in grams:
+                postings.setdefault(gram, []).append(i)
+        self.postings = {gram: np.array(ids, dtype='int64') for gram, ids in postings.items()}
+
+    def match_street(self, street):
+        """
+        Returns the id of the street best matching a normalized street name, or None.
+        Exact names are a dict lookup; anything else is scored by trigram similarity
+        against the streets sharing at least one trigram.
+        """
+        if street in self.street_ids:
+            return self.street_ids[street]
+        if street in self.street_cache:
+            return self.street_cache[street]
+
+        grams = trigrams(street)
+        hits = [self.postings[gram] for gram in grams if gram in self.postings]
+        best = None
+        if hits:
+            shared = np.bincount(np.concatenate(hits), minlength=len(self.streets))
+            similarity = shared / (len(grams) + self.trigram_counts - shared)
+            candidate = int(np.argmax(similarity))
+            if similarity[candidate] >= self.min_similarity:
+                best = candidate
+        self.street_cache[street] = best
+        return best
+
+    def street_points(self, group_id):
+        start, stop = self.starts[group_id], self.starts[group_id + 1]
+        return self.houses[start:stop], self.coords[start:stop], self.city_codes[start:stop]
+
+    def intersection(self, street_a, street_b):
+        """
+        Returns (lat, lon, city code) halfway between the closest pair of points on two street groups,
+        or None if they never come within max_gap meters
+        """
+        pair = (min(street_a, street_b), max(street_a, street_b))
+        if pair in self.intersection_cache:
+            return self.intersection_cache[pair]
+
+        houses_a, coords_a, cities_a = self.street_points(street_a)
+        houses_b, coords_b, cities_b = self.street_points(street_b)
+        result = None
+        if len(coords_a) and len(coords_b):
+            #only points inside the other street's bounding box (plus max_gap) can be the closest pair
+            margin = np.array([self.max_gap / meters_per_lat, self.max_gap / meters_per_lon])
+            near_a = np.all((coords_a >= coords_b.min(0) - margin) & (coords_a <= coords_b.max(0) + margin), axis=1)
+            near_b = np.all((coords_b >= coords_a.min(0) - margin) & (coords_b <= coords_a.max(0) + margin), axis=1)
+            a, b = coords_a[near_a], coords_b[near_b]
+            if len(a) and len(b):
+                scale = np.array([meters_per_lat, meters_per_lon])
+                distances = np.hypot(*((a[:, None, :] - b[None, :, :]) * scale).transpose(2, 0, 1))
+                i, j = np.unravel_index(np.argmin(distances), distances.shape)
+                if distances[i, j] <= self.max_gap:
+                    lat, lon = (a[i] + b[j]) / 2
+                    result = (lat, lon, cities_a[near_a][i])
+        self.intersection_cache[pair] = result
+        return result
+
+    def interpolate(self, group_id, house):
+        """
+        Returns (lat, lon, city code) for a house number by linear interpolation between the nearest
+        numbered points on the same side of a street group (same parity), or None
+        """
+        houses, coords, cities = self.street_points(group_id)
+        numbered = houses >= 0
+        same_side = numbered & (houses % 2 == house % 2)
+        if same_side.sum() >= 2:
+            numbered = same_side
+        houses, coords, cities = houses[numbered], coords[numbered], cities[numbered]
+        if not len(houses):
+            return None
+
+        upper = np.searchsorted(houses, house)
+        if upper < len(houses) and houses[upper] == house:
+            return coords[upper][0], coords[upper][1], cities[upper]
+        if upper == 0 or upper == len(houses):
+            end = 0 if upper == 0 else len(houses) - 1
+            if abs(houses[end] - house) > self.max_extrapolate:
+                return None
+            return coords[end][0], coords[end][1], cities[end]
+
+        lower = upper - 1
+        weight = (house - houses[lower]) / (houses[upper] - houses[lower])
+        lat, lon = coords[lower] + weight * (coords[upper] - coords[lower])
+        return lat, lon, cities[lower]
+
+    def resolve_one(self, key):
+        number, street, cross_street = split_location(key)
+        street_id = self.match_street(street)
+        if street_id is None:
+            return None
+        if cross_street is not None:
+            cross_id = self.match_street(cross_street)
+            if cross_id is None or cross_id == street_id:
+                return None
+            #both streets have to be in the same city, the preferred city is tried first
+            for group_a in self.street_groups[street_id]:
+                for group_b in self.street_groups[cross_id]:
+                    if self.group_cities[group_a] == self.group_cities[group_b]:
+                        found = self.intersection(group_a, group_b)
+                        if found is not None:
+                            return found + ('intersection',)
+            return None
+        if number is not None:
+            for group_id in self.street_groups[street_id]:
+                found = self.interpolate(group_id, number)
+                if found is not None:
+                    return found + ('interpolated',)
+        return None
+
+    def resolve(self, locations):
+        """
+        Resolves an array or Series of locations; each distinct location is resolved once
+
+        returns DataFrame aligned with locations; columns lat, lon, city and method
+        ('intersection' or 'interpolated'), NaN where the location could not be resolved
+        """
+        keys = normalize_address(locations)
+        resolved = {}
+        for key in keys.dropna().unique():
+            found = self.resolve_one(key)
+            if found is not None:
+                lat, lon, city_code, method = found
+                resolved[key] = (lat, lon, self.cities[city_code], method)
+
+        table = pd.DataFrame.from_dict(resolved, orient='index', columns=['lat', 'lon', 'city', 'method'])
+        return table.reindex(keys.values).reset_index(drop=True)
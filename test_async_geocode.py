@@ -0,0 +1,79 @@
+import json
+import threading
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from async_geocode import AsyncGeocoder
+
+found = {'status': 'OK', 'results': [{'geometry': {'location': {'lat': 41.82, 'lng': -71.41}},
+                                      'address_components': [{'long_name': 'Elmwood', 'types': ['neighborhood']},
+                                                             {'long_name': 'Providence', 'types': ['locality']}]}]}
+
+class Answers(object):
+    #'Busy' addresses are rate limited on their first request, 'Bad' ones rejected, 'Down' ones
+    #always a server error and 'Junk' ones not json
+    def __init__(self):
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+
+    def answer(self, address):
+        with self.lock:
+            self.requests[address] += 1
+            first = self.requests[address] == 1
+        if 'Busy' in address and first:
+            return 429, b'{}'
+        if 'Bad' in address:
+            return 400, b'{"status": "INVALID_REQUEST"}'
+        if 'Down' in address:
+            return 503, b'{}'
+        if 'Junk' in address:
+            return 200, b'<html>'
+        return 200, json.dumps(found).encode()
+
+@pytest.fixture
+def server():
+    answers = Answers()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            status, body = answers.answer(parse_qs(urlparse(self.path).query)['address'][0])
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    answers.link = 'http://127.0.0.1:'+str(httpd.server_address[1])+'/geocode/json'
+    yield answers
+    httpd.shutdown()
+    httpd.server_close()
+
+def geocoder(server, retries=2):
+    return AsyncGeocoder('test', qps=1000, retries=retries, base_delay=0.01, max_delay=0.01, link=server.link)
+
+def test_one_bad_address_does_not_fail_the_batch(server):
+    results = geocoder(server)(['1 Main St', '2 Bad St', '3 Junk St', '4 Main St'])
+    assert results[0] == results[3] == (41.82, -71.41, 'Elmwood', 'Providence')
+    assert results[1] is None and results[2] is None
+    #rejected addresses are not asked again
+    assert server.requests['2 Bad St'] == 1
+
+def test_rate_limited_address_is_retried(server):
+    client = geocoder(server)
+    assert client(['5 Busy St'])[0] == (41.82, -71.41, 'Elmwood', 'Providence')
+    assert server.requests['5 Busy St'] == 2
+    assert client.stats()['quota_errors'] == 1
+
+def test_server_errors_give_up_after_the_retries(server):
+    client = geocoder(server, retries=2)
+    assert client(['6 Down St', '7 Main St'])[0] is None
+    assert server.requests['6 Down St'] == 3
+    assert client.stats()['failures'] == 1
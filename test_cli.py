@@ -0,0 +1,9 @@
+import pvd_crime
+from cli import build_parser
+
+def test_ingest_passes_paging_options(monkeypatch):
+    runs = []
+    monkeypatch.setattr(pvd_crime, 'create_crime_log', lambda **kwargs: runs.append(kwargs))
+    args = build_parser().parse_args(['ingest', '--page-size', '250', '--mode', 'keyset', '--chunk-size', '1000'])
+    args.run(args)
+    assert runs[0]['page_size'] == 250 and runs[0]['mode'] == 'keyset' and runs[0]['chunk_size'] == 1000
@@ -0,0 +1,51 @@
+import pandas as pd
+
+from master_store import MasterStore, open_store, row_keys
+
+def crime_rows():
+    #one case charged under two statutes with the same offense_desc and reported_date, and a
+    #second case with a single statute
+    return pd.DataFrame({'casenumber': ['2018-00009699', '2018-00009699', '2018-00012612'],
+                         'counts': [1, 2, 1],
+                         'location': ['100 Broad St', '100 Broad St', '153 Benefit St'],
+                         'month': [1, 1, 2],
+                         'offense_desc': ['Assault, Simple', 'Assault, Simple', 'Larceny from Building'],
+                         'reported_date': ['2018-01-27 23:09:00', '2018-01-27 23:09:00', '2018-02-04 23:41:00'],
+                         'reporting_officer': ['SMarmas', 'SMarmas', 'DIamarone'],
+                         'statute_code': ['11-5-3', '11-5-3', '11-41-1'],
+                         'statute_desc': ['SIMPLE ASSAULT/BATTERY', 'SIMPLE ASSAULT OR BATTERY',
+                                          'LARCENY/U $1500 - FROM BLD'],
+                         'year': [2018, 2018, 2018],
+                         'offense_cat': ['other_crime', 'other_crime', 'property_crime'],
+                         'city': ['Providence'] * 3,
+                         'lat': [41.8, 41.8, 41.82],
+                         'lon': [-71.42, -71.42, -71.41],
+                         'neighborhood': ['Elmwood', 'Elmwood', 'College Hill']})
+
+def test_row_keys_tell_statutes_apart():
+    keys = row_keys(crime_rows())
+    assert len(set(keys)) == 3
+
+def test_row_keys_hash_null_statute_like_empty():
+    rows = crime_rows()
+    assert row_keys(rows.assign(statute_code=None))[2] == row_keys(rows.assign(statute_code=''))[2]
+
+def test_migration_keeps_every_statute_row(tmp_path):
+    master_file = str(tmp_path / 'master.csv')
+    crime_rows().to_csv(master_file, index=False)
+    store = open_store(str(tmp_path / 'store'), master_file)
+    assert len(store) == 3
+    assert len(store.load()) == 3
+
+def test_reingest_leaves_statute_rows_unchanged(tmp_path):
+    store = MasterStore(str(tmp_path / 'store'))
+    store.append(crime_rows())
+    assert store.append(crime_rows()) == {'inserted': 0, 'updated': 0, 'unchanged': 3}
+    assert len(MasterStore(str(tmp_path / 'store'))) == 3
+
+def test_migration_harmonizes_google_neighborhoods(tmp_path):
+    master_file = str(tmp_path / 'master.csv')
+    rows = crime_rows().assign(neighborhood=['West End Providence', 'West End Providence', 'Ward 13'])
+    rows.to_csv(master_file, index=False)
+    store = open_store(str(tmp_path / 'store'), master_file)
+    assert sorted(store.load()['neighborhood']) == ['Federal Hill', 'West End', 'West End']
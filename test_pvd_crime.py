@@ -0,0 +1,56 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+
+from fake_socrata import FakeSocrataServer
+from pvd_crime import create_df
+
+class FailingSession(requests.Session):
+    #a session whose fail_at-th request raises, like a dropped connection mid fetch
+    def __init__(self, fail_at):
+        requests.Session.__init__(self)
+        self.fail_at = fail_at
+        self.calls = 0
+
+    def get(self, *args, **kwargs):
+        self.calls += 1
+        if self.calls == self.fail_at:
+            raise requests.ConnectionError('connection dropped')
+        return requests.Session.get(self, *args, **kwargs)
+
+def write_master(path):
+    #one row older than every row the fake api serves
+    pd.DataFrame({'casenumber': ['2016-00000001'], 'counts': [1], 'location': ['100 Broad St'], 'month': [12],
+                  'offense_desc': ['Vandalism'], 'reported_date': ['2016-12-31 12:00:00'],
+                  'reporting_officer': ['SMarmas'], 'statute_code': ['11-44-1'],
+                  'statute_desc': ['VANDALISM/MALICIOUS INJURY TO PROPERTY'], 'year': [2016],
+                  'offense_cat': ['property_crime'], 'city': ['Providence'], 'lat': [41.8], 'lon': [-71.42],
+                  'neighborhood': ['Elmwood']}).to_csv(path, index=False)
+
+@pytest.mark.parametrize('mode', ['offset', 'keyset'])
+def test_create_df_after_failed_fetch_returns_every_row(tmp_path, monkeypatch, mode):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('crime_log_runs')
+    write_master('master.csv')
+    with FakeSocrataServer(n_rows=3000) as server:
+        with pytest.raises(requests.ConnectionError):
+            create_df(link=server.link, key='test', master_file='master.csv', store_dir='store', page_size=500,
+                      max_workers=1, mode=mode, session=FailingSession(fail_at=4))
+        df = create_df(link=server.link, key='test', master_file='master.csv', store_dir='store', page_size=500,
+                       max_workers=1, mode=mode, session=requests.Session())
+    assert len(df) == 3000
+    assert not os.listdir('crime_log_runs')
+
+def test_create_df_does_not_create_the_store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_master('master.csv')
+    with FakeSocrataServer(n_rows=1000) as server:
+        df = create_df(link=server.link, key='test', master_file='master.csv', store_dir='store', page_size=500,
+                       max_workers=1, session=requests.Session())
+    assert len(df) == 1000
+    assert not os.path.exists('store')
@@ -0,0 +1,25 @@
+import pandas as pd
+
+from master_store import MasterStore
+from rollups import RollupCube
+
+def crime_rows(dates):
+    return pd.DataFrame({'casenumber': ['2018-%08d' % i for i in range(len(dates))], 'counts': 1,
+                         'location': '100 Broad St', 'offense_desc': 'Vandalism', 'reported_date': dates,
+                         'statute_code': '11-44-1', 'statute_desc': 'VANDALISM/MALICIOUS INJURY TO PROPERTY',
+                         'offense_cat': 'property_crime', 'city': 'Providence', 'lat': 41.8, 'lon': -71.42,
+                         'neighborhood': 'Elmwood'})
+
+def test_hourly_rate_counts_both_ends_of_the_range(tmp_path):
+    store = MasterStore(str(tmp_path / 'store'))
+    cube = RollupCube(store)
+    store.append(crime_rows(['2018-01-01 09:00:00', '2018-01-02 09:30:00', '2018-01-03 09:10:00']))
+    rates = cube.hourly_rate()
+    assert rates.loc[9, 'Vandalism'] == 1
+    assert rates['Vandalism'].sum() == 1
+
+def test_hourly_rate_of_one_day(tmp_path):
+    store = MasterStore(str(tmp_path / 'store'))
+    cube = RollupCube(store)
+    store.append(crime_rows(['2018-01-01 09:00:00', '2018-01-01 21:00:00']))
+    assert cube.hourly_rate()['Vandalism'].sum() == 2
@@ -0,0 +1,35 @@
+import json
+
+import pandas as pd
+import pytest
+
+from run_report import RunReport
+
+def failing_stage(df):
+    raise ValueError('bad rows')
+
+def test_failed_stage_is_recorded_with_its_error(tmp_path):
+    report = RunReport()
+    report.call('classify', len, pd.DataFrame({'a': [1, 2]}))
+    try:
+        with pytest.raises(ValueError):
+            report.call('geocode', failing_stage, pd.DataFrame({'a': [1, 2, 3]}))
+    finally:
+        report.write(str(tmp_path / 'run_report.json'))
+    with open(str(tmp_path / 'run_report.json')) as f:
+        stages = json.load(f)['stages']
+    assert stages['classify']['errors'] == 0
+    assert stages['geocode']['calls'] == 1 and stages['geocode']['rows_in'] == 3
+    assert stages['geocode']['errors'] == 1 and stages['geocode']['error'] == 'ValueError: bad rows'
+
+def test_failed_fetch_chunk_is_recorded():
+    def chunks():
+        yield pd.DataFrame({'a': [1, 2]})
+        raise ConnectionError('connection dropped')
+
+    report = RunReport()
+    with pytest.raises(ConnectionError):
+        list(report.timed_iter('fetch', chunks()))
+    fetch = report.stats()['stages']['fetch']
+    assert fetch['calls'] == 1 and fetch['rows_out'] == 2
+    assert fetch['errors'] == 1 and fetch['error'] == 'ConnectionError: connection dropped'
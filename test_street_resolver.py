@@ -0,0 +1,34 @@
+import pandas as pd
+
+from street_resolver import StreetResolver
+
+vrt = '''<OGRVRTDataSource>
+    <OGRVRTLayer name="{name}">
+        <SrcDataSource relativeToVRT="1">{name}.csv</SrcDataSource>
+        <GeometryField encoding="PointFromColumns" x="LON" y="LAT"/>
+    </OGRVRTLayer>
+</OGRVRTDataSource>'''
+
+def write_source(address_dir, name, numbers, street, lat, lon):
+    #points up one street, numbered every 10 and 0.001 degrees apart
+    (address_dir / (name + '.vrt')).write_text(vrt.format(name=name))
+    pd.DataFrame({'LON': [lon] * len(numbers), 'LAT': [lat + i * 0.001 for i in range(len(numbers))],
+                  'NUMBER': [str(n) for n in numbers], 'STREET': street}).to_csv(address_dir / (name + '.csv'),
+                                                                                   index=False)
+
+def write_addresses(address_dir):
+    #Cedar St in both cities; grouped by name only, 64 Cedar St would be interpolated between
+    #Cranston's 60 and Providence's 70, two miles apart
+    write_source(address_dir, 'city_of_cranston', [10, 20, 30, 40, 50, 60], 'Cedar St', 41.78, -71.44)
+    write_source(address_dir, 'providence', [70, 80, 90, 100], 'Cedar Street', 41.83, -71.42)
+
+def test_shared_street_name_resolves_in_providence(tmp_path):
+    write_addresses(tmp_path)
+    found = StreetResolver(str(tmp_path)).resolve(['84 Cedar St', '20 Cedar St'])
+    assert list(found['city']) == ['Providence', 'Cranston']
+    assert round(found['lat'][0], 4) == 41.8314
+
+def test_city_picks_the_group_tried_first(tmp_path):
+    write_addresses(tmp_path)
+    found = StreetResolver(str(tmp_path), city='Cranston').resolve(['64 Cedar St'])
+    assert found['city'][0] == 'Cranston'
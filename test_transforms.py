@@ -0,0 +1,28 @@
+import pytest
+
+from transforms import normalize_locations, intern_locations
+
+@pytest.mark.parametrize('raw, canonical', [
+    ('12 Main St Apt 3', '12 Main St'),
+    ('12 Main St # 2b', '12 Main St'),
+    ('12 Main St Unit 4', '12 Main St'),
+    ('12 Main Street Suite 200', '12 Main St'),
+    ('12 Main St Fl. 2', '12 Main St'),
+    ('12 Main St Room 5', '12 Main St'),
+    ('12 North Main Street Apt 3', '12 N Main St'),
+    #streets named like a unit word keep their name
+    ('101 Unit St', '101 Unit St'),
+    ('101 unit street', '101 Unit St'),
+    ('7 Unit St Apt 2', '7 Unit St'),
+    ('Cloud St & Unit St', 'Cloud St At Unit St'),
+    ('12 Suite Ave', '12 Suite Ave'),
+    ('5 Floor Rd.', '5 Floor Rd'),
+    ('12 Room Pl', '12 Room Pl'),
+])
+def test_normalize_locations_units(raw, canonical):
+    assert normalize_locations([raw])[0] == canonical
+
+def test_intern_locations_shares_ids_of_variants():
+    ids, table = intern_locations(['101 Unit St', '101 unit street', '101 Unit St Apt 2', None])
+    assert list(ids) == [0, 0, 0, -1]
+    assert list(table) == ['101 Unit St']
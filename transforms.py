@@ -0,0 +1,155 @@
+import re
+
+import pandas as pd
+import numpy as np
+
+#Vectorized transforms for crime log DataFrames.
+#Offenses are categorized through a lookup table applied to the distinct offense codes,
+#dates are parsed with a fixed format fast path, and hour/minute/day come from the dt accessor.
+#Locations are normalized once per distinct string by one compiled regex and interned to integer ids.
+
+violent_crime = ['Assault, Aggravated', 'Murder\\Manslaughter', 'Statutory Rape', 'Assault, Threats']
+
+property_crime = ['Larceny from Motor Vehicle', 'Vandalism', 'Larceny from Building', 'Burglary',
+                  'Robbery', 'Larceny, Other', 'Larceny, Purse-snatching', 'Motor Vehicle Theft',
+                  'Larceny, Shoplifting', 'Tresspassing', 'Arson']
+
+offense_categories = ['other_crime', 'property_crime', 'violent_crime']
+
+api_date_format = '%Y-%m-%dT%H:%M:%S.%f'
+
+#street suffixes written out in full (after title casing) and their canonical abbreviation
+street_abbreviations = {'Street': 'St', 'Str': 'St', 'Avenue': 'Ave', 'Av': 'Ave', 'Road': 'Rd', 'Drive': 'Dr',
+                        'Place': 'Pl', 'Boulevard': 'Blvd', 'Bl': 'Blvd', 'Court': 'Ct', 'Lane': 'Ln',
+                        'Parkway': 'Pkwy', 'Pky': 'Pkwy', 'Terrace': 'Ter', 'Terr': 'Ter', 'Square': 'Sq',
+                        'Circle': 'Cir', 'Highway': 'Hwy', 'Plaza': 'Plz'}
+name_abbreviations = {'Mount': 'Mt', 'Saint': 'St'}
+directions = {'North': 'N', 'South': 'S', 'East': 'E', 'West': 'W'}
+unit_words = ['Apt', 'Apartment', 'Unit', 'Ste', 'Suite', 'Rm', 'Room', 'Fl', 'Floor']
+
+def alternatives(words):
+    return '(?:' + '|'.join(sorted(words, key=len, reverse=True)) + r')\b'
+
+#what may follow the last word of a street name: the end, a unit or a cross street
+street_end = r'(?=\s*$|\s*[#&/]|\s+At\b|\s+' + alternatives(unit_words) + ')'
+street_words = set(street_abbreviations) | set(street_abbreviations.values()) | {'Way', 'At'}
+
+#every rule is one alternative, so a location is rewritten in a single scan
+location_rules = re.compile(
+    #unit suffixes at the end, e.g. '12 Main St Apt 3', '12 Main St # 2b'; not when the word
+    #after the unit word is a street suffix, as in the street '101 Unit St'
+    r'(?P<unit>\s*(?:#|\b' + alternatives(unit_words) + r'\.?)\s*(?!' + alternatives(street_words)
+    + r'\.?\s*$)[\w-]*\s*$)'
+    #cross streets, '&' and '/' as the api writes them
+    r'|(?P<cross>\s*[&/]\s*)'
+    #a direction starting a street name, not when it is the name itself as in 'West St'
+    r'|(?P<direction>\b' + alternatives(directions) + r'(?=\s+(?!' + alternatives(street_words) + r')\S+\s+\S))'
+    #suffixes only as the last word, so 'Court St' keeps its name
+    r'|(?P<suffix>\b' + alternatives(street_abbreviations) + street_end + ')'
+    r'|(?P<name>\b' + alternatives(name_abbreviations) + ')'
+    r'|(?P<period>\.)'
+    r'|(?P<space>\s{2,}|[^\S ])')
+
+#most locations are already canonical; the full rules only run on ones holding a character or
+#word some rule rewrites
+rule_chars = re.compile(r'[&/#.\t\n\r\f\v]|  |^\s|\s$')
+rule_words = set(street_abbreviations) | set(name_abbreviations) | set(directions) | set(unit_words)
+
+def offense_table(violent_crime=violent_crime, property_crime=property_crime):
+    """
+    Returns a Series mapping offense_desc to its offense_cat; offenses not in it are other_crime
+    """
+    table = pd.Series('violent_crime', index=violent_crime)
+    return pd.concat([table, pd.Series('property_crime', index=property_crime)])
+
+def classify_offenses(offense_desc, table=None):
+    """
+    Takes an array or Series of offense descriptions and returns a Categorical of
+    'violent_crime', 'property_crime' or 'other_crime'
+
+    Each distinct offense is looked up once in the table, the rows are mapped by category code
+    """
+    if table is None:
+        table = offense_table()
+    offenses = pd.Categorical(offense_desc)
+
+    #category of each distinct offense, plus a last slot for missing offenses (code -1)
+    category_codes = pd.Categorical(table.reindex(offenses.categories).fillna('other_crime'),
+                                    categories=offense_categories).codes
+    category_codes = np.append(category_codes, offense_categories.index('other_crime')).astype('int8')
+
+    return pd.Categorical.from_codes(category_codes[offenses.codes], categories=offense_categories)
+
+def parse_reported_dates(dates, date_format=api_date_format):
+    """
+    Takes an array or Series of date strings and returns a Series of datetime64
+
+    Tries the fixed format first, which pandas parses without inferring each string;
+    falls back to pandas' format inference if any string does not match it.
+    Values that are already datetimes are returned as is.
+    """
+    dates = pd.Series(dates)
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+    try:
+        return pd.to_datetime(dates, format=date_format)
+    except (ValueError, TypeError):
+        return pd.to_datetime(dates)
+
+def hour_minute_day(dates):
+    """
+    Takes a Series of datetimes and returns a DataFrame of hour, minute and day columns
+    """
+    dates = pd.Series(dates)
+    return pd.DataFrame({'hour': dates.dt.hour.values.astype('int8'), 'minute': dates.dt.minute.values.astype('int8'),
+                         'day': dates.dt.day.values.astype('int8')}, index=dates.index)
+
+def add_hour_minute_day(df, column='reported_date'):
+    """
+    Returns df with hour, minute and day columns from the datetimes in column,
+    and counts, month and year made numeric
+    """
+    numeric = {col: pd.to_numeric(df[col]) for col in ['counts', 'month', 'year'] if col in df}
+    return df.assign(**numeric).assign(**hour_minute_day(df[column]))
+
+def location_rule(match):
+    rule = match.lastgroup
+    if rule == 'cross':
+        return ' At '
+    if rule == 'direction':
+        return directions[match.group(rule)]
+    if rule == 'suffix':
+        return street_abbreviations[match.group(rule)]
+    if rule == 'name':
+        return name_abbreviations[match.group(rule)]
+    if rule == 'space':
+        return ' '
+    return ''
+
+def normalize_locations(locations):
+    """
+    Takes an array of distinct location strings and returns an object array of canonical ones;
+    title case, '&' and '/' as ' At ', abbreviated street words and leading directions, unit
+    suffixes and periods dropped and single spaces, e.g. '12 North Main Street Apt 3' becomes
+    '12 N Main St'. Empty results are None.
+    """
+    titled = pd.Series(np.asarray(locations, dtype=object)).astype(str).str.title()
+    canonical = [location_rules.sub(location_rule, location).strip()
+                 if rule_chars.search(location) or not rule_words.isdisjoint(location.split()) else location
+                 for location in titled]
+    return np.array([location or None for location in canonical], dtype=object)
+
+def intern_locations(locations):
+    """
+    Takes an array or Series of raw location strings and returns (ids, table); int32 ids with
+    table[ids] the canonical location of each row, -1 for missing locations
+
+    Only the distinct raw strings are normalized, and raw variants of the same place
+    ('12 Main Street', '12 main st ') share one id.
+    """
+    raw = pd.Categorical(np.asarray(locations, dtype=object))
+    canonical = normalize_locations(raw.categories)
+    raw_ids, table = pd.factorize(canonical)
+    #code -1 (missing) picks the appended -1
+    ids = np.append(raw_ids, -1).astype('int32')[raw.codes]
+    return ids, np.asarray(table, dtype=object)